@@ -0,0 +1,125 @@
+"""
+Бенчмарк: проверка нескольких ящиков из одного процесса
+
+Поднимает фейковый IMAP сервер с несколькими ящиками (у одного есть папка
+"Спам", куда тоже попадают письма суда) и сравнивает время check_email при
+последовательной и параллельной проверке ящиков с временем самого медленного
+ящика. Заодно проверяет, что уведомления ушли в чаты своих ящиков.
+
+Заглушки работают в том же процессе и делят с ним GIL, поэтому при малых
+задержках параллельный запуск упирается в их собственную нагрузку на CPU;
+реалистичные задержки сети (десятки мс) показывают выигрыш честнее.
+
+Пример:
+    python benchmarks/bench_accounts.py --accounts 4 --messages 200
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeMailbox, FakeTelegramServer
+
+SPAM_FOLDER = 'Спам'
+
+
+def build_accounts(args):
+    """
+    Ящики фейкового сервера и соответствующий им файл настроек
+
+    Returns:
+        tuple: (папки по логинам для FakeIMAPServer, список ящиков для ACCOUNTS_FILE)
+    """
+    server_accounts = {}
+    config = []
+    for index in range(args.accounts):
+        login = f"firm{index}@example.test"
+        # Ящики разного размера, чтобы один из них был заметно медленнее
+        count = args.messages * (index + 1) // args.accounts
+        folders = {'INBOX': corpus.generate_mailbox(count, court_ratio=0.3, seed=index)}
+        if index == 0:
+            folders[SPAM_FOLDER] = corpus.generate_mailbox(
+                count // 4, court_ratio=0.2, seed=100, mailbox=FakeMailbox(mail_notifier.encode_mailbox_name(SPAM_FOLDER)),
+            )
+        server_accounts[login] = {mail_notifier.encode_mailbox_name(name): box for name, box in folders.items()}
+        config.append({
+            'name': f"firm{index}",
+            'email': login,
+            'password': 'bench',
+            'folders': list(folders),
+            'chat_id': str(1000 + index),
+        })
+    return server_accounts, config
+
+
+def run(args, accounts_filter=None, workers=1):
+    """Один запуск check_email на свежих ящиках"""
+    server_accounts, config = build_accounts(args)
+    if accounts_filter is not None:
+        config = [config[accounts_filter]]
+    imap_server = FakeIMAPServer(accounts=server_accounts, latency=args.imap_latency).start()
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+    host, port = imap_server.address
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(host, port, use_ssl=False)
+    mail_notifier.ACCOUNT_WORKERS = workers
+    mail_notifier._telegram_client = mail_notifier.TelegramClient(
+        'TOKEN', api_url=telegram_server.api_url, chat_rate=100000,
+    )
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        mail_notifier.STATE_FILE = os.path.join(state_dir, 'email_state.json')
+        mail_notifier.MESSAGE_CACHE_FILE = ''
+        mail_notifier.ACCOUNTS_FILE = os.path.join(state_dir, 'accounts.json')
+        with open(mail_notifier.ACCOUNTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'accounts': config}, f, ensure_ascii=False)
+        started = time.perf_counter()
+        mail_notifier.run_coroutine(mail_notifier.check_email())
+        elapsed = time.perf_counter() - started
+        with open(mail_notifier.STATE_FILE, encoding='utf-8') as f:
+            state = json.load(f)
+
+    imap_server.stop()
+    telegram_server.stop()
+    mail_notifier._telegram_client.close()
+    chats = {}
+    for message in telegram_server.messages:
+        chats[message['chat_id']] = chats.get(message['chat_id'], 0) + 1
+    return elapsed, chats, sorted(state['mailboxes'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=200, help='писем в самом большом ящике')
+    parser.add_argument('--imap-latency', type=float, default=0.05)
+    parser.add_argument('--telegram-latency', type=float, default=0.05)
+    args = parser.parse_args()
+
+    mail_notifier.logger.setLevel(logging.WARNING)
+    mail_notifier.TELEGRAM_DIGEST_THRESHOLD = 0
+    mail_notifier.TELEGRAM_GLOBAL_RATE = 100000
+
+    single = [run(args, accounts_filter=index)[0] for index in range(args.accounts)]
+    sequential, _, _ = run(args, workers=1)
+    concurrent, chats, mailboxes = run(args, workers=args.accounts)
+
+    print(f"Ящиков: {args.accounts}, задержка IMAP {args.imap_latency * 1000:.0f} мс, "
+          f"Telegram {args.telegram_latency * 1000:.0f} мс")
+    for index, elapsed in enumerate(single):
+        print(f"  firm{index} отдельно: {elapsed:.2f} с")
+    print(f"Сумма по ящикам:        {sum(single):.2f} с")
+    print(f"Последовательно:        {sequential:.2f} с")
+    print(f"Параллельно:            {concurrent:.2f} с (самый медленный ящик {max(single):.2f} с)")
+    print(f"Уведомлений по чатам:   {dict(sorted(chats.items()))}")
+    print(f"Состояние папок:        {', '.join(mailboxes)}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Бенчмарк: разбор накопившегося бэклога непрочитанных писем
+
+Имитирует ситуацию после простоя: в ящике много непрочитанных писем, часть из
+них - уведомления суда. Замеряет время полного прохода check_email и
+пропускную способность (писем и уведомлений в секунду) против локальных
+заглушек IMAP и Telegram с задержкой на каждый запрос. С --replay после
+первого прохода состояние удаляется, а письма снова становятся непрочитанными
+(как при повторной обработке после сбоя): второй проход отвечает из
+локального кэша писем.
+
+Пример:
+    python benchmarks/bench_backlog.py --messages 1000 --court-ratio 0.5
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeTelegramServer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--court-ratio', type=float, default=0.5)
+    parser.add_argument('--attachment-size', type=int, default=50000)
+    parser.add_argument('--imap-latency', type=float, default=0.005, help='задержка IMAP команды, секунды')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='задержка ответа Bot API, секунды')
+    parser.add_argument('--replay', action='store_true', help='повторный проход после сброса состояния')
+    args = parser.parse_args()
+
+    mailbox = corpus.generate_mailbox(args.messages, court_ratio=args.court_ratio,
+                                      attachment_size=args.attachment_size)
+    imap_server = FakeIMAPServer({'INBOX': mailbox}, latency=args.imap_latency).start()
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+    host, port = imap_server.address
+
+    mail_notifier.logger.setLevel(logging.WARNING)
+    mail_notifier.YANDEX_EMAIL = 'bench@example.test'
+    mail_notifier.YANDEX_APP_PASSWORD = 'bench'
+    mail_notifier.TELEGRAM_CHAT_ID = '100500'
+    mail_notifier.TELEGRAM_DIGEST_THRESHOLD = 0
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(host, port, use_ssl=False)
+    # Лимиты Telegram не ограничивают замер: нас интересует собственная скорость пайплайна
+    mail_notifier.TELEGRAM_GLOBAL_RATE = 100000
+    mail_notifier._telegram_client = mail_notifier.TelegramClient(
+        'TOKEN', api_url=telegram_server.api_url, chat_rate=100000,
+    )
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        mail_notifier.STATE_FILE = os.path.join(state_dir, 'email_state.json')
+        mail_notifier.MESSAGE_CACHE_FILE = os.path.join(state_dir, 'message_cache.sqlite3')
+        mail_notifier._message_cache = None
+        report(args, 'Первый проход', run_pass(imap_server, telegram_server))
+        if args.replay:
+            # Сбрасывается и журнал доставок, иначе повтор не отправит уже доставленное
+            os.remove(mail_notifier.STATE_FILE)
+            mail_notifier._state_journal = None
+            for message in mailbox.messages:
+                message.flags.discard('\\Seen')
+            report(args, 'Повтор из кэша', run_pass(imap_server, telegram_server))
+        mail_notifier.get_message_cache().close()
+
+    imap_server.stop()
+    telegram_server.stop()
+
+
+def run_pass(imap_server, telegram_server):
+    """Один проход check_email со сбросом счетчиков заглушек"""
+    imap_server.reset_stats()
+    telegram_server.messages.clear()
+    started = time.perf_counter()
+    mail_notifier.run_coroutine(mail_notifier.check_email())
+    return {
+        'seconds': time.perf_counter() - started,
+        'notifications': len(telegram_server.messages),
+        'commands': imap_server.stats.get('commands', 0),
+        'bytes': imap_server.stats.get('bytes_sent', 0),
+    }
+
+
+def report(args, label, result):
+    elapsed = result['seconds']
+    print(f"{label}: писем {args.messages}, уведомлений суда {result['notifications']}, "
+          f"задержка IMAP {args.imap_latency * 1000:.0f} мс, Telegram {args.telegram_latency * 1000:.0f} мс")
+    print(f"IMAP команд: {result['commands']}, получено {mail_notifier.format_bytes(result['bytes'])}")
+    print(f"Время: {elapsed:.2f} с, {args.messages / elapsed:.0f} писем/с, "
+          f"{result['notifications'] / elapsed:.1f} уведомлений/с")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Бенчмарк: режим демона с десятками ящиков в одном процессе
+
+Запускает run_daemons отдельным процессом для --accounts ящиков фейкового
+IMAP сервера (у каждого свой чат). Когда все ящики вошли в IDLE, в каждый
+приходит уведомление суда, и замеряется задержка от появления письма до
+сообщения в заглушке Telegram. Дочерний процесс сообщает число своих потоков
+и пиковую память (VmHWM) - с одним циклом событий они не растут с числом
+ящиков, как раньше с потоком на каждый ящик.
+
+Отдельный сценарий: письмо приходит посреди проверки, перед которой демон
+войдет в IDLE. Сервер сообщает о нем EXISTS в ответе на SEARCH, и в IDLE
+уже не повторит - уведомление должно уйти сразу, а не через IDLE_TIMEOUT.
+
+С --check завершается с кодом 1, если не все уведомления дошли, потоков
+больше --max-threads или p99 задержки (в том числе для письма посреди
+проверки) больше --max-latency.
+
+Пример:
+    python benchmarks/bench_daemon.py --accounts 50 --check
+"""
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeMailbox, FakeTelegramServer
+
+# Код дочернего процесса: демоны всех ящиков и задача, которая ждет доставки и останавливает их
+CHILD = """
+import asyncio, json, resource, sys, threading
+def peak_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+config = json.loads(sys.argv[1])
+import mail_notifier
+mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(
+    config['host'], config['port'], use_ssl=False,
+)
+mail_notifier.STATE_FILE = config['state']
+mail_notifier.MESSAGE_CACHE_FILE = ''
+
+async def run():
+    daemons = asyncio.ensure_future(mail_notifier.run_daemons(mail_notifier.load_accounts()))
+    threads = 0
+    while mail_notifier.metrics.summary()['counters'].get('notifications_delivered', 0) < config['expected']:
+        threads = max(threads, threading.active_count())
+        await asyncio.sleep(0.05)
+    daemons.cancel()
+    try:
+        await daemons
+    except asyncio.CancelledError:
+        pass
+    return threads
+
+threads = mail_notifier.run_coroutine(run())
+print(json.dumps({'threads': threads, 'rss': peak_rss()}))
+"""
+
+
+def percentile(values, share):
+    """Перцентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share / 100 * len(ordered)) - 1)]
+
+
+def child_env(telegram_server, accounts_file):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'TELEGRAM_BOT_TOKEN': 'TOKEN',
+        'TELEGRAM_API_URL': telegram_server.api_url,
+        'TELEGRAM_CHAT_RATE': '1000',
+        'TELEGRAM_DIGEST_THRESHOLD': '0',
+        'ACCOUNTS_FILE': accounts_file,
+        'ACCOUNT_WORKERS': '4',
+        'PROCESSED_FOLDER': '',
+        'LOG_LEVEL': 'WARNING',
+    })
+    return env
+
+
+def wait_for(condition, timeout, process):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if process.poll() is not None:
+            sys.exit(f"Демон завершился с кодом {process.returncode}:\n{process.stderr.read()[-2000:]}")
+        if time.monotonic() > deadline:
+            process.kill()
+            sys.exit("Демон не дождался писем за отведенное время")
+        time.sleep(0.02)
+
+
+def measure(args):
+    """
+    Один запуск демонов: ожидание IDLE во всех ящиках, письмо в каждый и доставка
+
+    Returns:
+        dict: Задержки уведомлений, потоки и пиковая память дочернего процесса
+    """
+    rng = random.Random(args.seed)
+    mailboxes = {f"firm{index}@example.test": FakeMailbox() for index in range(args.accounts)}
+    imap_server = FakeIMAPServer(accounts={login: {'INBOX': box} for login, box in mailboxes.items()},
+                                 latency=args.imap_latency).start()
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+    host, port = imap_server.address
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        accounts_file = os.path.join(state_dir, 'accounts.json')
+        with open(accounts_file, 'w', encoding='utf-8') as f:
+            json.dump({'accounts': [
+                {'name': f"firm{index}", 'email': login, 'password': 'bench', 'chat_id': str(1000 + index)}
+                for index, login in enumerate(mailboxes)
+            ]}, f)
+        config = {'host': host, 'port': port, 'expected': args.accounts,
+                  'state': os.path.join(state_dir, 'email_state.json')}
+        process = subprocess.Popen([sys.executable, '-c', CHILD, json.dumps(config)], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True, env=child_env(telegram_server, accounts_file))
+        wait_for(lambda: imap_server.stats.get('cmd_idle', 0) >= args.accounts, args.timeout, process)
+
+        arrived = {}
+        for index, mailbox in enumerate(mailboxes.values()):
+            arrived[str(1000 + index)] = time.time()
+            mailbox.append(corpus.build_court_notice(rng))
+        wait_for(lambda: len(telegram_server.messages) >= args.accounts, args.timeout, process)
+        stdout, stderr = process.communicate(timeout=args.timeout)
+    imap_server.stop()
+    telegram_server.stop()
+    if process.returncode != 0:
+        print(stderr[-2000:])
+        sys.exit(f"Демон завершился с кодом {process.returncode}")
+
+    report = json.loads(stdout.strip().splitlines()[-1])
+    report['latencies'] = [message['time'] - arrived[message['chat_id']] for message in telegram_server.messages]
+    report['chats'] = len({message['chat_id'] for message in telegram_server.messages})
+    return report
+
+
+def measure_mid_check(args):
+    """
+    Письмо приходит после SELECT первой проверки, до входа демона в IDLE
+
+    Демон работает в этом же процессе: обертка search_messages кладет письмо в
+    ящик при первом поиске, его UID уже за границей UIDNEXT этой проверки.
+
+    Returns:
+        float or None: Задержка от письма до Telegram или None, если не дошло за --max-latency * 5
+    """
+    rng = random.Random(args.seed)
+    mailbox = FakeMailbox()
+    imap_server = FakeIMAPServer(accounts={'midcheck@example.test': {'INBOX': mailbox}}).start()
+    telegram_server = FakeTelegramServer().start()
+    host, port = imap_server.address
+
+    mail_notifier.logger.setLevel(logging.WARNING)
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(host, port, use_ssl=False)
+    mail_notifier._telegram_client = mail_notifier.TelegramClient('TOKEN', api_url=telegram_server.api_url)
+    mail_notifier.MESSAGE_CACHE_FILE = ''
+    mail_notifier.PROCESSED_FOLDER = ''
+    mail_notifier.TELEGRAM_DIGEST_THRESHOLD = 0
+    mail_notifier.YANDEX_EMAIL = 'midcheck@example.test'
+    mail_notifier.YANDEX_APP_PASSWORD = 'bench'
+    mail_notifier.TELEGRAM_CHAT_ID = '1000'
+
+    arrived = []
+    search_messages = mail_notifier.search_messages
+
+    async def search_with_arrival(mail, base_criteria):
+        if not arrived:
+            arrived.append(time.time())
+            mailbox.append(corpus.build_court_notice(rng))
+        return await search_messages(mail, base_criteria)
+
+    async def run():
+        daemons = asyncio.ensure_future(mail_notifier.run_daemons([mail_notifier.default_account()]))
+        deadline = time.monotonic() + args.max_latency * 5
+        while not telegram_server.messages and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        daemons.cancel()
+        try:
+            await daemons
+        except asyncio.CancelledError:
+            pass
+
+    mail_notifier.search_messages = search_with_arrival
+    with tempfile.TemporaryDirectory() as state_dir:
+        mail_notifier.STATE_FILE = os.path.join(state_dir, 'email_state.json')
+        try:
+            mail_notifier.run_coroutine(run())
+        finally:
+            mail_notifier.search_messages = search_messages
+            if mail_notifier._state_journal is not None:
+                mail_notifier._state_journal.close()
+                mail_notifier._state_journal = None
+    imap_server.stop()
+    telegram_server.stop()
+    if not telegram_server.messages:
+        return None
+    return telegram_server.messages[0]['time'] - arrived[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--accounts', type=int, default=50, help='ящиков, у каждого свой чат')
+    parser.add_argument('--imap-latency', type=float, default=0.0, help='задержка IMAP команды, секунды')
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help='задержка ответа Bot API, секунды')
+    parser.add_argument('--timeout', type=float, default=60.0, help='сколько ждать демона, секунды')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--check', action='store_true', help='код возврата 1 при регрессии')
+    parser.add_argument('--max-threads', type=int, default=8, help='потолок потоков дочернего процесса')
+    parser.add_argument('--max-latency', type=float, default=2.0, help='потолок p99 задержки, секунды')
+    args = parser.parse_args()
+
+    report = measure(args)
+    latencies = report['latencies']
+    print(f"Ящиков в IDLE: {args.accounts}, доставлено уведомлений: {len(latencies)} в {report['chats']} чатов")
+    print(f"Задержка от письма до Telegram: p50 {percentile(latencies, 50):.3f} с, "
+          f"p99 {percentile(latencies, 99):.3f} с")
+    print(f"Потоков в процессе демона: {report['threads']}, пиковая память: "
+          f"{mail_notifier.format_bytes(report['rss'])}")
+    mid_check = measure_mid_check(args)
+    print("Письмо посреди проверки перед IDLE: " +
+          (f"доставлено через {mid_check:.3f} с" if mid_check is not None
+           else f"не доставлено за {args.max_latency * 5:.0f} с"))
+
+    if args.check:
+        failures = []
+        if len(latencies) != args.accounts or report['chats'] != args.accounts:
+            failures.append(f"доставлено {len(latencies)} уведомлений в {report['chats']} чатов из {args.accounts}")
+        if report['threads'] > args.max_threads:
+            failures.append(f"потоков {report['threads']} > {args.max_threads}")
+        if percentile(latencies, 99) > args.max_latency:
+            failures.append(f"p99 задержки {percentile(latencies, 99):.3f} с > {args.max_latency:.1f} с")
+        if mid_check is None or mid_check > args.max_latency:
+            failures.append("письмо, пришедшее посреди проверки, ждало следующего выхода из IDLE")
+        if failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Бенчмарк: декодирование тел писем с учетом кодировки против слепого UTF-8
+
+Строит корпус текстовых частей в UTF-8, windows-1251 и koi8-r с разными
+Content-Transfer-Encoding (8bit, base64, quoted-printable), включая части с
+отсутствующей и неверно указанной кодировкой. Для прежнего и текущего
+разбора считает долю правильно прочитанных отрывков и скорость в МБ/с по
+лучшему из --repeat проходов.
+
+С --check завершается с кодом 1, если текущий разбор прочитал неверно хотя бы
+одну часть или оказался медленнее прежнего больше чем в --max-slowdown раз.
+
+Пример:
+    python benchmarks/bench_decode.py --parts 3000 --check
+"""
+import argparse
+import base64
+import email
+import html
+import os
+import quopri
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail_notifier
+
+PARAGRAPHS = (
+    'Уважаемый участник процесса! Вам предоставлен доступ к материалам дела в системе "Мой Арбитр".',
+    'Дело рассматривается Арбитражным судом города Москвы, судья Иванов И. И.',
+    'Судебное заседание назначено на 17.11.2025 в 10 часов 30 минут, зал 5014.',
+    'Ознакомиться с материалами дела можно в личном кабинете на сайте kad.arbitr.ru.',
+    'Это письмо сформировано автоматически и не требует ответа.',
+)
+CHARSETS = ('utf-8', 'cp1251', 'koi8-r')
+TRANSFER_ENCODINGS = ('8bit', 'base64', 'quoted-printable')
+# Метка кодировки в заголовке: правильная, отсутствует или ошибочная
+LABELS = ('correct', 'correct', 'correct', 'missing', 'wrong')
+WRONG_LABELS = {'utf-8': 'windows-1251', 'cp1251': 'utf-8', 'koi8-r': 'utf-8'}
+PREVIEW_CHARS = 120
+
+
+def encode_body(data, transfer_encoding):
+    """Применяет Content-Transfer-Encoding к телу части"""
+    if transfer_encoding == 'base64':
+        return base64.encodebytes(data).replace(b'\n', b'\r\n')
+    if transfer_encoding == 'quoted-printable':
+        return quopri.encodestring(data).replace(b'\n', b'\r\n')
+    return data
+
+
+def build_part(rng, size):
+    """
+    Одна текстовая часть письма
+
+    Returns:
+        tuple: (заголовки части, тело части, ожидаемый текст, описание)
+    """
+    text = ' '.join(rng.choice(PARAGRAPHS) for _ in range(max(1, size // 80)))
+    charset = rng.choice(CHARSETS)
+    transfer_encoding = rng.choice(TRANSFER_ENCODINGS)
+    subtype = rng.choice(('plain', 'html'))
+    label = rng.choice(LABELS)
+    content = text if subtype == 'plain' else f"<html><body><p>{html.escape(text)}</p></body></html>"
+
+    declared = {'correct': charset, 'missing': None, 'wrong': WRONG_LABELS[charset]}[label]
+    content_type = f"text/{subtype}" + (f"; charset={declared}" if declared else '')
+    headers = f"Content-Type: {content_type}\r\nContent-Transfer-Encoding: {transfer_encoding}\r\n\r\n"
+    body = encode_body(content.encode(charset), transfer_encoding)
+    return headers.encode('ascii'), body, text, f"{charset}/{transfer_encoding}/{label}"
+
+
+def legacy_parse(part_data):
+    """Прежний разбор: склейка с заголовками, пакет email и слепой UTF-8"""
+    mime_headers, body_bytes = part_data
+    msg = email.message_from_bytes(mime_headers + body_bytes)
+    content = msg.get_payload(decode=True).decode('utf-8', errors='ignore')
+    if msg.get_content_type() == 'text/html':
+        return mail_notifier.extract_plain_text_from_html(content)
+    return content.strip()
+
+
+def preview(text):
+    return ' '.join(text.split())[:PREVIEW_CHARS]
+
+
+def run(parse, parts):
+    """Разбирает весь корпус и считает правильно прочитанные отрывки"""
+    started = time.perf_counter()
+    results = [parse((headers, body)) for headers, body, _, _ in parts]
+    elapsed = time.perf_counter() - started
+    failures = {}
+    for result, (_, _, text, kind) in zip(results, parts):
+        if preview(result) != preview(text):
+            failures[kind] = failures.get(kind, 0) + 1
+    return elapsed, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--parts', type=int, default=3000)
+    parser.add_argument('--size', type=int, default=2000, help='средний размер текста части, символов')
+    parser.add_argument('--repeat', type=int, default=5, help='проходов корпуса, время - лучший из них')
+    parser.add_argument('--max-slowdown', type=float, default=1.25,
+                        help='допустимое замедление текущего разбора относительно прежнего для --check')
+    parser.add_argument('--check', action='store_true', help='код возврата 1 при ошибке декодирования или замедлении')
+    args = parser.parse_args()
+
+    rng = random.Random(11)
+    parts = [build_part(rng, rng.randint(args.size // 2, args.size * 3 // 2)) for _ in range(args.parts)]
+    megabytes = sum(len(body) for _, body, _, _ in parts) / 1024 / 1024
+
+    print(f"Частей: {args.parts}, объем тел {megabytes:.1f} МБ")
+    print(f"{'разбор':<10}{'верно':>10}{'мс/МБ':>10}{'МБ/с':>10}")
+    parsers = (('прежний', legacy_parse), ('текущий', mail_notifier.parse_body_part))
+    results = {}
+    # Проходы чередуются, чтобы колебания нагрузки на машину доставались обоим разборам
+    for _ in range(args.repeat):
+        for name, parse in parsers:
+            elapsed, failures = run(parse, parts)
+            if name not in results or elapsed < results[name][0]:
+                results[name] = (elapsed, failures)
+    for name, _ in parsers:
+        elapsed, failures = results[name]
+        correct = args.parts - sum(failures.values())
+        print(f"{name:<10}{correct / args.parts:>10.1%}{elapsed * 1000 / megabytes:>10.1f}{megabytes / elapsed:>10.1f}")
+        for kind, count in sorted(failures.items(), key=lambda item: -item[1])[:5]:
+            print(f"    ошибки {kind}: {count}")
+
+    if args.check:
+        check_failures = []
+        legacy_elapsed, _ = results['прежний']
+        elapsed, failures = results['текущий']
+        if failures:
+            check_failures.append(f"неверно прочитано {sum(failures.values())} из {args.parts} частей")
+        if elapsed > legacy_elapsed * args.max_slowdown:
+            check_failures.append(f"разбор медленнее прежнего в {elapsed / legacy_elapsed:.2f} раза "
+                                  f"(допустимо {args.max_slowdown:.2f})")
+        if check_failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(check_failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,190 @@
+"""
+Бенчмарк: отсев повторных уведомлений суда
+
+1. Стоимость проверки письма по индексу отправленных уведомлений при разной
+   длине истории (словарь хэшей - время проверки не должно расти).
+2. Два ящика на фейковом IMAP сервере: часть уведомлений из первого ящика
+   лежит копией (тот же Message-ID) во втором, часть дел суд прислал
+   повторно (новый Message-ID, тот же номер дела и тема). Сравнивается число
+   сообщений в Telegram и загруженных тел писем с отсевом и без него, затем
+   в ящики приходят еще копии и проверяется, что следующий запуск (со
+   снимком состояния предыдущего) их тоже не отправляет.
+
+С --check завершается с кодом 1, если хотя бы один повтор дошел до Telegram
+или уникальное уведомление потерялось.
+
+Пример:
+    python benchmarks/bench_dedup.py --notices 200 --check
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeMailbox, FakeTelegramServer
+
+
+def measure_lookup(sizes, checks=20000):
+    """
+    Время claim по индексу с историей каждой длины из sizes
+
+    Returns:
+        list: [(длина истории, мкс на проверку нового письма, мкс на проверку повтора)]
+    """
+    now = time.time()
+    results = []
+    for size in sizes:
+        keys = [mail_notifier.notice_dedup_keys(f"<{index}@bench>", f"Дело А40-{index}/2025") for index in range(size)]
+        index = mail_notifier.DedupIndex({key: int(now) for pair in keys for key in pair})
+        fresh = [mail_notifier.notice_dedup_keys(f"<new{i}@bench>", f"Дело А41-{i}/2025") for i in range(checks)]
+        repeats = [keys[i % size] for i in range(checks)]
+        started = time.perf_counter()
+        for pair in fresh:
+            index.claim(pair, now)
+        fresh_us = (time.perf_counter() - started) / checks * 1e6
+        started = time.perf_counter()
+        for pair in repeats:
+            index.claim(pair, now)
+        repeat_us = (time.perf_counter() - started) / checks * 1e6
+        results.append((size, fresh_us, repeat_us))
+    return results
+
+
+def close_state_journal():
+    if mail_notifier._state_journal is not None:
+        mail_notifier._state_journal.close()
+        mail_notifier._state_journal = None
+
+
+def build_scenario(args, rng):
+    """
+    Уведомления суда, их копии во втором ящике и повторные уведомления по тем же делам
+
+    Returns:
+        tuple: (папки по логинам, число уникальных уведомлений, копии для второго запуска)
+    """
+    first, second = FakeMailbox(), FakeMailbox()
+    late_copies = []
+    for index in range(args.notices):
+        subject = corpus.COURT_SUBJECT.format(case=corpus.case_number(rng))
+        notice = corpus.build_message(corpus.COURT_SENDER, subject, html=corpus.court_notice_html(rng))
+        first.append(notice)
+        if rng.random() < args.copy_ratio:
+            second.append(notice)
+        if rng.random() < args.resend_ratio:
+            # Суд прислал то же уведомление еще раз отдельным письмом
+            first.append(corpus.build_message(corpus.COURT_SENDER, subject, html=corpus.court_notice_html(rng)))
+        if index % 10 == 0:
+            late_copies.append(notice)
+        first.append(corpus.build_other_message(rng))
+    accounts = {'first@example.test': {'INBOX': first}, 'second@example.test': {'INBOX': second}}
+    return accounts, args.notices, late_copies
+
+
+def run_checks(args, window):
+    """
+    Два запуска check_email подряд с общим состоянием
+
+    Returns:
+        dict: Сообщения в Telegram и загруженные тела писем по запускам
+    """
+    mail_notifier.DEDUP_WINDOW_HOURS = window
+    accounts, unique, late_copies = build_scenario(args, random.Random(args.seed))
+    imap_server = FakeIMAPServer(accounts=accounts).start()
+    telegram_server = FakeTelegramServer().start()
+    host, port = imap_server.address
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(host, port, use_ssl=False)
+    mail_notifier._telegram_client = mail_notifier.TelegramClient(
+        'TOKEN', api_url=telegram_server.api_url, chat_rate=100000,
+    )
+    report = {'unique': unique, 'runs': []}
+    with tempfile.TemporaryDirectory() as state_dir:
+        mail_notifier.STATE_FILE = os.path.join(state_dir, 'email_state.json')
+        mail_notifier.MESSAGE_CACHE_FILE = ''
+        mail_notifier.ACCOUNTS_FILE = os.path.join(state_dir, 'accounts.json')
+        with open(mail_notifier.ACCOUNTS_FILE, 'w', encoding='utf-8') as f:
+            json.dump({'accounts': [
+                {'name': 'first', 'email': 'first@example.test', 'password': 'bench'},
+                {'name': 'second', 'email': 'second@example.test', 'password': 'bench'},
+            ]}, f)
+        for run in range(2):
+            if run == 1:
+                # Новые копии уже отправленных уведомлений приходят после запуска
+                for notice in late_copies:
+                    accounts['second@example.test']['INBOX'].append(notice)
+            # Журнал и индекс перечитываются из файла, как в новом процессе по расписанию
+            close_state_journal()
+            mail_notifier.metrics = mail_notifier.Metrics()
+            sent_before = len(telegram_server.messages)
+            mail_notifier.run_coroutine(mail_notifier.check_email())
+            summary = mail_notifier.metrics.summary()
+            report['runs'].append({
+                'sent': len(telegram_server.messages) - sent_before,
+                'dropped': summary['counters'].get('duplicates_dropped', 0),
+                'bodies': summary['spans'].get('parse', {}).get('count', 0),
+            })
+        report['state_bytes'] = os.path.getsize(mail_notifier.STATE_FILE)
+        with open(mail_notifier.STATE_FILE, encoding='utf-8') as f:
+            report['keys'] = len(json.load(f).get('dedup', {}))
+        close_state_journal()
+    imap_server.stop()
+    telegram_server.stop()
+    mail_notifier._telegram_client.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--notices', type=int, default=200, help='уникальных уведомлений суда')
+    parser.add_argument('--copy-ratio', type=float, default=0.5, help='доля уведомлений с копией во втором ящике')
+    parser.add_argument('--resend-ratio', type=float, default=0.2, help='доля дел с повторным уведомлением')
+    parser.add_argument('--history', default='1000,10000,100000', help='длины истории для замера проверки')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--check', action='store_true', help='код возврата 1, если повтор дошел до Telegram')
+    args = parser.parse_args()
+
+    mail_notifier.logger.setLevel(logging.WARNING)
+    mail_notifier.TELEGRAM_DIGEST_THRESHOLD = 0
+    mail_notifier.TELEGRAM_GLOBAL_RATE = 100000
+    mail_notifier.PROCESSED_FOLDER = ''
+
+    print(f"{'история':>10}{'новое письмо, мкс':>20}{'повтор, мкс':>14}")
+    for size, fresh_us, repeat_us in measure_lookup([int(value) for value in args.history.split(',')]):
+        print(f"{size:>10}{fresh_us:>20.2f}{repeat_us:>14.2f}")
+
+    window = mail_notifier.DEDUP_WINDOW_HOURS or 24
+    with_dedup = run_checks(args, window)
+    without = run_checks(args, 0)
+    print()
+    print(f"Уникальных уведомлений: {with_dedup['unique']}, копии во втором ящике: {args.copy_ratio:.0%}, "
+          f"повторные уведомления: {args.resend_ratio:.0%}")
+    print(f"{'':<16}{'запуск':>8}{'в Telegram':>12}{'отсеяно':>10}{'тел загружено':>15}")
+    for label, report in (('с отсевом', with_dedup), ('без отсева', without)):
+        for number, run in enumerate(report['runs'], 1):
+            print(f"{label:<16}{number:>8}{run['sent']:>12}{run['dropped']:>10}{run['bodies']:>15}")
+    print(f"Ключей в снимке: {with_dedup['keys']}, размер email_state.json: "
+          f"{mail_notifier.format_bytes(with_dedup['state_bytes'])}")
+
+    if args.check:
+        failures = []
+        first, second = with_dedup['runs']
+        if first['sent'] != with_dedup['unique']:
+            failures.append(f"первый запуск отправил {first['sent']} вместо {with_dedup['unique']}")
+        if second['sent']:
+            failures.append(f"второй запуск отправил {second['sent']} повторов")
+        if failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
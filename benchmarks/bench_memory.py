@@ -0,0 +1,221 @@
+"""
+Бенчмарк: пиковая память проверки почты в зависимости от размера писем
+
+Для каждого размера из --sizes строит папку с уведомлениями суда, к которым
+приложены сканы такого размера, и с уведомлениями, у которых в HTML после
+текста встроена картинка такого размера (data: URI, то есть огромная
+текстовая часть). Проверка запускается отдельным процессом против
+фейковых IMAP и Telegram, замеряется его пиковая память (VmHWM). Для
+сравнения тот же процесс загружает каждое письмо целиком (BODY.PEEK[]) и
+разбирает его email.message_from_bytes, как до загрузки по BODYSTRUCTURE.
+
+Отдельный прогон проверяет, что окно загрузки начала части не теряет
+уведомления: HTML со 100 КБ стилей перед текстом и text/plain с кириллицей
+в quoted-printable (в первые 8 КБ помещается меньше RULE_BODY_SCAN_LENGTH
+символов) должны пройти правило с body_regex по тексту за пределами окна.
+
+С --check завершается с кодом 1, если пиковая память превысила --max-rss
+или выросла от самого маленького размера к самому большому больше чем на
+--max-growth, или хотя бы одно уведомление с обрезанной частью потерялось, -
+защита от регрессий.
+
+Пример:
+    python benchmarks/bench_memory.py --sizes 1,10,50 --check
+"""
+import argparse
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeMailbox, FakeTelegramServer
+
+MB = 1024 * 1024
+
+# Обычный запуск main() или прежний способ: письмо целиком и полный разбор MIME
+CHILD = """
+import email, imaplib, json, resource, sys
+def peak_rss():
+    # ru_maxrss переживает fork и exec и может показать память родителя,
+    # VmHWM относится только к адресному пространству этого процесса
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+config = json.loads(sys.argv[1])
+import mail_notifier
+connect = lambda: imaplib.IMAP4(config['host'], config['port'])
+if config['legacy']:
+    mail = connect()
+    mail.login('bench', 'bench')
+    mail.select('INBOX')
+    for uid in mail.uid('SEARCH', 'UNSEEN')[1][0].split():
+        status, data = mail.uid('FETCH', uid, '(BODY.PEEK[])')
+        message = email.message_from_bytes(data[0][1])
+        # Прежний extract_email_body: первая текстовая часть из разобранного письма
+        for part in message.walk():
+            content_type = part.get_content_type()
+            if content_type in ('text/plain', 'text/html') and 'attachment' not in str(part.get('Content-Disposition', '')):
+                body_bytes = part.get_payload(decode=True)
+                if body_bytes:
+                    mail_notifier.decode_body_text(body_bytes, part.get_content_charset(), content_type,
+                                                   mail_notifier.BODY_PREVIEW_LENGTH * 2)
+                    break
+    mail.logout()
+else:
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(
+        config['host'], config['port'], use_ssl=False,
+    )
+    mail_notifier.STATE_FILE = config['state']
+    mail_notifier.MESSAGE_CACHE_FILE = ''
+    mail_notifier.main()
+print(json.dumps({'rss': peak_rss()}))
+"""
+
+
+# Правило, текст для которого в обоих письмах прогона с обрезанной частью лежит за первым окном
+TRUNCATED_RULE = {'name': 'hearings', 'sender_domains': ['arbitr.ru'], 'body_regex': 'заседани'}
+
+
+def child_env(telegram_server, rules_file=''):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'YANDEX_EMAIL': 'bench@example.test',
+        'YANDEX_APP_PASSWORD': 'bench',
+        'TELEGRAM_BOT_TOKEN': 'TOKEN',
+        'TELEGRAM_CHAT_ID': '100500',
+        'TELEGRAM_API_URL': telegram_server.api_url,
+        'TELEGRAM_CHAT_RATE': '1000',
+        'TELEGRAM_DIGEST_THRESHOLD': '0',
+        'ACCOUNTS_FILE': '',
+        'RULES_FILE': rules_file,
+        'PROCESSED_FOLDER': '',
+        # В папке одни и те же письма, каждое должно дойти
+        'DEDUP_WINDOW_HOURS': '0',
+    })
+    return env
+
+
+def build_mailbox(size, count, rng):
+    """
+    Уведомления суда со сканом размера size и с картинкой того же размера внутри HTML
+    """
+    mailbox = FakeMailbox()
+    with_scan = corpus.build_court_notice(rng, attachment_size=size)
+    picture = base64.b64encode(random.Random(size).randbytes(size * 3 // 4)).decode()
+    html = corpus.court_notice_html(rng).replace(
+        '</body>', f'<p><img src="data:image/jpeg;base64,{picture}"></p></body>',
+    )
+    with_picture = corpus.build_message(corpus.COURT_SENDER, corpus.COURT_SUBJECT.format(case=corpus.case_number(rng)),
+                                        html=html)
+    for index in range(count):
+        mailbox.append(with_scan if index % 2 == 0 else with_picture)
+    return mailbox
+
+
+def build_truncated_mailbox(rng):
+    """
+    Уведомления, текст которых не помещается в первое окно загрузки части
+
+    HTML: 100 КБ стилей перед текстом. text/plain: кириллица в quoted-printable
+    (до 9 байт на символ), слово из body_regex после 1800 символов.
+    """
+    mailbox = FakeMailbox()
+    mailbox.append(corpus.build_court_notice(rng, html_padding=100 * 1024))
+    text = 'Уважаемый участник процесса! ' + 'Вам предоставлен доступ к материалам дела. ' * 42
+    text += 'Судебное заседание назначено на 17.11.2025.'
+    mailbox.append(corpus.build_message(corpus.COURT_SENDER, corpus.COURT_SUBJECT.format(case=corpus.case_number(rng)),
+                                        text=text, transfer_encoding='quoted-printable'))
+    return mailbox
+
+
+def measure(mailbox, legacy, rules_file=''):
+    """
+    Один прогон отдельным процессом
+
+    Returns:
+        tuple: (пиковая память в байтах, доставлено уведомлений, из них с текстом письма)
+    """
+    imap_server = FakeIMAPServer({'INBOX': mailbox}).start()
+    telegram_server = FakeTelegramServer().start()
+    host, port = imap_server.address
+    with tempfile.TemporaryDirectory() as state_dir:
+        config = {'host': host, 'port': port, 'legacy': legacy,
+                  'state': os.path.join(state_dir, 'email_state.json')}
+        result = subprocess.run([sys.executable, '-c', CHILD, json.dumps(config)],
+                                capture_output=True, text=True, env=child_env(telegram_server, rules_file))
+    imap_server.stop()
+    telegram_server.stop()
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        sys.exit(f"Прогон завершился с кодом {result.returncode}")
+    rss = json.loads(result.stdout.strip().splitlines()[-1])['rss']
+    with_text = sum(1 for message in telegram_server.messages if 'Уважаемый участник' in message['text'])
+    return rss, len(telegram_server.messages), with_text
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1,10,50', help='размеры сканов и картинок в МБ через запятую')
+    parser.add_argument('--count', type=int, default=4, help='писем в папке')
+    parser.add_argument('--no-legacy', action='store_true', help='не замерять прежний способ')
+    parser.add_argument('--check', action='store_true', help='код возврата 1 при превышении потолка')
+    parser.add_argument('--max-rss', type=float, default=100.0, help='потолок пиковой памяти, МБ')
+    parser.add_argument('--max-growth', type=float, default=10.0, help='допустимый рост памяти, МБ')
+    args = parser.parse_args()
+    sizes = [float(value) for value in args.sizes.split(',')]
+
+    print(f"Писем в папке: {args.count} (сканы во вложении и картинки внутри HTML)")
+    print(f"{'размер':>8}{'память сейчас':>16}{'уведомлений':>13}{'с текстом':>11}{'прежде':>12}")
+    peaks = []
+    for size in sizes:
+        # Прогон помечает письма прочитанными, поэтому каждому - своя папка
+        rss, delivered, with_text = measure(build_mailbox(int(size * MB), args.count, random.Random(size)), legacy=False)
+        legacy = '' if args.no_legacy else mail_notifier.format_bytes(
+            measure(build_mailbox(int(size * MB), args.count, random.Random(size)), legacy=True)[0])
+        peaks.append(rss)
+        print(f"{size:>6.0f} МБ{mail_notifier.format_bytes(rss):>16}{delivered:>13}{with_text:>11}{legacy:>12}")
+        if delivered != args.count or with_text != args.count:
+            sys.exit("Уведомления доставлены не полностью или без текста письма")
+
+    with tempfile.TemporaryDirectory() as rules_dir:
+        rules_file = os.path.join(rules_dir, 'rules.json')
+        with open(rules_file, 'w', encoding='utf-8') as f:
+            json.dump({'rules': [TRUNCATED_RULE]}, f, ensure_ascii=False)
+        _, truncated_delivered, truncated_with_text = measure(build_truncated_mailbox(random.Random(1)),
+                                                              legacy=False, rules_file=rules_file)
+    print(f"Текст за окном загрузки (HTML со стилями, quoted-printable): доставлено {truncated_delivered} из 2, "
+          f"с текстом письма {truncated_with_text}")
+
+    if args.check:
+        failures = []
+        if truncated_delivered != 2 or truncated_with_text != 2:
+            failures.append(f"из писем с текстом за окном загрузки доставлено {truncated_delivered} из 2, "
+                            f"с текстом {truncated_with_text}")
+        if max(peaks) > args.max_rss * MB:
+            failures.append(f"пиковая память {mail_notifier.format_bytes(max(peaks))} > {args.max_rss:.0f} МБ")
+        if peaks[-1] - peaks[0] > args.max_growth * MB:
+            failures.append(f"рост памяти {mail_notifier.format_bytes(peaks[-1] - peaks[0])} > {args.max_growth:.0f} МБ")
+        if failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+"""
+Бенчмарк: очередь отправки уведомлений при недоступном и медленном Telegram
+
+Пять запусков check_email подряд с общим состоянием на фейковом IMAP сервере,
+обработанные письма переносятся в папку PROCESSED_FOLDER:
+
+1. Bot API недоступен (502 на каждый запрос): ни одно уведомление не должно
+   потеряться - уведомления о всех письмах сохранены в очереди в
+   email_state.json, а сами письма остаются непрочитанными во входящих до
+   доставки. Текстов уведомлений (тем и отрывков писем) в файле быть не
+   должно: следующий запуск собирает их заново с сервера.
+2. Bot API снова отвечает, но первые --failures запросов получают 500, и
+   приходят новые уведомления суда: следующий запуск досылает очередь с
+   повторами и отправляет новые, каждое ровно один раз, в порядке UID и с
+   текстом письма, а не заглушкой о недоступном письме.
+3. Bot API отвечает медленно (--telegram-latency): проверка ящика
+   заканчивается, не дожидаясь отправки, время прохода IMAP сравнивается
+   со временем доставки.
+4. Журнал состояния не принимает записи о доставке (диск заполнен): каждое
+   уведомление, которое Telegram уже принял, не должно уйти второй раз ни
+   в этом запуске, ни в следующем (пятый запуск без новых писем).
+
+После пятого запуска все письма суда должны быть прочитаны и перенесены в
+PROCESSED_FOLDER: доставленные письма переносятся при следующей проверке.
+
+С --check завершается с кодом 1, если уведомление потерялось, пришло
+дважды, не в порядке писем или заглушкой вместо текста, текст уведомления
+попал в email_state.json, письмо прочитано или перенесено до доставки
+уведомления или осталось во входящих после нее, или проход IMAP ждал Telegram.
+
+Пример:
+    python benchmarks/bench_outbox.py --notices 20 --check
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeMailbox, FakeTelegramServer
+
+NOTICE_UID_RE = re.compile(r'ID ПИСЬМА: (\d+)')
+LOST_TEXT = 'Текст уведомления не сохранился'
+PROCESSED_FOLDER = 'Court'
+
+
+def close_state_journal():
+    if mail_notifier._state_journal is not None:
+        mail_notifier._state_journal.close()
+        mail_notifier._state_journal = None
+
+
+def run_pass(telegram_server):
+    """
+    Один запуск check_email с журналом, перечитанным из файла, как в новом процессе
+
+    Returns:
+        dict: Время прохода IMAP и всего запуска, UID доставленных уведомлений, счетчики
+    """
+    close_state_journal()
+    mail_notifier.metrics = mail_notifier.Metrics()
+    sent_before = len(telegram_server.messages)
+    finished = []
+    check_account = mail_notifier.check_account
+
+    async def timed_check_account(account, slots=None):
+        await check_account(account, slots)
+        finished.append(time.perf_counter())
+
+    mail_notifier.check_account = timed_check_account
+    started = time.perf_counter()
+    try:
+        mail_notifier.run_coroutine(mail_notifier.check_email())
+    finally:
+        mail_notifier.check_account = check_account
+    elapsed = time.perf_counter() - started
+    counters = mail_notifier.metrics.summary()['counters']
+    return {
+        'imap_seconds': max(finished) - started,
+        'seconds': elapsed,
+        'uids': [int(NOTICE_UID_RE.search(message['text']).group(1))
+                 for message in telegram_server.messages[sent_before:]],
+        'lost': sum(1 for message in telegram_server.messages[sent_before:] if LOST_TEXT in message['text']),
+        'queued': counters.get('notifications_queued', 0),
+        'retries': counters.get('outbox_retries', 0),
+    }
+
+
+def fail_delivery_records():
+    """
+    Записи о доставке и удалении из очереди падают с ENOSPC, остальные пишутся как обычно
+
+    Returns:
+        function: Восстанавливает StateJournal.append
+    """
+    append = mail_notifier.StateJournal.append
+
+    def failing_append(journal, records):
+        if any(record['op'] in ('delivered', 'dropped') for record in records):
+            raise OSError(28, 'No space left on device')
+        return append(journal, records)
+
+    mail_notifier.StateJournal.append = failing_append
+    return lambda: setattr(mail_notifier.StateJournal, 'append', append)
+
+
+def pending_in_snapshot():
+    with open(mail_notifier.STATE_FILE, encoding='utf-8') as f:
+        return sum(len(entry['uids']) for entry in json.load(f).get('outbox', []))
+
+
+def texts_in_snapshot():
+    """Сколько записей очереди в email_state.json хранят текст или тему письма"""
+    with open(mail_notifier.STATE_FILE, encoding='utf-8') as f:
+        outbox = json.load(f).get('outbox', [])
+    return sum(1 for entry in outbox if 'text' in entry or 'материалам дела' in json.dumps(entry, ensure_ascii=False))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--notices', type=int, default=20, help='уведомлений суда в каждом запуске')
+    parser.add_argument('--other', type=int, default=200, help='прочих писем в ящике')
+    parser.add_argument('--failures', type=int, default=3, help='ответов 500 в начале второго запуска')
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help='задержка Bot API в третьем запуске')
+    parser.add_argument('--retry-min', type=float, default=0.1, help='OUTBOX_RETRY_MIN для бенчмарка, секунды')
+    parser.add_argument('--drain', type=float, default=5.0, help='OUTBOX_DRAIN_TIMEOUT, секунды')
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--check', action='store_true', help='код возврата 1 при потере или повторе уведомления')
+    args = parser.parse_args()
+
+    # Ошибки Telegram в первых двух запусках ожидаемы
+    mail_notifier.logger.setLevel(logging.CRITICAL)
+    mail_notifier.TELEGRAM_DIGEST_THRESHOLD = 0
+    mail_notifier.TELEGRAM_GLOBAL_RATE = 100000
+    mail_notifier.PROCESSED_FOLDER = PROCESSED_FOLDER
+    mail_notifier.MESSAGE_CACHE_FILE = ''
+    mail_notifier.OUTBOX_RETRY_MIN = args.retry_min
+    mail_notifier.OUTBOX_DRAIN_TIMEOUT = args.drain
+    mail_notifier.YANDEX_EMAIL = 'outbox@example.test'
+    mail_notifier.YANDEX_APP_PASSWORD = 'bench'
+    mail_notifier.TELEGRAM_CHAT_ID = '1000'
+
+    rng = random.Random(args.seed)
+    mailbox = FakeMailbox()
+    processed = FakeMailbox(PROCESSED_FOLDER)
+    court_uids = []
+
+    def deliver_mail():
+        uids = [mailbox.append(corpus.build_court_notice(rng)) for _ in range(args.notices)]
+        for _ in range(args.other // 3):
+            mailbox.append(corpus.build_other_message(rng))
+        court_uids.extend(uids)
+        return uids
+
+    imap_server = FakeIMAPServer(accounts={
+        'outbox@example.test': {'INBOX': mailbox, PROCESSED_FOLDER: processed},
+    }).start()
+    telegram_server = FakeTelegramServer().start()
+    host, port = imap_server.address
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(host, port, use_ssl=False)
+    mail_notifier._telegram_client = mail_notifier.TelegramClient(
+        'TOKEN', api_url=telegram_server.api_url, chat_rate=100000,
+    )
+
+    runs = []
+    with tempfile.TemporaryDirectory() as state_dir:
+        mail_notifier.STATE_FILE = os.path.join(state_dir, 'email_state.json')
+
+        deliver_mail()
+        telegram_server.down = True
+        first = run_pass(telegram_server)
+        first['pending'] = pending_in_snapshot()
+        first['texts'] = texts_in_snapshot()
+        first['unseen'] = sum(1 for message in mailbox.messages
+                              if message.uid in court_uids and '\\Seen' not in message.flags)
+        first['moved'] = len(processed.messages)
+        runs.append(('Telegram недоступен', first))
+
+        telegram_server.down = False
+        telegram_server.scripted = [(500, {'ok': False, 'description': 'Internal Server Error'})] * args.failures
+        expected_second = list(court_uids) + deliver_mail()
+        second = run_pass(telegram_server)
+        second['pending'] = pending_in_snapshot()
+        runs.append(('Telegram вернулся', second))
+
+        telegram_server.latency = args.telegram_latency
+        expected_third = deliver_mail()
+        third = run_pass(telegram_server)
+        third['pending'] = pending_in_snapshot()
+        runs.append((f"Telegram {args.telegram_latency * 1000:.0f} мс", third))
+
+        telegram_server.latency = 0
+        expected_fourth = deliver_mail()
+        restore_append = fail_delivery_records()
+        try:
+            fourth = run_pass(telegram_server)
+        finally:
+            restore_append()
+        fourth['pending'] = pending_in_snapshot()
+        runs.append(('журнал не пишется', fourth))
+
+        fifth = run_pass(telegram_server)
+        fifth['pending'] = pending_in_snapshot()
+        runs.append(('после сбоя журнала', fifth))
+        left_in_inbox = sum(1 for message in mailbox.messages if message.uid in court_uids)
+        moved_seen = sum(1 for message in processed.messages if '\\Seen' in message.flags)
+        close_state_journal()
+    imap_server.stop()
+    telegram_server.stop()
+
+    print(f"Уведомлений суда в каждом запуске: {args.notices}, прочих писем: {args.other // 3}")
+    print(f"{'':<22}{'в очередь':>10}{'доставлено':>12}{'повторов':>10}{'в очереди':>11}"
+          f"{'проход IMAP, с':>16}{'запуск, с':>11}")
+    for label, run in runs:
+        print(f"{label:<22}{run['queued']:>10}{len(run['uids']):>12}{run['retries']:>10}{run['pending']:>11}"
+              f"{run['imap_seconds']:>16.3f}{run['seconds']:>11.3f}")
+    print(f"Непрочитанных уведомлений суда после первого запуска: {first['unseen']}, "
+          f"перенесено в {PROCESSED_FOLDER}: {first['moved']}, "
+          f"записей очереди с текстом в email_state.json: {first['texts']}")
+    print(f"После пятого запуска: во входящих писем суда {left_in_inbox}, "
+          f"в {PROCESSED_FOLDER} прочитанных {moved_seen} из {len(court_uids)}, "
+          f"заглушек вместо текста {sum(run['lost'] for _, run in runs)}")
+
+    if args.check:
+        failures = []
+        if first['uids'] or first['pending'] != args.notices:
+            failures.append(f"при недоступном Telegram в очереди {first['pending']} из {args.notices}")
+        if first['unseen'] != args.notices or first['moved']:
+            failures.append(f"до доставки уведомлений прочитано {args.notices - first['unseen']} писем, "
+                            f"перенесено {first['moved']}")
+        if first['texts']:
+            failures.append(f"тексты {first['texts']} уведомлений сохранены в email_state.json")
+        for label, run, expected in (('второй', second, expected_second), ('третий', third, expected_third),
+                                     ('четвертый', fourth, expected_fourth), ('пятый', fifth, [])):
+            if run['uids'] != expected or run['pending']:
+                failures.append(f"{label} запуск доставил {len(run['uids'])} из {len(expected)} "
+                                f"(повторов {len(run['uids']) - len(set(run['uids']))}, "
+                                f"порядок {'верный' if run['uids'] == sorted(run['uids']) else 'нарушен'})")
+        lost = sum(run['lost'] for _, run in runs)
+        if lost:
+            failures.append(f"{lost} уведомлений отправлены заглушкой без текста письма")
+        if left_in_inbox or moved_seen != len(court_uids):
+            failures.append(f"после доставки во входящих осталось {left_in_inbox} писем суда, "
+                            f"в {PROCESSED_FOLDER} прочитанных {moved_seen} из {len(court_uids)}")
+        delivery = args.notices * args.telegram_latency
+        if third['imap_seconds'] > delivery / 2:
+            failures.append(f"проход IMAP {third['imap_seconds']:.3f} с ждал отправки ({delivery:.1f} с)")
+        if failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
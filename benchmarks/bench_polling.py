@@ -0,0 +1,163 @@
+"""
+Бенчмарк: адаптивный опрос без IDLE против расписания */5 по записанным моментам прихода писем
+
+Моделирует опрос ящика по моментам прихода уведомлений суда: синтетическим
+(рабочие часы по Москве, пачки писем по одному делу), из текстового файла
+(--arrivals, по строке на момент: unix timestamp или ISO 8601) или из
+заголовков Date подходящих под правила писем mbox/.eml (--fixtures).
+Сравниваются запуск по расписанию каждые 5 минут (и для справки каждую
+минуту) и PollScheduler, который учится по гистограмме прямо во время
+моделирования, начиная с пустой (или с --histogram). Задержка уведомления -
+время от прихода письма до ближайшего опроса после него.
+
+Запуск по расписанию - это каждый раз новое соединение (4 IMAP команды:
+CAPABILITY, LOGIN, STATUS, LOGOUT), опрос демона - одна команда NOOP или
+STATUS на открытом соединении; полные проверки при новой почте одинаковы
+и считаются отдельно.
+
+С --check завершается с кодом 1, если адаптивный опрос не снизил среднюю
+задержку или сделал больше опросов, чем расписание */5.
+
+Пример:
+    python benchmarks/bench_polling.py --weeks 8 --check
+    python benchmarks/bench_polling.py --fixtures ~/export.mbox
+"""
+import argparse
+import email
+import math
+import os
+import statistics
+import sys
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+
+CRON_COMMANDS = 4
+POLL_COMMANDS = 1
+
+
+def percentile(values, share):
+    """Перцентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share / 100 * len(ordered)) - 1)]
+
+
+def load_arrivals(args):
+    """
+    Моменты прихода уведомлений
+
+    Returns:
+        list: Отсортированные unix timestamp
+    """
+    if args.arrivals:
+        arrivals = []
+        with open(os.path.expanduser(args.arrivals), encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    arrivals.append(float(line))
+                except ValueError:
+                    moment = datetime.fromisoformat(line)
+                    if moment.tzinfo is None:
+                        moment = moment.replace(tzinfo=mail_notifier.MOSCOW_TZ)
+                    arrivals.append(moment.timestamp())
+        return sorted(arrivals)
+    if args.fixtures:
+        arrivals = []
+        for message in corpus.load_fixtures(os.path.expanduser(args.fixtures)).messages:
+            headers = email.message_from_bytes(message.raw.split(b'\r\n\r\n', 1)[0])
+            subject = mail_notifier.decode_email_header(headers.get('Subject', ''))
+            if headers.get('Date') and mail_notifier.check_email_criteria(subject, headers.get('From', '')):
+                arrivals.append(parsedate_to_datetime(headers['Date']).timestamp())
+        return sorted(arrivals)
+    return corpus.court_arrivals(weeks=args.weeks, per_day=args.per_day, seed=args.seed)
+
+
+def simulate(arrivals, next_interval, observe=None):
+    """
+    Опросы от полуночи дня первого письма до суток после последнего
+
+    Returns:
+        dict: Число опросов, полных проверок, длительность в сутках и задержки уведомлений
+    """
+    first = datetime.fromtimestamp(arrivals[0], mail_notifier.MOSCOW_TZ)
+    now = first.replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+    end = arrivals[-1] + 86400
+    days = (end - now) / 86400
+    index = 0
+    polls = checks = 0
+    latencies = []
+    while now <= end:
+        polls += 1
+        found = 0
+        while index < len(arrivals) and arrivals[index] <= now:
+            latencies.append(now - arrivals[index])
+            index += 1
+            found += 1
+        if found:
+            checks += 1
+        if observe:
+            observe(now, found)
+        now += next_interval(now)
+    return {'polls': polls, 'checks': checks, 'days': days, 'latencies': latencies}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--weeks', type=int, default=8, help='недель синтетики')
+    parser.add_argument('--per-day', type=float, default=6.0, help='уведомлений в рабочий день в синтетике')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--arrivals', help='файл с моментами прихода, по строке на момент')
+    parser.add_argument('--fixtures', help='mbox файл, .eml файл или папка с .eml')
+    parser.add_argument('--histogram', default='', help='файл гистограммы: начать с нее и сохранить выученное')
+    parser.add_argument('--min-interval', type=float, default=mail_notifier.POLL_INTERVAL_MIN)
+    parser.add_argument('--max-interval', type=float, default=mail_notifier.POLL_INTERVAL_MAX)
+    parser.add_argument('--check', action='store_true', help='код возврата 1, если опрос не лучше расписания')
+    args = parser.parse_args()
+    mail_notifier.logger.setLevel('WARNING')
+
+    arrivals = load_arrivals(args)
+    if not arrivals:
+        sys.exit("Нет ни одного момента прихода письма")
+    scheduler = mail_notifier.PollScheduler(
+        'bench', mail_notifier.ArrivalHistogram(args.histogram),
+        min_interval=args.min_interval, max_interval=args.max_interval,
+    )
+    results = [
+        ('расписание */5', CRON_COMMANDS, simulate(arrivals, lambda now: 300)),
+        ('расписание */1', CRON_COMMANDS, simulate(arrivals, lambda now: 60)),
+        ('адаптивный опрос', POLL_COMMANDS, simulate(arrivals, scheduler.next_interval, scheduler.observe)),
+    ]
+
+    business = sum(1 for moment in arrivals if mail_notifier.is_business_hour(mail_notifier.week_hour(moment)))
+    days = results[0][2]['days']
+    print(f"Уведомлений: {len(arrivals)} за {days:.0f} сут., в рабочие часы: {business / len(arrivals):.0%}")
+    print(f"{'':<18}{'опросов/сут':>12}{'команд/сут':>12}{'проверок':>10}"
+          f"{'средняя, с':>12}{'p50, с':>9}{'p99, с':>9}")
+    for label, commands, result in results:
+        latencies = result['latencies']
+        print(f"{label:<18}{result['polls'] / days:>12.0f}{result['polls'] * commands / days:>12.0f}"
+              f"{result['checks']:>10}{statistics.mean(latencies):>12.0f}"
+              f"{percentile(latencies, 50):>9.0f}{percentile(latencies, 99):>9.0f}")
+
+    if args.check:
+        cron, adaptive = results[0][2], results[2][2]
+        failures = []
+        if statistics.mean(adaptive['latencies']) >= statistics.mean(cron['latencies']):
+            failures.append("средняя задержка не ниже, чем у расписания */5")
+        if adaptive['polls'] > cron['polls']:
+            failures.append(f"опросов {adaptive['polls']} > {cron['polls']}")
+        if failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""
+Бенчмарк: повторяемые прогоны проверки почты против фейковых IMAP и Telegram
+
+Строит синтетическую папку заданного размера и состава или загружает письма
+из mbox файла, .eml файла или папки с .eml (--fixtures) и несколько раз
+прогоняет проверку так, как ее запускает расписание: отдельным процессом
+python, с чистым состоянием и непрочитанной почтой. Сообщает прогоны в
+секунду, p50/p99 задержки уведомления (от запуска процесса до получения
+сообщения заглушкой Telegram), переданные байты, пиковую память процесса и
+время стадий по метрикам mail_notifier.
+
+Пример:
+    python benchmarks/bench_replay.py --messages 10000 --court-ratio 0.02 --attachment-size 500000
+    python benchmarks/bench_replay.py --fixtures ~/export.mbox --runs 3
+"""
+import argparse
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer, FakeTelegramServer
+
+# Код дочернего процесса: обычный запуск main() с подмененным IMAP соединением
+CHILD = """
+import json, resource, sys
+def peak_rss():
+    # ru_maxrss переживает fork и exec и может показать память родителя,
+    # VmHWM относится только к адресному пространству этого процесса
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+config = json.loads(sys.argv[1])
+import mail_notifier
+mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(config['host'], config['port'], use_ssl=False)
+mail_notifier.STATE_FILE = config['state']
+mail_notifier.MESSAGE_CACHE_FILE = config['cache']
+mail_notifier.TELEGRAM_GLOBAL_RATE = config['global_rate']
+mail_notifier.main()
+print(json.dumps({
+    'metrics': mail_notifier.metrics.summary(),
+    'rss': peak_rss(),
+}))
+"""
+
+
+def percentile(values, share):
+    """Перцентиль по ближайшему рангу"""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(share / 100 * len(ordered)) - 1)]
+
+
+def child_env(args, telegram_server):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'YANDEX_EMAIL': 'bench@example.test',
+        'YANDEX_APP_PASSWORD': 'bench',
+        'TELEGRAM_BOT_TOKEN': 'TOKEN',
+        'TELEGRAM_CHAT_ID': '100500',
+        'TELEGRAM_API_URL': telegram_server.api_url,
+        'TELEGRAM_CHAT_RATE': str(args.chat_rate),
+        'TELEGRAM_DIGEST_THRESHOLD': str(args.digest_threshold),
+        'IMAP_SERVER_SEARCH': 'true' if args.server_search else 'false',
+        'LOG_LEVEL': args.log_level,
+        # Прогоны должны начинаться с одной и той же папки
+        'ACCOUNTS_FILE': '',
+        'PROCESSED_FOLDER': '',
+    })
+    return env
+
+
+def build_mailbox(args):
+    if args.fixtures:
+        return corpus.load_fixtures(os.path.expanduser(args.fixtures))
+    return corpus.generate_mailbox(args.messages, court_ratio=args.court_ratio,
+                                   attachment_size=args.attachment_size,
+                                   attachment_ratio=args.attachment_ratio, seen_ratio=args.seen_ratio)
+
+
+def run_once(args, mailbox, initial_flags, imap_server, telegram_server, state_dir, cache_path):
+    """
+    Один прогон проверки в отдельном процессе
+
+    Returns:
+        dict: Время, задержки уведомлений, байты, пиковая память и метрики процесса
+    """
+    for message, flags in zip(mailbox.messages, initial_flags):
+        message.flags = set(flags)
+    state_path = os.path.join(state_dir, 'email_state.json')
+    for path in (state_path, os.path.splitext(state_path)[0] + '.journal'):
+        if os.path.exists(path):
+            os.remove(path)
+    imap_server.reset_stats()
+    telegram_server.reset_stats()
+    host, port = imap_server.address
+    config = {'host': host, 'port': port, 'state': state_path, 'cache': cache_path,
+              'global_rate': args.chat_rate * 30}
+
+    # Заглушка Telegram ставит метку time.time() на каждое сообщение
+    started = time.time()
+    result = subprocess.run([sys.executable, '-c', CHILD, json.dumps(config)],
+                            capture_output=True, text=True, env=child_env(args, telegram_server))
+    elapsed = time.time() - started
+    if result.returncode != 0:
+        print(result.stderr[-2000:])
+        sys.exit(f"Прогон завершился с кодом {result.returncode}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    return {
+        'seconds': elapsed,
+        'latencies': [message['time'] - started for message in telegram_server.messages],
+        'imap_bytes': imap_server.stats.get('bytes_sent', 0) + imap_server.stats.get('bytes_received', 0),
+        'telegram_bytes': telegram_server.stats.get('bytes_sent', 0) + telegram_server.stats.get('bytes_received', 0),
+        'commands': imap_server.stats.get('commands', 0),
+        'rss': report['rss'],
+        'spans': report['metrics']['spans'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--court-ratio', type=float, default=0.02)
+    parser.add_argument('--attachment-size', type=int, default=200000)
+    parser.add_argument('--attachment-ratio', type=float, default=0.3)
+    parser.add_argument('--seen-ratio', type=float, default=0.0)
+    parser.add_argument('--fixtures', help='mbox файл, .eml файл или папка с .eml вместо синтетики')
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--imap-latency', type=float, default=0.0, help='задержка IMAP команды, секунды')
+    parser.add_argument('--telegram-latency', type=float, default=0.0, help='задержка ответа Bot API, секунды')
+    parser.add_argument('--chat-rate', type=float, default=1000.0, help='TELEGRAM_CHAT_RATE прогонов')
+    parser.add_argument('--digest-threshold', type=int, default=0, help='TELEGRAM_DIGEST_THRESHOLD прогонов')
+    parser.add_argument('--server-search', action='store_true', help='IMAP_SERVER_SEARCH=true')
+    parser.add_argument('--cache', action='store_true', help='общий кэш писем для всех прогонов')
+    parser.add_argument('--log-level', default='INFO')
+    args = parser.parse_args()
+
+    mailbox = build_mailbox(args)
+    initial_flags = [set(message.flags) for message in mailbox.messages]
+    imap_server = FakeIMAPServer({'INBOX': mailbox}, latency=args.imap_latency).start()
+    telegram_server = FakeTelegramServer(latency=args.telegram_latency).start()
+
+    runs = []
+    with tempfile.TemporaryDirectory() as state_dir:
+        cache_path = os.path.join(state_dir, 'message_cache.sqlite3') if args.cache else ''
+        for _ in range(args.runs):
+            runs.append(run_once(args, mailbox, initial_flags, imap_server, telegram_server,
+                                 state_dir, cache_path))
+    imap_server.stop()
+    telegram_server.stop()
+
+    source = args.fixtures or (f"синтетика, доля суда {args.court_ratio:.0%}, вложения "
+                               f"{mail_notifier.format_bytes(args.attachment_size)} у {args.attachment_ratio:.0%} писем")
+    seconds = statistics.median(run['seconds'] for run in runs)
+    latencies = [latency for run in runs for latency in run['latencies']]
+    print(f"Папка: {len(mailbox.messages)} писем ({source})")
+    print(f"Прогонов: {len(runs)}, {1 / seconds:.2f} прогона/с (медиана {seconds:.2f} с), "
+          f"IMAP команд за прогон: {runs[-1]['commands']}")
+    if latencies:
+        print(f"Задержка уведомления: p50 {percentile(latencies, 50):.3f} с, p99 {percentile(latencies, 99):.3f} с "
+              f"({len(latencies) // len(runs)} уведомлений за прогон)")
+    else:
+        print("Задержка уведомления: уведомлений не было")
+    print(f"Передано за прогон: IMAP {mail_notifier.format_bytes(statistics.median(run['imap_bytes'] for run in runs))}, "
+          f"Telegram {mail_notifier.format_bytes(statistics.median(run['telegram_bytes'] for run in runs))}")
+    print(f"Пиковая память процесса: {mail_notifier.format_bytes(max(run['rss'] for run in runs))}")
+    stages = sorted({name for run in runs for name in run['spans']})
+    print("Стадии, медиана по прогонам: " + ', '.join(
+        f"{name} {statistics.median(run['spans'].get(name, {}).get('seconds', 0) for run in runs):.3f} с"
+        for name in stages
+    ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""
+Бенчмарк: проверка писем по набору правил фильтрации
+
+Строит набор правил, как у юриста с сотнями дел: у каждого клиента свой чат
+и свои номера дел в теме, плюс правила по адресам обычных отправителей.
+Прогоняет через него заголовки синтетической почты и сравнивает прежний
+способ (цикл по правилам с приведением строк к нижнему регистру и поиском
+подстрок для каждого условия) со скомпилированным RuleSet. Проверяет, что
+оба способа выбирают одни и те же правила.
+
+Пример:
+    python benchmarks/bench_rules.py --rules 10,100,500,2000 --headers 10000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+
+CASES_PER_RULE = 3
+
+
+def build_rules(count, rng):
+    """
+    Правила по номерам дел и по адресам отправителей
+
+    Returns:
+        list: Правила в формате load_rules
+    """
+    rules = []
+    for index in range(count):
+        rule = {
+            'name': f"rule{index}",
+            'senders': [],
+            'sender_domains': [],
+            'sender_keywords': [],
+            'subject_keywords': [],
+            'body_regex': '',
+            'chat_id': str(1000 + index),
+            'template': '',
+        }
+        if index % 10 == 9:
+            # Каждое десятое правило - письма конкретного отправителя с ключевым словом в теме
+            rule['senders'] = [f"client{index}@firm.example"]
+            rule['subject_keywords'] = [rng.choice(corpus.OTHER_SUBJECTS).split()[-1]]
+        else:
+            rule['sender_domains'] = ['arbitr.ru']
+            rule['sender_keywords'] = ['арбитр']
+            rule['subject_keywords'] = [corpus.case_number(rng) for _ in range(CASES_PER_RULE)]
+        rules.append(rule)
+    return rules
+
+
+def build_headers(count, rules, rng):
+    """
+    Пары (тема, отправитель): уведомления суда по делам из правил и чужим делам, обычная почта
+    """
+    cases = [keyword for rule in rules if rule['sender_domains'] for keyword in rule['subject_keywords']]
+    clients = [rule['senders'][0] for rule in rules if rule['senders']]
+    headers = []
+    for _ in range(count):
+        kind = rng.random()
+        if kind < 0.3 and cases:
+            headers.append((corpus.COURT_SUBJECT.format(case=rng.choice(cases)), corpus.COURT_SENDER))
+        elif kind < 0.5:
+            headers.append((corpus.COURT_SUBJECT.format(case=corpus.case_number(rng)), corpus.COURT_SENDER))
+        elif kind < 0.6 and clients:
+            headers.append((rng.choice(corpus.OTHER_SUBJECTS), f'"Клиент" <{rng.choice(clients)}>'))
+        else:
+            headers.append((rng.choice(corpus.OTHER_SUBJECTS), rng.choice(corpus.OTHER_SENDERS)))
+    return headers
+
+
+def legacy_match(rules, subject, sender_raw):
+    """Прежняя проверка, повторенная для каждого правила по очереди"""
+    sender_email = mail_notifier.extract_email_from_sender(sender_raw)
+    for rule in rules:
+        sender_values = rule['senders'] + rule['sender_domains'] + rule['sender_keywords']
+        sender_checks = []
+        for value in sender_values:
+            sender_checks.append(value.lower() in sender_raw.lower())
+            sender_checks.append(value.lower() in sender_email.lower())
+        is_target_sender = any(sender_checks) if sender_values else True
+        is_target_subject = any(
+            keyword.lower() in subject.lower() for keyword in rule['subject_keywords']
+        ) if rule['subject_keywords'] else True
+        if is_target_sender and is_target_subject:
+            return rule
+    return None
+
+
+def measure(match, headers):
+    """Время проверки всех заголовков и выбранные правила"""
+    started = time.perf_counter()
+    result = [match(subject, sender) for subject, sender in headers]
+    return time.perf_counter() - started, [rule['name'] if rule else None for rule in result]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rules', default='10,100,500,2000', help='размеры набора правил через запятую')
+    parser.add_argument('--headers', type=int, default=10000)
+    args = parser.parse_args()
+
+    print(f"Заголовков: {args.headers}")
+    print(f"{'правил':>8}{'сборка, мс':>12}{'прежде, мкс':>13}{'сейчас, мкс':>13}{'ускорение':>11}"
+          f"{'подошло':>9}{'расхождений':>13}")
+    for count in [int(value) for value in args.rules.split(',')]:
+        rng = random.Random(count)
+        rules = build_rules(count, rng)
+        headers = build_headers(args.headers, rules, rng)
+
+        started = time.perf_counter()
+        rule_set = mail_notifier.RuleSet(rules)
+        compile_time = time.perf_counter() - started
+
+        legacy_time, legacy_result = measure(lambda subject, sender: legacy_match(rules, subject, sender), headers)
+        compiled_time, compiled_result = measure(rule_set.match, headers)
+        mismatches = sum(1 for old, new in zip(legacy_result, compiled_result) if old != new)
+        matched = sum(1 for name in compiled_result if name)
+        print(f"{count:>8}{compile_time * 1000:>12.1f}{legacy_time * 1e6 / args.headers:>13.1f}"
+              f"{compiled_time * 1e6 / args.headers:>13.1f}{legacy_time / compiled_time:>10.1f}x"
+              f"{matched:>9}{mismatches:>13}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+"""
+Бенчмарк: очистка текста для Telegram до и после предкомпиляции и ранней обрезки
+
+Прогоняет через старую и новую реализацию корпус HTML-уведомлений суда вместе
+с темами и отправителями: тело письма очищается от разметки, затем тема,
+отправитель и отрывок тела готовятся к отправке, как в format_notification.
+Отдельно сравнивает извлечение отрывка из HTML разного размера регулярными
+выражениями по всему документу и потоковым разбором (время и пик памяти).
+
+Пример:
+    python benchmarks/bench_sanitize.py --notices 2000 --html-padding 4000
+"""
+import argparse
+import os
+import quopri
+import random
+import re
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+
+
+def legacy_extract_plain_text_from_html(html_text):
+    """Прежняя реализация: восемь проходов re.sub без компиляции"""
+    clean_text = re.sub(r'<[^>]+>', '', html_text)
+    clean_text = re.sub(r'\s+', ' ', clean_text)
+    clean_text = re.sub(r'&nbsp;', ' ', clean_text)
+    clean_text = re.sub(r'&amp;', '&', clean_text)
+    clean_text = re.sub(r'&lt;', '<', clean_text)
+    clean_text = re.sub(r'&gt;', '>', clean_text)
+    clean_text = re.sub(r'&quot;', '"', clean_text)
+    return clean_text.strip()
+
+
+def legacy_clean_telegram_text(text):
+    """Прежняя реализация: quopri, HTML и 18 последовательных str.replace"""
+    if not text:
+        return ""
+    cleaned_text = quopri.decodestring(text.encode('utf-8')).decode('utf-8', errors='ignore')
+    if '<' in cleaned_text and '>' in cleaned_text:
+        cleaned_text = legacy_extract_plain_text_from_html(cleaned_text)
+    replacements = {
+        '*': '•', '_': '—', '`': "'", '[': '(', ']': ')', '~': '≈', '#': '№', '=': '═', '|': '│',
+        '{': '❴', '}': '❵', '>': '›', '<': '‹', '?': '？', '&': 'и', ';': ',', ':': 'ː', '!': '❗',
+    }
+    for old, new in replacements.items():
+        cleaned_text = cleaned_text.replace(old, new)
+    cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
+    return cleaned_text.strip()
+
+
+def legacy_prepare(subject, sender, html_body):
+    """Подготовка уведомления до изменений"""
+    body = legacy_extract_plain_text_from_html(html_body)
+    body_clean = legacy_clean_telegram_text(body)
+    if len(body_clean) > 150:
+        body_clean = body_clean[:147] + "..."
+    return legacy_clean_telegram_text(subject), legacy_clean_telegram_text(sender), body_clean
+
+
+def compiled_prepare(subject, sender, html_body):
+    """Подготовка уведомления текущей реализацией"""
+    body = mail_notifier.extract_plain_text_from_html(html_body)
+    body_clean = mail_notifier.clean_telegram_text(body, max_length=mail_notifier.BODY_PREVIEW_LENGTH)
+    if len(body_clean) > mail_notifier.BODY_PREVIEW_LENGTH:
+        body_clean = body_clean[:mail_notifier.BODY_PREVIEW_LENGTH - 3] + "..."
+    return mail_notifier.clean_telegram_text(subject), mail_notifier.clean_telegram_text(sender), body_clean
+
+
+def build_corpus(count, html_padding, seed=42):
+    """Темы, отправители и HTML тела уведомлений суда"""
+    rng = random.Random(seed)
+    return [
+        (
+            corpus.COURT_SUBJECT.format(case=corpus.case_number(rng)),
+            corpus.COURT_SENDER,
+            corpus.court_notice_html(rng, rng.randint(0, html_padding)),
+        )
+        for _ in range(count)
+    ]
+
+
+def measure(prepare, notices, repeat):
+    """Лучшее время из нескольких прогонов по всему корпусу"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for subject, sender, html_body in notices:
+            prepare(subject, sender, html_body)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def measure_extraction(extract, html_bytes, repeat):
+    """Лучшее время и пик памяти извлечения текста из одного документа"""
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        extract(html_bytes)
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    extract(html_bytes)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def bench_extraction(sizes, repeat):
+    """Извлечение отрывка из HTML части: весь документ против потокового разбора"""
+    rng = random.Random(7)
+    preview_length = mail_notifier.BODY_PREVIEW_LENGTH * 2
+    print(f"{'HTML':>10}{'regex, мс':>12}{'пик':>12}{'поток, мс':>12}{'пик':>12}")
+    for size in sizes:
+        html_bytes = corpus.court_notice_html(rng, size).encode('utf-8')
+        regex_time, regex_peak = measure_extraction(
+            lambda data: legacy_extract_plain_text_from_html(data.decode('utf-8', errors='ignore')),
+            html_bytes, repeat,
+        )
+        stream_time, stream_peak = measure_extraction(
+            lambda data: mail_notifier.extract_html_preview(data, preview_length), html_bytes, repeat,
+        )
+        print(f"{mail_notifier.format_bytes(len(html_bytes)):>10}{regex_time * 1000:>12.2f}"
+              f"{mail_notifier.format_bytes(regex_peak):>12}{stream_time * 1000:>12.2f}"
+              f"{mail_notifier.format_bytes(stream_peak):>12}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--notices', type=int, default=2000)
+    parser.add_argument('--html-padding', type=int, default=4000, help='максимальный объем инлайн-стилей, байт')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--body-sizes', default='1000,100000,1000000', help='размеры HTML для извлечения, байт')
+    args = parser.parse_args()
+
+    notices = build_corpus(args.notices, args.html_padding)
+    legacy_time = measure(legacy_prepare, notices, args.repeat)
+    compiled_time = measure(compiled_prepare, notices, args.repeat)
+
+    subject, sender, html_body = notices[0]
+    print(f"Уведомлений: {args.notices}, средний размер HTML "
+          f"{mail_notifier.format_bytes(sum(len(n[2]) for n in notices) / len(notices))}")
+    print(f"Прежняя очистка: {legacy_time:.3f} с, {args.notices / legacy_time:,.0f} уведомлений/с")
+    print(f"Текущая очистка: {compiled_time:.3f} с, {args.notices / compiled_time:,.0f} уведомлений/с")
+    print(f"Ускорение: x{legacy_time / compiled_time:.2f}")
+    print(f"Было:  {legacy_prepare(subject, sender, html_body)[2]}")
+    print(f"Стало: {compiled_prepare(subject, sender, html_body)[2]}")
+    print()
+    bench_extraction([int(size) for size in args.body_sizes.split(',')], args.repeat)
+
+
+if __name__ == '__main__':
+    main()
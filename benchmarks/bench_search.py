@@ -0,0 +1,92 @@
+"""
+Бенчмарк: фильтрация на клиенте против поиска на стороне сервера
+
+Запускает check_email против локального фейкового IMAP сервера с синтетическим
+ящиком и сравнивает число команд (round trips), объем трафика и время.
+
+Пример:
+    python benchmarks/bench_search.py --messages 10000 --latency 0.005
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import corpus
+import mail_notifier
+from fake_servers import FakeIMAPServer
+
+
+def run_mode(server_search, args):
+    """Один прогон check_email на свежем ящике"""
+    mailbox = corpus.generate_mailbox(
+        args.messages, court_ratio=args.court_ratio,
+        attachment_size=args.attachment_size, seen_ratio=args.seen_ratio,
+    )
+    server = FakeIMAPServer({'INBOX': mailbox}, latency=args.latency).start()
+    host, port = server.address
+    sent = []
+
+    mail_notifier.IMAP_SERVER_SEARCH = server_search
+    mail_notifier.YANDEX_EMAIL = 'bench@example.test'
+    mail_notifier.YANDEX_APP_PASSWORD = 'bench'
+    mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(host, port, use_ssl=False)
+    mail_notifier.TELEGRAM_DIGEST_THRESHOLD = 0
+
+    class TelegramStub:
+        async def try_send_message(self, chat_id, text):
+            sent.append(text)
+            return {'message_id': len(sent)}, False
+
+        def close(self):
+            pass
+
+    mail_notifier._telegram_client = TelegramStub()
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        mail_notifier.STATE_FILE = os.path.join(state_dir, 'email_state.json')
+        mail_notifier.MESSAGE_CACHE_FILE = os.path.join(state_dir, 'message_cache.sqlite3')
+        mail_notifier._message_cache = None
+        started = time.perf_counter()
+        mail_notifier.run_coroutine(mail_notifier.check_email())
+        elapsed = time.perf_counter() - started
+
+    server.stop()
+    stats = server.stats
+    return {
+        'mode': 'server' if server_search else 'client',
+        'notifications': len(sent),
+        'commands': stats.get('commands', 0),
+        'bytes_in': stats.get('bytes_sent', 0),
+        'bytes_out': stats.get('bytes_received', 0),
+        'seconds': elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000)
+    parser.add_argument('--court-ratio', type=float, default=0.02)
+    parser.add_argument('--attachment-size', type=int, default=0)
+    parser.add_argument('--seen-ratio', type=float, default=0.0)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка на команду, секунды')
+    args = parser.parse_args()
+
+    mail_notifier.logger.setLevel(logging.WARNING)
+    results = [run_mode(False, args), run_mode(True, args)]
+
+    print(f"Писем в ящике: {args.messages}, доля уведомлений суда: {args.court_ratio:.0%}, "
+          f"задержка: {args.latency * 1000:.1f} мс")
+    print(f"{'режим':<8}{'уведомл.':>10}{'команд':>9}{'получено':>14}{'отправлено':>14}{'время, с':>11}")
+    for result in results:
+        print(f"{result['mode']:<8}{result['notifications']:>10}{result['commands']:>9}"
+              f"{mail_notifier.format_bytes(result['bytes_in']):>14}"
+              f"{mail_notifier.format_bytes(result['bytes_out']):>14}{result['seconds']:>11.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""
+Бенчмарк: стоимость запуска по расписанию, когда новых писем нет
+
+1. Время импорта mail_notifier по `python -X importtime` (медиана из
+   нескольких запусков) и самые тяжелые модули, которые он тянет.
+2. Полный запуск main() в отдельном процессе против фейкового IMAP сервера,
+   когда состояние уже актуально: время, число IMAP команд и загруженные
+   тяжелые модули. Для сравнения тот же запуск с заранее импортированными
+   sqlite3 и email.parser (как было до ленивых импортов).
+
+С --check завершается с кодом 1, если импорт дольше --max-import-ms или
+запуск без работы загрузил тяжелый модуль, - защита от регрессий.
+
+Пример:
+    python benchmarks/bench_startup.py --runs 5 --check
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import corpus
+from fake_servers import FakeIMAPServer
+
+# concurrent.futures и ssl сюда не входят: их импортирует сам asyncio, без
+# которого не работает ни IMAP, ни Telegram, и отложить их нельзя
+HEAVY_MODULES = ('sqlite3', 'email.parser', 'imaplib')
+
+# Код дочернего процесса: минимум импортов, чтобы не исказить sys.modules
+CHILD = """
+import json, sys, time
+config = json.loads(sys.argv[1])
+started = time.perf_counter()
+for name in config['preload']:
+    __import__(name)
+import mail_notifier
+imported = time.perf_counter()
+mail_notifier.open_imap_connection = lambda: mail_notifier.AsyncIMAPClient.open(config['host'], config['port'], use_ssl=False)
+mail_notifier.STATE_FILE = config['state']
+mail_notifier.MESSAGE_CACHE_FILE = config['cache']
+mail_notifier.main()
+finished = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'run': finished - imported,
+    'heavy': [name for name in config['heavy'] if name in sys.modules],
+}))
+"""
+
+
+def child_env():
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT,
+        'YANDEX_EMAIL': 'bench@example.test',
+        'YANDEX_APP_PASSWORD': 'bench',
+        'TELEGRAM_BOT_TOKEN': 'TOKEN',
+        'TELEGRAM_CHAT_ID': '100500',
+    })
+    return env
+
+
+def parse_importtime(stderr):
+    """
+    Разбирает вывод -X importtime
+
+    Returns:
+        tuple: (время импорта mail_notifier в мкс, [(модуль, мкс)] его прямых зависимостей)
+    """
+    children = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0:
+            if name.strip() == 'mail_notifier':
+                return int(cumulative), sorted(children, key=lambda item: -item[1])
+            children = []
+        elif depth == 1:
+            children.append((name.strip(), int(cumulative)))
+    return 0, []
+
+
+def measure_import(runs):
+    totals = []
+    children = []
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import mail_notifier'],
+            capture_output=True, text=True, env=child_env(), check=True,
+        )
+        total, children = parse_importtime(result.stderr)
+        totals.append(total)
+    return statistics.median(totals) / 1000, children
+
+
+def measure_idle_run(server, state_dir, preload, runs):
+    """Запуск main() без новых писем в отдельном процессе"""
+    host, port = server.address
+    config = {
+        'host': host, 'port': port, 'preload': list(preload), 'heavy': list(HEAVY_MODULES),
+        'state': os.path.join(state_dir, 'email_state.json'),
+        'cache': os.path.join(state_dir, 'message_cache.sqlite3'),
+    }
+    walls = []
+    for _ in range(runs):
+        server.reset_stats()
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, '-c', CHILD, json.dumps(config)],
+            capture_output=True, text=True, env=child_env(), check=True,
+        )
+        walls.append(time.perf_counter() - started)
+        report = json.loads(result.stdout.strip().splitlines()[-1])
+    report['wall'] = statistics.median(walls)
+    report['commands'] = server.stats.get('commands', 0)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--messages', type=int, default=200)
+    parser.add_argument('--check', action='store_true', help='код возврата 1 при регрессии')
+    parser.add_argument('--max-import-ms', type=float, default=150.0)
+    args = parser.parse_args()
+
+    import_ms, children = measure_import(args.runs)
+    print(f"Импорт mail_notifier: {import_ms:.1f} мс (медиана из {args.runs})")
+    for name, microseconds in children[:5]:
+        print(f"    {name:<24}{microseconds / 1000:>8.1f} мс")
+
+    mailbox = corpus.generate_mailbox(args.messages, court_ratio=0.1, seen_ratio=1.0)
+    server = FakeIMAPServer({'INBOX': mailbox}).start()
+    with tempfile.TemporaryDirectory() as state_dir:
+        # Состояние уже догнало ящик: типичный запуск по расписанию без новой почты
+        with open(os.path.join(state_dir, 'email_state.json'), 'w', encoding='utf-8') as f:
+            json.dump({'mailboxes': {'INBOX': {'uidvalidity': mailbox.uidvalidity,
+                                                'last_uid': mailbox.next_uid - 1}}}, f)
+        lazy = measure_idle_run(server, state_dir, (), args.runs)
+        eager = measure_idle_run(server, state_dir, HEAVY_MODULES, args.runs)
+    server.stop()
+
+    print()
+    print(f"{'запуск без писем':<22}{'импорт, мс':>12}{'main, мс':>10}{'процесс, мс':>13}{'IMAP команд':>13}")
+    for label, report in (('ленивые импорты', lazy), ('все импорты сразу', eager)):
+        print(f"{label:<22}{report['import'] * 1000:>12.1f}{report['run'] * 1000:>10.1f}"
+              f"{report['wall'] * 1000:>13.1f}{report['commands']:>13}")
+    print(f"Тяжелые модули в запуске без писем: {', '.join(lazy['heavy']) or 'нет'}")
+
+    if args.check:
+        failures = []
+        if import_ms > args.max_import_ms:
+            failures.append(f"импорт {import_ms:.1f} мс > {args.max_import_ms:.0f} мс")
+        if lazy['heavy']:
+            failures.append(f"загружены {', '.join(lazy['heavy'])}")
+        if failures:
+            print(f"РЕГРЕССИЯ: {'; '.join(failures)}")
+            sys.exit(1)
+        print("Проверка пройдена")
+
+
+if __name__ == '__main__':
+    main()
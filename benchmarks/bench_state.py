@@ -0,0 +1,112 @@
+"""
+Бенчмарк: фиксация состояния после каждого письма
+
+Сравнивает стоимость одной фиксации (сдвиг границы UID или запись о
+доставке) тремя способами: прежняя перезапись email_state.json целиком
+без fsync, такая же перезапись, но надежная (временный файл, fsync,
+os.replace), и запись строки в журнал StateJournal с fsync. Размер
+состояния задается числом папок. Отдельно замеряет загрузку при старте со
+снимком и полным журналом и восстановление после оборванной записи.
+
+Пример:
+    python benchmarks/bench_state.py --mailboxes 50 --commits 500
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail_notifier
+
+
+def legacy_commit(path, mailboxes, mailbox, last_uid, durable):
+    """Прежний способ: чтение и перезапись всего файла состояния"""
+    with open(path, 'r', encoding='utf-8') as f:
+        state = json.load(f)
+    state['mailboxes'][mailbox] = {'uidvalidity': 1, 'last_uid': last_uid}
+    target = path + '.tmp' if durable else path
+    with open(target, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=2)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+    if durable:
+        os.replace(target, path)
+        mail_notifier.fsync_directory(path)
+
+
+def measure_legacy(state_dir, args, durable):
+    path = os.path.join(state_dir, f"legacy_{int(durable)}.json")
+    mailboxes = {f"box{index}/INBOX": {'uidvalidity': 1, 'last_uid': 0} for index in range(args.mailboxes)}
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump({'mailboxes': mailboxes}, f)
+    started = time.perf_counter()
+    for uid in range(1, args.commits + 1):
+        legacy_commit(path, mailboxes, f"box{uid % args.mailboxes}/INBOX", uid, durable)
+    return (time.perf_counter() - started) / args.commits
+
+
+def measure_journal(state_dir, args):
+    mail_notifier.STATE_JOURNAL_MAX_RECORDS = args.commits * 2 + 1
+    journal = mail_notifier.StateJournal(os.path.join(state_dir, 'journal.json'))
+    for index in range(args.mailboxes):
+        journal.append([{'op': 'state', 'mailbox': f"box{index}/INBOX", 'uidvalidity': 1, 'last_uid': 0}])
+    journal.compact()
+    started = time.perf_counter()
+    for uid in range(1, args.commits + 1):
+        mailbox = f"box{uid % args.mailboxes}/INBOX"
+        journal.append([{'op': 'delivered', 'mailbox': mailbox, 'uidvalidity': 1, 'uid': uid,
+                         'message_id': uid, 'chat_id': '100500', 'time': '2025-10-01T10:00:00'}])
+        journal.append([{'op': 'state', 'mailbox': mailbox, 'uidvalidity': 1, 'last_uid': uid}])
+    elapsed = (time.perf_counter() - started) / (args.commits * 2)
+    journal.close()
+    return elapsed, journal
+
+
+def measure_load(journal):
+    """Загрузка снимка с полным журналом, затем с оборванной последней строкой"""
+    started = time.perf_counter()
+    loaded = mail_notifier.StateJournal(journal.path)
+    load_time = time.perf_counter() - started
+    same = loaded.mailboxes == journal.mailboxes
+    loaded.close()
+
+    with open(journal.journal_path, 'ab') as f:
+        f.write(b'{"op": "state", "mailbox": "box0/INBOX", "uidva')
+    recovered = mail_notifier.StateJournal(journal.path)
+    intact = recovered.mailboxes == journal.mailboxes
+    recovered.close()
+    return load_time, same, intact
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mailboxes', type=int, default=50, help='папок в файле состояния')
+    parser.add_argument('--commits', type=int, default=500)
+    args = parser.parse_args()
+    mail_notifier.logger.setLevel(logging.WARNING)
+
+    # Рядом с местом запуска, а не в /tmp: там часто tmpfs, где fsync ничего не стоит
+    with tempfile.TemporaryDirectory(dir='.') as state_dir:
+        legacy = measure_legacy(state_dir, args, durable=False)
+        legacy_durable = measure_legacy(state_dir, args, durable=True)
+        journal_time, journal = measure_journal(state_dir, args)
+        journal_size = os.path.getsize(journal.journal_path)
+        load_time, same, intact = measure_load(journal)
+
+    print(f"Папок: {args.mailboxes}, фиксаций: {args.commits}")
+    print(f"Перезапись файла без fsync:      {legacy * 1000:.3f} мс на фиксацию (при сбое файл может обрезаться)")
+    print(f"Перезапись файла с fsync:        {legacy_durable * 1000:.3f} мс на фиксацию")
+    print(f"Строка журнала с fsync:          {journal_time * 1000:.3f} мс на запись")
+    print(f"Загрузка снимка и журнала ({args.commits * 2} записей, "
+          f"{mail_notifier.format_bytes(journal_size)}): {load_time * 1000:.1f} мс, совпадает: {same}")
+    print(f"Оборванная последняя строка отброшена, состояние цело: {intact}")
+
+
+if __name__ == '__main__':
+    main()
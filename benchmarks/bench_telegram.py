@@ -0,0 +1,144 @@
+"""
+Бенчмарк: отдельный HTTP запрос на каждое сообщение против пула TelegramClient
+
+Отправляет пачку сообщений в локальную заглушку Bot API и сравнивает число
+открытых соединений и время, затем рассылает те же сообщения по --chats
+чатам одновременно из одного цикла событий. Дополнительно проверяет
+обработку 429 с retry_after и сворачивание всплеска в дайджест.
+
+Пример:
+    python benchmarks/bench_telegram.py --messages 30
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail_notifier
+from fake_servers import FakeTelegramServer
+
+CHAT_ID = '100500'
+
+
+def bench_bare_post(count):
+    """Поведение до пула: новое соединение на каждое сообщение"""
+    server = FakeTelegramServer().start()
+    url = f"{server.api_url}/botTOKEN/sendMessage"
+    started = time.perf_counter()
+    for index in range(count):
+        body = json.dumps({'chat_id': CHAT_ID, 'text': f"Сообщение {index}"}).encode('utf-8')
+        request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+    elapsed = time.perf_counter() - started
+    server.stop()
+    return server.stats.get('connections', 0), elapsed
+
+
+def bench_client(count):
+    """Один TelegramClient с постоянным соединением"""
+    server = FakeTelegramServer().start()
+    client = mail_notifier.TelegramClient('TOKEN', api_url=server.api_url, chat_rate=10000)
+
+    async def send_all():
+        for index in range(count):
+            await client.send_message(CHAT_ID, f"Сообщение {index}")
+
+    started = time.perf_counter()
+    mail_notifier.run_coroutine(send_all())
+    elapsed = time.perf_counter() - started
+    client.close()
+    server.stop()
+    return server.stats.get('connections', 0), elapsed
+
+
+def bench_chats(count, chats, latency):
+    """Сообщения в разные чаты одновременно: ожидание ответов не занимает потоки"""
+    server = FakeTelegramServer(latency=latency).start()
+    client = mail_notifier.TelegramClient('TOKEN', api_url=server.api_url, chat_rate=10000)
+
+    async def send_all():
+        await asyncio.gather(*(
+            client.send_message(str(index % chats), f"Сообщение {index}") for index in range(count)
+        ))
+
+    started = time.perf_counter()
+    mail_notifier.run_coroutine(send_all())
+    elapsed = time.perf_counter() - started
+    client.close()
+    server.stop()
+    return server.stats.get('connections', 0), elapsed, threading.active_count()
+
+
+def check_rate_limit():
+    """Ответ 429 должен приводить к ожиданию retry_after и повтору"""
+    server = FakeTelegramServer(scripted=[
+        (429, {'ok': False, 'error_code': 429, 'parameters': {'retry_after': 1}}),
+    ]).start()
+    client = mail_notifier.TelegramClient('TOKEN', api_url=server.api_url)
+    started = time.perf_counter()
+    result = mail_notifier.run_coroutine(client.send_message(CHAT_ID, 'Проверка лимита'))
+    elapsed = time.perf_counter() - started
+    client.close()
+    server.stop()
+    return result is not None, client.retries, elapsed
+
+
+def check_digest(count):
+    """Всплеск больше порога уходит одним сообщением"""
+    server = FakeTelegramServer().start()
+    mail_notifier.TELEGRAM_CHAT_ID = CHAT_ID
+    mail_notifier._telegram_client = mail_notifier.TelegramClient('TOKEN', api_url=server.api_url)
+    notices = [
+        {'uid': str(index), 'subject': f"Предоставлен доступ к материалам дела № А40-{index}/2025",
+         'sender': 'Арбитражный суд', 'body': 'Текст'}
+        for index in range(count)
+    ]
+
+    async def send_digest():
+        delivered = []
+        for text, included in mail_notifier.format_digest_messages(notices):
+            if await mail_notifier._telegram_client.send_message(CHAT_ID, text) is not None:
+                delivered += included
+        return delivered
+
+    delivered = mail_notifier.run_coroutine(send_digest())
+    mail_notifier._telegram_client.close()
+    server.stop()
+    return len(delivered), len(server.messages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=30)
+    parser.add_argument('--chats', type=int, default=20, help='чатов при одновременной рассылке')
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа Bot API при рассылке, секунды')
+    args = parser.parse_args()
+    mail_notifier.logger.setLevel(logging.WARNING)
+
+    bare_connections, bare_time = bench_bare_post(args.messages)
+    pooled_connections, pooled_time = bench_client(args.messages)
+    print(f"Сообщений: {args.messages}")
+    print(f"Без пула:       соединений {bare_connections:>4}, время {bare_time:.3f} с")
+    print(f"TelegramClient: соединений {pooled_connections:>4}, время {pooled_time:.3f} с")
+
+    connections, elapsed, threads = bench_chats(args.messages, args.chats, args.latency)
+    print(f"{args.chats} чатов одновременно (ответ через {args.latency * 1000:.0f} мс): "
+          f"соединений {connections}, время {elapsed:.3f} с, потоков {threads}")
+
+    delivered, retries, elapsed = check_rate_limit()
+    print(f"429 retry_after=1: доставлено={delivered}, повторов={retries}, ожидание {elapsed:.2f} с")
+
+    delivered, sent = check_digest(args.messages)
+    print(f"Дайджест: уведомлений {delivered}, сообщений в Telegram {sent}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Генератор синтетических писем для бенчмарков: уведомления суда и обычная почта
+
+Вместо синтетики в фейковую папку можно загрузить настоящие письма из mbox
+файла, .eml файла или папки с .eml файлами (load_fixtures).
+"""
+import mailbox as mailbox_files
+import os
+import random
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from email.policy import SMTP
+from email.utils import format_datetime, make_msgid
+
+from fake_servers import FakeMailbox
+
+COURT_SENDER = '"Арбитражный суд" <guard@arbitr.ru>'
+COURT_SUBJECT = 'Предоставлен доступ к материалам дела № {case}'
+OTHER_SENDERS = (
+    '"Интернет-магазин" <noreply@shop.example>',
+    '"Коллега" <colleague@firm.example>',
+    'newsletter@news.example',
+    '"Банк" <info@bank.example>',
+)
+OTHER_SUBJECTS = (
+    'Ваш заказ отправлен',
+    'Re: договор поставки',
+    'Еженедельная рассылка',
+    'Выписка по счету',
+)
+
+COURT_HTML = """<html><head><style type="text/css">
+body {{ font-family: Arial, sans-serif; }} td {{ padding: 4px; }} .footer {{ color: #888; }}
+{padding}
+</style><script>var tracking = "{case}";</script></head>
+<body><table width="100%"><tr><td>
+<p>Уважаемый участник процесса!</p>
+<p>Вам предоставлен доступ к материалам дела &laquo;{case}&raquo; в системе
+&quot;Мой Арбитр&quot;. Дело рассматривается Арбитражным судом г.&nbsp;Москвы.</p>
+<p>Судья: Иванов&nbsp;И.&nbsp;И. &mdash; дата заседания {date}.</p>
+<p>Ознакомиться с материалами можно по ссылке: <a href="https://kad.arbitr.ru/Card?id={case}">kad.arbitr.ru</a></p>
+</td></tr></table><div class="footer">Это письмо сформировано автоматически &amp; не требует ответа.</div>
+</body></html>"""
+
+
+def case_number(rng):
+    """Номер дела вида А40-12345/2025"""
+    return f"А{rng.randint(10, 83)}-{rng.randint(1000, 299999)}/{rng.choice((2024, 2025))}"
+
+
+def court_notice_html(rng, padding_size=0):
+    """HTML-тело уведомления суда, при необходимости раздутое инлайн-стилями"""
+    padding = ''.join(f".c{i} {{ margin: {i % 7}px; color: #{i % 4096:03x}; }}\n" for i in range(padding_size // 40))
+    return COURT_HTML.format(
+        case=case_number(rng),
+        date=(datetime(2025, 10, 1) + timedelta(days=rng.randint(0, 60))).strftime('%d.%m.%Y'),
+        padding=padding,
+    )
+
+
+def build_message(sender, subject, text=None, html=None, attachment_size=0, date=None, charset='utf-8',
+                  transfer_encoding=None):
+    """
+    Собирает письмо с текстовой и/или HTML частью и необязательным вложением
+
+    Args:
+        transfer_encoding (str): Content-Transfer-Encoding текстовых частей (по умолчанию выбирает email)
+
+    Returns:
+        bytes: Письмо в формате RFC 822 с переводами строк CRLF
+    """
+    message = EmailMessage(policy=SMTP)
+    message['From'] = sender
+    message['To'] = 'lawyer@firm.example'
+    message['Subject'] = subject
+    message['Date'] = format_datetime(date or datetime.now(timezone.utc))
+    message['Message-ID'] = make_msgid(domain='example.test')
+
+    if text is not None:
+        message.set_content(text, charset=charset, cte=transfer_encoding)
+        if html is not None:
+            message.add_alternative(html, subtype='html', charset=charset, cte=transfer_encoding)
+    elif html is not None:
+        message.set_content(html, subtype='html', charset=charset, cte=transfer_encoding)
+    else:
+        message.set_content('', charset=charset, cte=transfer_encoding)
+
+    if attachment_size:
+        message.add_attachment(
+            random.Random(attachment_size).randbytes(attachment_size),
+            maintype='application', subtype='pdf', filename='Определение.pdf',
+        )
+    return message.as_bytes()
+
+
+def build_court_notice(rng, attachment_size=0, html_padding=0, date=None):
+    """Уведомление от арбитражного суда (только HTML, как в реальной почте)"""
+    case = case_number(rng)
+    return build_message(
+        COURT_SENDER, COURT_SUBJECT.format(case=case),
+        html=court_notice_html(rng, html_padding), attachment_size=attachment_size, date=date,
+    )
+
+
+def build_other_message(rng, attachment_size=0, date=None):
+    """Обычное письмо, не относящееся к суду"""
+    return build_message(
+        rng.choice(OTHER_SENDERS), rng.choice(OTHER_SUBJECTS),
+        text='Добрый день!\n\n' + 'Текст обычного письма. ' * rng.randint(5, 50),
+        attachment_size=attachment_size, date=date,
+    )
+
+
+def generate_mailbox(count, court_ratio=0.02, attachment_size=0, attachment_ratio=0.3,
+                     seen_ratio=0.0, seed=42, mailbox=None):
+    """
+    Заполняет фейковую папку синтетической почтой
+
+    Args:
+        count (int): Количество писем
+        court_ratio (float): Доля уведомлений суда
+        attachment_size (int): Размер вложения в байтах
+        attachment_ratio (float): Доля писем с вложением
+        seen_ratio (float): Доля уже прочитанных писем
+        seed (int): Зерно генератора для воспроизводимости
+
+    Returns:
+        FakeMailbox: Заполненная папка
+    """
+    rng = random.Random(seed)
+    mailbox = mailbox or FakeMailbox()
+    start = datetime.now(timezone.utc) - timedelta(days=30)
+    # Обычные письма разной длины генерируются один раз и переиспользуются. Уведомления
+    # суда всегда новые: копии с тем же Message-ID и номером дела отсеиваются как повторы
+    templates = {}
+    for index in range(count):
+        is_court = rng.random() < court_ratio
+        with_attachment = attachment_size and rng.random() < attachment_ratio
+        date = start + timedelta(minutes=index * 30 * 24 * 60 // max(count, 1))
+        size = attachment_size if with_attachment else 0
+        if is_court:
+            message = build_court_notice(rng, size)
+        else:
+            key = (bool(with_attachment), index % 50)
+            if key not in templates:
+                templates[key] = build_other_message(rng, size)
+            message = templates[key]
+        flags = ('\\Seen',) if rng.random() < seen_ratio else ()
+        mailbox.append(message, flags, date)
+    return mailbox
+
+
+def court_arrivals(weeks=8, per_day=6.0, seed=42, start=None):
+    """
+    Моменты прихода уведомлений суда, похожие на настоящие
+
+    В рабочие дни уведомления приходят в основном с 9 до 18 по Москве (с
+    пиками до и после обеда), реже вечером; в выходные - единицы. Часть
+    уведомлений приходит пачкой: по тому же делу через несколько минут.
+
+    Args:
+        weeks (int): Сколько недель моделировать
+        per_day (float): Среднее число уведомлений в рабочий день
+        seed (int): Зерно генератора для воспроизводимости
+        start (datetime): Понедельник, с которого начать (по умолчанию за weeks недель до сегодня)
+
+    Returns:
+        list: Отсортированные unix timestamp
+    """
+    rng = random.Random(seed)
+    moscow = timezone(timedelta(hours=3))
+    if start is None:
+        today = datetime.now(moscow).replace(hour=0, minute=0, second=0, microsecond=0)
+        start = today - timedelta(days=today.weekday(), weeks=weeks)
+    # Вес часа в рабочий день: утренний и послеобеденный пики, редкие вечерние письма
+    weekday_hours = [0.02] * 8 + [0.6, 1.0, 1.0, 0.9, 0.5, 0.8, 1.0, 0.9, 0.7, 0.4] + [0.15, 0.1, 0.05, 0.03, 0.02, 0.02]
+    arrivals = []
+    for day in range(weeks * 7):
+        midnight = start + timedelta(days=day)
+        if midnight.weekday() < 5:
+            count = rng.expovariate(1 / per_day) if per_day else 0
+            hours = weekday_hours
+        else:
+            count = rng.random() * 0.5
+            hours = [1.0] * 24
+        for _ in range(int(round(count))):
+            hour = rng.choices(range(24), weights=hours)[0]
+            moment = midnight + timedelta(hours=hour, seconds=rng.uniform(0, 3600))
+            arrivals.append(moment.timestamp())
+            while rng.random() < 0.4:
+                moment += timedelta(seconds=rng.uniform(30, 600))
+                arrivals.append(moment.timestamp())
+    return sorted(arrivals)
+
+
+def load_fixtures(path, mailbox=None):
+    """
+    Заполняет фейковую папку письмами из mbox файла, .eml файла или папки с .eml
+
+    Письма из mbox с флагом прочтения (заголовок Status: RO) попадают в папку
+    прочитанными, остальные - непрочитанными.
+
+    Args:
+        path (str): Путь к mbox, .eml или папке
+        mailbox (FakeMailbox): Папка, в которую добавить письма
+
+    Returns:
+        FakeMailbox: Заполненная папка
+    """
+    mailbox = mailbox or FakeMailbox()
+    if os.path.isdir(path):
+        names = sorted(name for name in os.listdir(path) if name.lower().endswith('.eml'))
+        for name in names:
+            with open(os.path.join(path, name), 'rb') as f:
+                mailbox.append(f.read())
+    elif path.lower().endswith('.eml'):
+        with open(path, 'rb') as f:
+            mailbox.append(f.read())
+    else:
+        for message in mailbox_files.mbox(path, create=False):
+            flags = ('\\Seen',) if 'R' in message.get_flags() else ()
+            mailbox.append(message.as_bytes(), flags)
+    return mailbox
@@ -0,0 +1,777 @@
+"""
+Локальные фейковые IMAP сервер и Telegram Bot API для бенчмарков и отладки
+
+IMAP сервер понимает подмножество IMAP4rev1, которое использует mail_notifier.py:
+LOGIN, SELECT, STATUS, SEARCH, FETCH, STORE, COPY, MOVE, EXPUNGE, NOOP, IDLE и
+их UID-варианты. Для сравнения режимов он считает команды и переданные байты,
+а параметр latency имитирует сетевую задержку на каждую команду.
+
+Заглушка Telegram принимает sendMessage по HTTP/1.1 с keep-alive, считает
+соединения и байты тел запросов и ответов и умеет отвечать заранее заданными ошибками (например, 429)
+или имитировать недоступность Bot API (502 на каждый запрос).
+"""
+import bisect
+import email
+import json
+import re
+import select
+import socketserver
+import threading
+import time
+from datetime import datetime, timezone
+from email.header import decode_header
+from email.utils import parsedate_to_datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CAPABILITIES = 'IMAP4rev1 IDLE MOVE UIDPLUS LITERAL+'
+SYSTEM_FLAGS = ('\\Seen', '\\Answered', '\\Flagged', '\\Deleted', '\\Draft')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+LITERAL_RE = re.compile(rb'\{(\d+)(\+?)\}\r\n$')
+
+
+class FakeMessage:
+    """
+    Письмо в фейковом ящике: исходные байты, UID, флаги и дата получения
+    """
+
+    def __init__(self, uid, raw, flags=(), internaldate=None):
+        self.uid = uid
+        self.raw = raw
+        self.flags = set(flags)
+        self.internaldate = internaldate or datetime.now(timezone.utc)
+        self._parsed = None
+        self._decoded_headers = {}
+
+    @property
+    def parsed(self):
+        if self._parsed is None:
+            self._parsed = email.message_from_bytes(self.raw)
+        return self._parsed
+
+    def split_raw(self):
+        """Возвращает (заголовки, тело) исходного письма"""
+        for separator in (b'\r\n\r\n', b'\n\n'):
+            index = self.raw.find(separator)
+            if index != -1:
+                return self.raw[:index + len(separator)], self.raw[index + len(separator):]
+        return self.raw, b''
+
+    def header_text(self, name):
+        """Декодированное значение заголовка для SEARCH"""
+        key = name.lower()
+        if key not in self._decoded_headers:
+            value = self.parsed.get(name, '')
+            text = ''
+            try:
+                for part, charset in decode_header(str(value)):
+                    if isinstance(part, bytes):
+                        text += part.decode(charset or 'utf-8', errors='replace')
+                    else:
+                        text += part
+            except Exception:
+                text = str(value)
+            self._decoded_headers[key] = text.casefold()
+        return self._decoded_headers[key]
+
+
+class FakeMailbox:
+    """
+    Папка фейкового сервера с потокобезопасным добавлением писем
+    """
+
+    def __init__(self, name='INBOX', uidvalidity=1):
+        self.name = name
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.changed = threading.Condition()
+
+    def append(self, raw, flags=(), internaldate=None):
+        """Добавляет письмо и будит клиентов в IDLE"""
+        with self.changed:
+            message = FakeMessage(self.next_uid, raw, flags, internaldate)
+            self.next_uid += 1
+            self.messages.append(message)
+            self.changed.notify_all()
+            return message.uid
+
+    def reset_uidvalidity(self, uidvalidity):
+        """Имитирует пересоздание папки сервером"""
+        with self.changed:
+            self.uidvalidity = uidvalidity
+            for index, message in enumerate(self.messages, 1):
+                message.uid = index
+            self.next_uid = len(self.messages) + 1
+
+    def unseen_count(self):
+        return sum(1 for message in self.messages if '\\Seen' not in message.flags)
+
+
+def tokenize(data):
+    """
+    Разбирает аргументы команды IMAP во вложенные списки байтовых строк
+    """
+    stack = [[]]
+    pos = 0
+    length = len(data)
+    while pos < length:
+        char = data[pos:pos + 1]
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char == b'(':
+            stack.append([])
+            pos += 1
+        elif char == b')':
+            item = stack.pop()
+            stack[-1].append(item)
+            pos += 1
+        elif char == b'"':
+            pos += 1
+            value = bytearray()
+            while pos < length and data[pos:pos + 1] != b'"':
+                if data[pos:pos + 1] == b'\\':
+                    pos += 1
+                value += data[pos:pos + 1]
+                pos += 1
+            stack[-1].append(bytes(value))
+            pos += 1
+        elif char == b'{':
+            end = data.index(b'}', pos)
+            size = int(data[pos + 1:end].rstrip(b'+'))
+            start = data.index(b'\n', end) + 1
+            stack[-1].append(data[start:start + size])
+            pos = start + size
+        else:
+            start = pos
+            depth = 0
+            while pos < length:
+                char = data[pos:pos + 1]
+                if char == b'[':
+                    depth += 1
+                elif char == b']':
+                    depth -= 1
+                elif depth == 0 and char in (b' ', b'(', b')', b'\r', b'\n'):
+                    break
+                pos += 1
+            stack[-1].append(data[start:pos])
+    return stack[0]
+
+
+def quote(value):
+    """Кодирует строку IMAP: в кавычках для ASCII, литералом для остального"""
+    if value is None:
+        return b'NIL'
+    if isinstance(value, str):
+        value = value.encode('utf-8', errors='surrogateescape')
+    if all(32 <= byte < 127 for byte in value):
+        return b'"' + value.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+    return b'{%d}\r\n' % len(value) + value
+
+
+def parse_ranges(value, maximum):
+    """Разбирает набор вида 1:5,7,9:* в список диапазонов"""
+    ranges = []
+    for item in value.decode().split(','):
+        if ':' in item:
+            start, end = item.split(':', 1)
+        else:
+            start = end = item
+        start = maximum if start == '*' else int(start)
+        end = maximum if end == '*' else int(end)
+        ranges.append((min(start, end), max(start, end)))
+    return ranges
+
+
+def parse_sequence_set(value, maximum):
+    """Превращает набор вида 1:5,7,9:* в функцию проверки номера"""
+    ranges = parse_ranges(value, maximum)
+    return lambda number: any(start <= number <= end for start, end in ranges)
+
+
+def parse_imap_date(value):
+    day, month, year = value.decode().split('-')
+    return datetime(int(year), MONTHS.index(month.capitalize()) + 1, int(day), tzinfo=timezone.utc).date()
+
+
+def message_date(message):
+    try:
+        return parsedate_to_datetime(message.parsed.get('Date')).date()
+    except Exception:
+        return message.internaldate.date()
+
+
+def part_payload(part):
+    """Исходные (не декодированные) байты тела части"""
+    if part.is_multipart():
+        body = part.as_bytes()
+        index = body.find(b'\n\n')
+        return body[index + 2:] if index != -1 else body
+    payload = part.get_payload()
+    if isinstance(payload, bytes):
+        return payload
+    return payload.encode('ascii', errors='surrogateescape')
+
+
+def body_structure(part):
+    """Строит BODYSTRUCTURE для части письма"""
+    if part.is_multipart() and part.get_content_type() != 'message/rfc822':
+        children = b''.join(body_structure(child) for child in part.get_payload())
+        return b'(' + children + b' ' + quote(part.get_content_subtype()) + b')'
+
+    maintype = part.get_content_maintype()
+    subtype = part.get_content_subtype()
+    params = part.get_params() or []
+    param_items = b' '.join(quote(key) + b' ' + quote(value) for key, value in params[1:] if value)
+    payload = part_payload(part)
+    encoding = part.get('Content-Transfer-Encoding', '7bit').strip()
+    fields = [
+        quote(maintype), quote(subtype),
+        b'(' + param_items + b')' if param_items else b'NIL',
+        b'NIL', b'NIL', quote(encoding), str(len(payload)).encode(),
+    ]
+    if maintype == 'text':
+        fields.append(str(payload.count(b'\n')).encode())
+    disposition = part.get('Content-Disposition')
+    if disposition:
+        kind = disposition.split(';')[0].strip()
+        filename = part.get_filename()
+        disp_params = b'(' + quote('filename') + b' ' + quote(filename) + b')' if filename else b'NIL'
+        disposition_field = b'(' + quote(kind) + b' ' + disp_params + b')'
+    else:
+        disposition_field = b'NIL'
+    fields.extend([b'NIL', disposition_field, b'NIL', b'NIL'])
+    return b'(' + b' '.join(fields) + b')'
+
+
+def find_part(message, path):
+    """Находит часть письма по номеру секции 1.2.3"""
+    part = message.parsed
+    for index in path:
+        if part.is_multipart() and part.get_content_type() != 'message/rfc822':
+            part = part.get_payload()[index - 1]
+        elif part.get_content_type() == 'message/rfc822':
+            part = part.get_payload()[0]
+            if part.is_multipart():
+                part = part.get_payload()[index - 1]
+        elif index != 1:
+            raise IndexError(index)
+    return part
+
+
+def filter_header_fields(header_bytes, fields, exclude=False):
+    """Оставляет (или убирает) заданные поля из блока заголовков"""
+    wanted = {field.lower() for field in fields}
+    result = []
+    keep = False
+    for line in header_bytes.splitlines(keepends=True):
+        if not line.strip():
+            continue
+        if line[:1] in (b' ', b'\t'):
+            if keep:
+                result.append(line)
+            continue
+        name = line.split(b':', 1)[0].decode('ascii', errors='replace').strip().lower()
+        keep = (name in wanted) != exclude
+        if keep:
+            result.append(line)
+    return b''.join(result) + b'\r\n'
+
+
+def section_data(message, section):
+    """Возвращает байты секции BODY[section]"""
+    header, body = message.split_raw()
+    spec = section.upper()
+    if spec == '':
+        return message.raw
+    if spec == 'HEADER':
+        return header
+    if spec == 'TEXT':
+        return body
+    if spec.startswith('HEADER.FIELDS'):
+        fields = re.findall(r'[^\s()]+', section[section.index('(') + 1:].rstrip(')'))
+        return filter_header_fields(header, fields, exclude=spec.startswith('HEADER.FIELDS.NOT'))
+
+    numbers = []
+    suffix = ''
+    for piece in spec.split('.'):
+        if piece.isdigit() and not suffix:
+            numbers.append(int(piece))
+        else:
+            suffix = f"{suffix}.{piece}" if suffix else piece
+    part = find_part(message, numbers)
+    if suffix == 'MIME':
+        lines = b''.join(
+            f"{key}: {value}\r\n".encode('utf-8', errors='surrogateescape') for key, value in part.items()
+        )
+        return lines + b'\r\n'
+    if suffix == 'HEADER':
+        return part.as_bytes().split(b'\n\n', 1)[0] + b'\n\n'
+    return part_payload(part)
+
+
+class IMAPHandler(socketserver.StreamRequestHandler):
+    """Обработчик одного клиентского соединения"""
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.mailboxes = self.server.mailboxes
+        self.selected = None
+        self.known_exists = 0
+
+    def send(self, data):
+        self.server.count('bytes_sent', len(data))
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        data = line
+        while True:
+            match = LITERAL_RE.search(data)
+            if not match:
+                break
+            if not match.group(2):
+                self.send(b'+ Ready for literal\r\n')
+            data += self.rfile.read(int(match.group(1)))
+            data += self.rfile.readline()
+        self.server.count('bytes_received', len(data))
+        return data
+
+    def handle(self):
+        self.server.count('connections')
+        self.send(b'* OK Fake IMAP server ready\r\n')
+        while True:
+            data = self.read_command()
+            if data is None:
+                return
+            parts = data.split(b' ', 2)
+            if len(parts) < 2:
+                continue
+            tag = parts[0]
+            self.current_tag = tag
+            command = parts[1].strip().upper().decode()
+            args = tokenize(parts[2]) if len(parts) > 2 else []
+            self.server.count('commands')
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            try:
+                if not self.dispatch(tag, command, args):
+                    return
+            except Exception as e:
+                self.send(tag + b' BAD ' + str(e).encode('utf-8', errors='replace') + b'\r\n')
+
+    def dispatch(self, tag, command, args):
+        uid_mode = command == 'UID'
+        if uid_mode:
+            command = args[0].decode().upper()
+            args = args[1:]
+        handler = getattr(self, f"cmd_{command.lower()}", None)
+        if handler is None:
+            self.send(tag + b' BAD Unknown command\r\n')
+            return True
+        self.server.count(f"cmd_{'uid_' if uid_mode else ''}{command.lower()}")
+        result = handler(args, uid_mode) if command in ('SEARCH', 'FETCH', 'STORE', 'COPY', 'MOVE', 'EXPUNGE') else handler(args)
+        if command == 'LOGOUT':
+            self.send(tag + b' OK LOGOUT completed\r\n')
+            return False
+        if command == 'IDLE':
+            return result
+        self.notify_exists()
+        status = result if isinstance(result, bytes) else b'OK'
+        self.send(tag + b' ' + status + b' ' + command.encode() + b' completed\r\n')
+        return True
+
+    def notify_exists(self):
+        if self.selected is not None and len(self.selected.messages) != self.known_exists:
+            self.known_exists = len(self.selected.messages)
+            self.send(b'* %d EXISTS\r\n' % self.known_exists)
+
+    def get_mailbox(self, name):
+        name = name.decode() if isinstance(name, bytes) else name
+        key = 'INBOX' if name.upper() == 'INBOX' else name
+        if key not in self.mailboxes:
+            self.mailboxes[key] = FakeMailbox(key)
+        return self.mailboxes[key]
+
+    def cmd_capability(self, args):
+        self.send(f"* CAPABILITY {CAPABILITIES}\r\n".encode())
+
+    def cmd_login(self, args):
+        accounts = self.server.accounts
+        if accounts is not None:
+            user = args[0].decode()
+            if user not in accounts:
+                return b'NO [AUTHENTICATIONFAILED]'
+            self.mailboxes = accounts[user]
+
+    def cmd_noop(self, args):
+        pass
+
+    def cmd_logout(self, args):
+        self.send(b'* BYE Logging out\r\n')
+
+    def cmd_enable(self, args):
+        self.send(b'* ENABLED\r\n')
+
+    def cmd_select(self, args):
+        mailbox = self.get_mailbox(args[0])
+        self.selected = mailbox
+        self.known_exists = len(mailbox.messages)
+        self.send(b'* FLAGS (' + ' '.join(SYSTEM_FLAGS).encode() + b')\r\n')
+        self.send(b'* %d EXISTS\r\n* 0 RECENT\r\n' % self.known_exists)
+        self.send(b'* OK [UIDVALIDITY %d] UIDs valid\r\n' % mailbox.uidvalidity)
+        self.send(b'* OK [UIDNEXT %d] Predicted next UID\r\n' % mailbox.next_uid)
+        return b'OK [READ-WRITE]'
+
+    cmd_examine = cmd_select
+
+    def cmd_close(self, args):
+        if self.selected is not None:
+            self.selected.messages = [m for m in self.selected.messages if '\\Deleted' not in m.flags]
+        self.selected = None
+
+    def cmd_status(self, args):
+        mailbox = self.get_mailbox(args[0])
+        values = {
+            'MESSAGES': len(mailbox.messages),
+            'UIDNEXT': mailbox.next_uid,
+            'UIDVALIDITY': mailbox.uidvalidity,
+            'UNSEEN': mailbox.unseen_count(),
+            'RECENT': 0,
+        }
+        items = ' '.join(f"{item.decode().upper()} {values[item.decode().upper()]}" for item in args[1])
+        self.send(f"* STATUS {quote(mailbox.name).decode()} ({items})\r\n".encode())
+
+    def cmd_idle(self, args):
+        self.send(b'+ idling\r\n')
+        mailbox = self.selected
+        while True:
+            readable, _, _ = select.select([self.connection], [], [], 0.05)
+            if readable:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                self.notify_exists()
+                self.send(self.current_tag + b' OK IDLE terminated\r\n')
+                return True
+            if mailbox is not None:
+                with mailbox.changed:
+                    if len(mailbox.messages) == self.known_exists:
+                        mailbox.changed.wait(0.2)
+                self.notify_exists()
+
+    # --- Поиск ---
+
+    def parse_search_key(self, args, index, charset):
+        key = args[index]
+        if isinstance(key, list):
+            predicates = []
+            position = 0
+            while position < len(key):
+                predicate, position = self.parse_search_key(key, position, charset)
+                predicates.append(predicate)
+            return (lambda seq, msg: all(p(seq, msg) for p in predicates)), index + 1
+
+        name = key.decode().upper()
+        text = lambda value: value.decode(charset, errors='replace').casefold()
+        flag_keys = {
+            'SEEN': ('\\Seen', True), 'UNSEEN': ('\\Seen', False),
+            'DELETED': ('\\Deleted', True), 'UNDELETED': ('\\Deleted', False),
+            'FLAGGED': ('\\Flagged', True), 'UNFLAGGED': ('\\Flagged', False),
+            'ANSWERED': ('\\Answered', True), 'UNANSWERED': ('\\Answered', False),
+        }
+        if name == 'ALL':
+            return (lambda seq, msg: True), index + 1
+        if name in flag_keys:
+            flag, present = flag_keys[name]
+            return (lambda seq, msg: (flag in msg.flags) == present), index + 1
+        if name in ('FROM', 'TO', 'CC', 'SUBJECT'):
+            needle = text(args[index + 1])
+            return (lambda seq, msg: needle in msg.header_text(name)), index + 2
+        if name == 'HEADER':
+            header, needle = args[index + 1].decode(), text(args[index + 2])
+            return (lambda seq, msg: needle in msg.header_text(header)), index + 3
+        if name in ('BODY', 'TEXT'):
+            needle = text(args[index + 1])
+            return (lambda seq, msg: needle in msg.raw.decode('utf-8', errors='replace').casefold()), index + 2
+        if name in ('SINCE', 'BEFORE', 'ON', 'SENTSINCE', 'SENTBEFORE', 'SENTON'):
+            day = parse_imap_date(args[index + 1])
+            compare = {
+                'SINCE': lambda d: d >= day, 'BEFORE': lambda d: d < day, 'ON': lambda d: d == day,
+            }[name.replace('SENT', '')]
+            if name.startswith('SENT'):
+                return (lambda seq, msg: compare(message_date(msg))), index + 2
+            return (lambda seq, msg: compare(msg.internaldate.date())), index + 2
+        if name in ('LARGER', 'SMALLER'):
+            size = int(args[index + 1])
+            if name == 'LARGER':
+                return (lambda seq, msg: len(msg.raw) > size), index + 2
+            return (lambda seq, msg: len(msg.raw) < size), index + 2
+        if name == 'NOT':
+            inner, position = self.parse_search_key(args, index + 1, charset)
+            return (lambda seq, msg: not inner(seq, msg)), position
+        if name == 'OR':
+            left, position = self.parse_search_key(args, index + 1, charset)
+            right, position = self.parse_search_key(args, position, charset)
+            return (lambda seq, msg: left(seq, msg) or right(seq, msg)), position
+        if name == 'UID':
+            maximum = self.selected.messages[-1].uid if self.selected.messages else 0
+            matches = parse_sequence_set(args[index + 1], maximum)
+            return (lambda seq, msg: matches(msg.uid)), index + 2
+        matches = parse_sequence_set(key, len(self.selected.messages))
+        return (lambda seq, msg: matches(seq)), index + 1
+
+    def cmd_search(self, args, uid_mode):
+        charset = 'utf-8'
+        if args and isinstance(args[0], bytes) and args[0].upper() == b'CHARSET':
+            charset = args[1].decode()
+            args = args[2:]
+        predicates = []
+        index = 0
+        while index < len(args):
+            predicate, index = self.parse_search_key(args, index, charset)
+            predicates.append(predicate)
+        found = [
+            str(msg.uid if uid_mode else seq)
+            for seq, msg in enumerate(self.selected.messages, 1)
+            if all(p(seq, msg) for p in predicates)
+        ]
+        self.send(('* SEARCH ' + ' '.join(found)).rstrip().encode() + b'\r\n')
+
+    # --- Получение писем ---
+
+    def select_messages(self, message_set, uid_mode):
+        messages = self.selected.messages
+        if uid_mode:
+            uids = [message.uid for message in messages]
+            indexes = set()
+            for start, end in parse_ranges(message_set, uids[-1] if uids else 0):
+                indexes.update(range(bisect.bisect_left(uids, start), bisect.bisect_right(uids, end)))
+        else:
+            indexes = set()
+            for start, end in parse_ranges(message_set, len(messages)):
+                indexes.update(range(max(start, 1) - 1, min(end, len(messages))))
+        return [(index + 1, messages[index]) for index in sorted(indexes)]
+
+    def fetch_item(self, message, item):
+        name = item.decode()
+        upper = name.upper()
+        if upper == 'UID':
+            return b'UID %d' % message.uid
+        if upper == 'FLAGS':
+            return b'FLAGS (' + ' '.join(sorted(message.flags)).encode() + b')'
+        if upper == 'INTERNALDATE':
+            return b'INTERNALDATE "' + message.internaldate.strftime('%d-%b-%Y %H:%M:%S +0000').encode() + b'"'
+        if upper == 'RFC822.SIZE':
+            return b'RFC822.SIZE %d' % len(message.raw)
+        if upper in ('BODYSTRUCTURE', 'BODY'):
+            return upper.encode() + b' ' + body_structure(message.parsed)
+        if upper in ('RFC822', 'RFC822.HEADER', 'RFC822.TEXT'):
+            section = {'RFC822': '', 'RFC822.HEADER': 'HEADER', 'RFC822.TEXT': 'TEXT'}[upper]
+            if upper != 'RFC822.HEADER':
+                message.flags.add('\\Seen')
+            data = section_data(message, section)
+            return upper.encode() + b' {%d}\r\n' % len(data) + data
+
+        match = re.match(r'(BODY(?:\.PEEK)?)\[(.*)\](?:<(\d+)\.(\d+)>)?$', name, re.IGNORECASE | re.DOTALL)
+        if not match:
+            raise ValueError(f"Unsupported FETCH item {name}")
+        peek, section, origin, count = match.groups()
+        data = section_data(message, section)
+        label = f"BODY[{section}]"
+        if origin is not None:
+            data = data[int(origin):int(origin) + int(count)]
+            label += f"<{origin}>"
+        if peek.upper() == 'BODY':
+            message.flags.add('\\Seen')
+        return label.encode() + b' {%d}\r\n' % len(data) + data
+
+    def cmd_fetch(self, args, uid_mode):
+        items = args[1] if isinstance(args[1], list) else [args[1]]
+        if uid_mode and not any(item.upper() == b'UID' for item in items):
+            items = [b'UID'] + items
+        for seq, message in self.select_messages(args[0], uid_mode):
+            parts = [self.fetch_item(message, item) for item in items]
+            self.send(b'* %d FETCH (' % seq + b' '.join(parts) + b')\r\n')
+
+    def cmd_store(self, args, uid_mode):
+        mode = args[1].decode().upper()
+        flags = args[2] if isinstance(args[2], list) else [args[2]]
+        flags = {flag.decode() for flag in flags}
+        for seq, message in self.select_messages(args[0], uid_mode):
+            if mode.startswith('+'):
+                message.flags |= flags
+            elif mode.startswith('-'):
+                message.flags -= flags
+            else:
+                message.flags = set(flags)
+            if not mode.endswith('.SILENT'):
+                uid_part = b'UID %d ' % message.uid if uid_mode else b''
+                self.send(b'* %d FETCH (' % seq + uid_part + b'FLAGS (' + ' '.join(sorted(message.flags)).encode() + b'))\r\n')
+
+    def cmd_copy(self, args, uid_mode):
+        target = self.get_mailbox(args[1])
+        for _, message in self.select_messages(args[0], uid_mode):
+            target.append(message.raw, message.flags, message.internaldate)
+
+    def expunge(self, selected):
+        removed = {id(message) for _, message in selected}
+        for seq, message in sorted(((seq, message) for seq, message in selected), key=lambda pair: -pair[0]):
+            self.send(b'* %d EXPUNGE\r\n' % seq)
+        with self.selected.changed:
+            self.selected.messages = [m for m in self.selected.messages if id(m) not in removed]
+        self.known_exists = len(self.selected.messages)
+
+    def cmd_move(self, args, uid_mode):
+        selected = self.select_messages(args[0], uid_mode)
+        target = self.get_mailbox(args[1])
+        for _, message in selected:
+            target.append(message.raw, message.flags, message.internaldate)
+        self.expunge(selected)
+
+    def cmd_expunge(self, args, uid_mode=False):
+        selected = [
+            (seq, message) for seq, message in
+            (self.select_messages(args[0], True) if uid_mode else enumerate(self.selected.messages, 1))
+            if '\\Deleted' in message.flags
+        ]
+        self.expunge(selected)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """
+    Фейковый IMAP сервер без TLS, работающий в фоновом потоке
+
+    Args:
+        mailboxes (dict): Общие папки {имя: FakeMailbox} для любого логина
+        accounts (dict): Папки по логинам {логин: {имя: FakeMailbox}}
+        latency (float): Искусственная задержка на каждую команду, секунды
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    # Демоны десятков ящиков подключаются одновременно, очередь по умолчанию (5) их теряет
+    request_queue_size = 128
+
+    def __init__(self, mailboxes=None, accounts=None, latency=0.0, host='127.0.0.1', port=0):
+        super().__init__((host, port), IMAPHandler)
+        self.mailboxes = mailboxes if mailboxes is not None else {'INBOX': FakeMailbox()}
+        self.accounts = accounts
+        self.latency = latency
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def address(self):
+        return self.server_address[0], self.server_address[1]
+
+    def count(self, name, value=1):
+        with self.stats_lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def reset_stats(self):
+        with self.stats_lock:
+            self.stats = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TelegramHandler(BaseHTTPRequestHandler):
+    """Обработчик запросов к заглушке Bot API"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.count('connections')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length) or b'{}')
+        self.server.count('requests')
+        self.server.count('bytes_received', length)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        status, payload = self.server.respond(self.path.rsplit('/', 1)[-1], body)
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.server.count('bytes_sent', len(data))
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeTelegramServer(ThreadingHTTPServer):
+    """
+    Заглушка Telegram Bot API, работающая в фоновом потоке
+
+    Args:
+        latency (float): Искусственная задержка ответа, секунды
+        scripted (list): Ответы (status, payload), которые вернутся первыми,
+            например [(429, {'ok': False, 'parameters': {'retry_after': 1}})]
+
+    Пока атрибут down истинен, каждый запрос получает 502 Bad Gateway.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0.0, scripted=None, host='127.0.0.1', port=0):
+        super().__init__((host, port), TelegramHandler)
+        self.latency = latency
+        self.scripted = list(scripted or [])
+        self.down = False
+        self.messages = []
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def api_url(self):
+        return f"http://{self.server_address[0]}:{self.server_address[1]}"
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {}
+            self.messages = []
+
+    def respond(self, method, body):
+        with self.lock:
+            if self.down:
+                self.stats['failed'] = self.stats.get('failed', 0) + 1
+                return 502, {'ok': False, 'error_code': 502, 'description': 'Bad Gateway'}
+            if self.scripted:
+                return self.scripted.pop(0)
+            if method != 'sendMessage':
+                return 404, {'ok': False, 'error_code': 404, 'description': 'Not Found'}
+            message_id = len(self.messages) + 1
+            self.messages.append({'time': time.time(), 'message_id': message_id, **body})
+        return 200, {'ok': True, 'result': {
+            'message_id': message_id, 'chat': {'id': body.get('chat_id')}, 'text': body.get('text'),
+        }}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,16 +1,30 @@
-import imaplib
 import email
-from email.header import decode_header
-import requests
 import os
 import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 import re
+import html
+from html.parser import HTMLParser
+import codecs
+import binascii
+import functools
+import contextlib
 import quopri
+import base64
+import random
+import hashlib
+import unicodedata
+import ssl
+import threading
+import time
+import asyncio
+import urllib.parse
+# sqlite3 и email.header импортируются при первом использовании: запуск по
+# расписанию без новых писем до них не доходит
 
-# Настройка логирования
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Настройка логирования (LOG_LEVEL=DEBUG - подробности по каждому письму)
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper(), format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # Конфигурация из переменных окружения
@@ -20,12 +34,146 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 TELEGRAM_CHAT_ID = os.getenv('TELEGRAM_CHAT_ID')
 TARGET_SENDER = os.getenv('TARGET_SENDER', 'guard@arbitr.ru')
 TARGET_SUBJECT_KEYWORDS = os.getenv('TARGET_SUBJECT_KEYWORDS', 'Предоставлен доступ к материалам дела').split(',')
+# Файл с правилами фильтрации, чатами и шаблонами (пусто - одно правило из TARGET_*)
+RULES_FILE = os.getenv('RULES_FILE', '')
+# Поиск кандидатов на стороне сервера (FROM/SUBJECT/SINCE) вместо фильтрации всех непрочитанных
+IMAP_SERVER_SEARCH = os.getenv('IMAP_SERVER_SEARCH', 'false').lower() == 'true'
+IMAP_SEARCH_SINCE_DAYS = int(os.getenv('IMAP_SEARCH_SINCE_DAYS', '30'))
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', 'https://api.telegram.org')
+# Если за один проход подошло больше писем, они отправляются одним сообщением-дайджестом
+TELEGRAM_DIGEST_THRESHOLD = int(os.getenv('TELEGRAM_DIGEST_THRESHOLD', '10'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+# Папка, куда переносятся обработанные письма суда (пусто - оставлять во входящих)
+PROCESSED_FOLDER = os.getenv('PROCESSED_FOLDER', '')
+# Файл со списком ящиков, папок и чатов (пусто - один ящик из YANDEX_EMAIL)
+ACCOUNTS_FILE = os.getenv('ACCOUNTS_FILE', '')
+ACCOUNT_WORKERS = int(os.getenv('ACCOUNT_WORKERS', '4'))
+# Локальный кэш разобранных писем (пусто - без кэша). Если не задан, кэш ведется
+# только демоном и --resend: запуск по расписанию в CI не сохраняет файл между запусками
+MESSAGE_CACHE_FILE = os.getenv('MESSAGE_CACHE_FILE')
+DEFAULT_MESSAGE_CACHE_FILE = 'message_cache.sqlite3'
+MESSAGE_CACHE_SIZE = int(os.getenv('MESSAGE_CACHE_SIZE', '5000'))
+# Сколько часов повторы уведомления (тот же Message-ID или номер дела с темой) не отправляются (0 - не отсеивать)
+DEDUP_WINDOW_HOURS = float(os.getenv('DEDUP_WINDOW_HOURS', '24'))
+# Куда записать JSON сводку метрик запуска (пусто - только в лог)
+METRICS_FILE = os.getenv('METRICS_FILE', '')
+# Порт HTTP эндпоинта /metrics в формате Prometheus в режиме демона (0 - выключен)
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# Опрос без IDLE (--poll или сервер без IDLE): границы интервала и файл выученной гистограммы прихода писем
+POLL_INTERVAL_MIN = float(os.getenv('POLL_INTERVAL_MIN', '90'))
+POLL_INTERVAL_MAX = float(os.getenv('POLL_INTERVAL_MAX', '1800'))
+POLL_HISTOGRAM_FILE = os.getenv('POLL_HISTOGRAM_FILE', 'poll_histogram.json')
+# Сколько секунд запуск по расписанию ждет доставки очереди уведомлений (остаток уйдет при следующем запуске)
+OUTBOX_DRAIN_TIMEOUT = float(os.getenv('OUTBOX_DRAIN_TIMEOUT', '60'))
 
 # Константы
 IMAP_SERVER = 'imap.yandex.ru'
 IMAP_PORT = 993
 STATE_FILE = 'email_state.json'
+IMAP_MAILBOX = 'INBOX'
 REQUEST_TIMEOUT = 30
+IMAP_LINE_LIMIT = 1024 * 1024       # Максимальная длина строки ответа IMAP (BODYSTRUCTURE больших писем)
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_GLOBAL_RATE = 30           # Общий лимит Bot API, сообщений в секунду
+TELEGRAM_MAX_RETRIES = 3            # Повторы после ответа 429
+TELEGRAM_POOL_SIZE = 4
+TELEGRAM_MAX_MESSAGE_LENGTH = 4096
+BODY_PREVIEW_LENGTH = 150          # Длина отрывка письма в уведомлении
+FETCH_BATCH_SIZE = 200
+BODY_FETCH_BATCH_SIZE = 50          # Пакет тел писем: пока разбирается один, загружается следующий
+TEXT_FETCH_WINDOW = 8192            # Сколько байт text/plain части загружать: отрывку хватает начала
+HTML_FETCH_WINDOW = 65536           # У HTML перед текстом идут разметка и стили, окно больше
+BODY_FETCH_LIMIT = 1024 * 1024      # Дальше этого обрезанная текстовая часть не догружается
+PARSE_WORKERS = 4
+OUTBOX_RETRY_MIN = 2                # Задержка первого повтора недоставленного уведомления, секунды
+OUTBOX_RETRY_MAX = 10 * 60          # Потолок экспоненциальной задержки повторов
+STORE_BATCH_SIZE = 500              # UID в одной команде STORE/MOVE
+CACHE_QUERY_BATCH_SIZE = 500        # UID в одном запросе к кэшу (лимит параметров SQLite)
+CACHED_HEADER_FIELDS = ('From', 'Subject', 'Date', 'Message-ID')
+HEADER_FIELDS = 'FROM SUBJECT DATE MESSAGE-ID'
+TARGET_SENDER_DOMAIN = 'arbitr.ru'
+TARGET_SENDER_KEYWORDS = ('арбитр',)
+RULE_LIST_FIELDS = ('senders', 'sender_domains', 'sender_keywords', 'subject_keywords')  # Условия-списки по заголовкам
+RULE_CONDITION_FIELDS = RULE_LIST_FIELDS + ('body_regex',)
+NOTIFICATION_TEMPLATE_FIELDS = ('subject', 'sender', 'body', 'uid', 'time')
+RULE_BODY_SCAN_LENGTH = 2000        # Сколько символов текста письма проверять по body_regex
+UNREADABLE_BODY_TEXT = "Текст письма не доступен для чтения"
+STATE_JOURNAL_MAX_RECORDS = 1000    # После стольких записей журнал состояния сжимается в снимок
+DEDUP_MAX_ENTRIES = 10000           # Сколько ключей отправленных уведомлений хранить в снимке
+DEDUP_KEY_SIZE = 8                  # Байт хэша ключа: в снимке хранится 16 hex символов вместо Message-ID
+# Режим демона (--daemon)
+IDLE_TIMEOUT = 25 * 60              # Перезапуск IDLE раньше 29-минутного таймаута сервера
+IDLE_DONE_TIMEOUT = 30
+NOOP_POLL_INTERVAL = 60             # Интервал опроса NOOP, если сервер не поддерживает IDLE
+# Адаптивный опрос (--poll)
+MOSCOW_TZ = timezone(timedelta(hours=3))
+BUSINESS_HOURS = (9, 18)            # Рабочие часы суда по Москве, пн-пт
+POLL_RECENT_MATCH_WINDOW = 15 * 60  # После уведомления суд часто присылает еще, опрос с минимальным интервалом
+POLL_PRIOR_BUSINESS = 1.0           # Начальный вес часа в гистограмме: рабочие часы до первых наблюдений
+POLL_PRIOR_OFF_HOURS = 0.3
+POLL_BACKOFF_LIMIT = 2              # Вне рабочих часов пустые опросы удлиняют интервал не больше чем во столько раз
+POLL_HISTOGRAM_CAP = 500            # При таком числе наблюдений все счетчики делятся пополам (забывание)
+RECONNECT_DELAY_MIN = 5
+RECONNECT_DELAY_MAX = 300
+IMAP_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+# Разбор ответов IMAP FETCH
+FETCH_START_RE = re.compile(rb'^(\d+) \(')
+FETCH_LITERAL_RE = re.compile(rb'BODY\[([^\]]*)\](?:<\d+>)? \{\d+\}$', re.IGNORECASE)
+LITERAL_SIZE_RE = re.compile(rb'\{\d+\}$')
+IDLE_EXISTS_RE = re.compile(rb'^\* \d+ EXISTS', re.IGNORECASE)
+IMAP_LITERAL_RE = re.compile(rb'\{(\d+)\}$')
+IMAP_UNTAGGED_RE = re.compile(rb'\* (?:(\d+) )?([A-Za-z-]+)(?: (.*))?$', re.DOTALL)
+IMAP_RESPONSE_CODE_RE = re.compile(rb'\* (?:OK|NO|BAD|PREAUTH|BYE) \[([A-Za-z-]+)(?: ([^\]]*))?\]')
+STATUS_VALUE_RE = re.compile(rb'(UIDVALIDITY|UIDNEXT|UNSEEN) (\d+)')
+# Номер дела: А40-12345/2025, Ф05-1234/2025, 09АП-12345/2025
+CASE_NUMBER_RE = re.compile(r'(?<!\w)(?:\d{2}АП|[А-ЯA-Z]\d{1,3})-\d+/\d{4}(?!\d)')
+IMAP_TOKEN_RE = re.compile(rb'\s*(?:(\()|(\))|"((?:[^"\\]|\\.)*)"|([^\s()"]+))', re.DOTALL)
+
+# Очистка текста для Telegram
+HTML_TAG_RE = re.compile(r'<[^>]+>')
+# Потоковое извлечение текста из HTML
+HTML_CHUNK_SIZE = 4096
+HTML_SKIP_TAGS = frozenset(('style', 'script', 'title'))
+HTML_BLOCK_TAGS = frozenset((
+    'address', 'article', 'aside', 'blockquote', 'br', 'dd', 'div', 'dl', 'dt', 'footer',
+    'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr', 'li', 'main', 'nav', 'ol',
+    'p', 'pre', 'section', 'table', 'tbody', 'td', 'tfoot', 'th', 'thead', 'tr', 'ul',
+))
+QP_ESCAPE_RE = re.compile(r'=(?:[0-9A-Fa-f]{2}|\r?\n)')
+# Определение кодировки тела письма
+CHARSET_FALLBACKS = ('utf-8', 'cp1251', 'koi8-r')
+CHARSET_SAMPLE_SIZE = 4096          # Сколько байт смотреть при определении кодировки
+SINGLE_BYTE_CYRILLIC = frozenset(('cp1251', 'koi8-r', 'cp866', 'iso8859-5', 'mac-cyrillic'))
+# Таблицы для bytes.translate: после удаления всех прочих байтов длина
+# результата равна числу байтов в диапазоне 0xC0-0xDF или 0xE0-0xFF
+HIGH_UPPER_ONLY = bytes(set(range(256)) - set(range(0xC0, 0xE0)))
+HIGH_LOWER_ONLY = bytes(set(range(256)) - set(range(0xE0, 0x100)))
+TRUNCATED_TAIL_RE = re.compile(r'(?:<[^>]*|&#?\w*|=[0-9A-Fa-f]?)$')
+# Проблемные символы Markdown и их безопасные аналоги. Применяются цепочкой
+# str.replace: на кириллическом тексте она быстрее str.translate, у которого
+# нет быстрого пути для не-ASCII символов
+TELEGRAM_TEXT_REPLACEMENTS = (
+    ('*', '•'),
+    ('_', '—'),
+    ('`', "'"),
+    ('[', '('),
+    (']', ')'),
+    ('~', '≈'),
+    ('#', '№'),
+    ('=', '═'),
+    ('|', '│'),
+    ('{', '❴'),
+    ('}', '❵'),
+    ('>', '›'),
+    ('<', '‹'),
+    ('?', '？'),
+    ('&', 'и'),
+    (';', ','),
+    (':', 'ː'),
+    ('!', '❗'),
+)
 
 def log_info(message):
     """Логирование информационных сообщений"""
@@ -43,40 +191,658 @@ def log_warning(message):
     """Логирование предупреждений"""
     logger.warning(f"⚠️ {message}")
 
-def load_processed_state():
+def log_debug(message, *args):
     """
-    Загружает ID последнего обработанного письма из файла состояния
-    
+    Подробности по каждому письму (видны при LOG_LEVEL=DEBUG)
+
+    Аргументы подставляются в message через %s только если уровень DEBUG
+    включен, поэтому в горячем цикле выключенный лог почти ничего не стоит.
+    """
+    logger.debug(f"🔍 {message}", *args)
+
+class Metrics:
+    """
+    Счетчики и суммарное время стадий проверки
+
+    Время стадий (connect, login, status, select, search, fetch, parse, filter,
+    throttle, send, journal, store) накапливается по числу вызовов, сумме и максимуму, поэтому
+    память не растет в режиме демона. Разбор писем идет в пуле потоков, и
+    время parse суммируется по всем потокам.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.spans = {}
+        self.counters = {}
+
+    @contextlib.contextmanager
+    def span(self, name):
+        """
+        Замеряет время блока кода как стадию name
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                span = self.spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max': 0.0})
+                span['count'] += 1
+                span['seconds'] += elapsed
+                span['max'] = max(span['max'], elapsed)
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def summary(self):
+        """
+        Returns:
+            dict: Длительность работы, стадии и счетчики для JSON сводки
+        """
+        with self.lock:
+            return {
+                'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+                'duration': round(time.time() - self.started, 3),
+                'spans': {
+                    name: {'count': span['count'], 'seconds': round(span['seconds'], 4), 'max': round(span['max'], 4)}
+                    for name, span in sorted(self.spans.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def prometheus(self):
+        """
+        Returns:
+            str: Метрики в текстовом формате Prometheus
+        """
+        with self.lock:
+            lines = [
+                '# TYPE mail_notifier_uptime_seconds gauge',
+                f'mail_notifier_uptime_seconds {time.time() - self.started:.3f}',
+                '# TYPE mail_notifier_stage_seconds_total counter',
+            ]
+            lines += [f'mail_notifier_stage_seconds_total{{stage="{name}"}} {span["seconds"]:.6f}'
+                      for name, span in sorted(self.spans.items())]
+            lines.append('# TYPE mail_notifier_stage_calls_total counter')
+            lines += [f'mail_notifier_stage_calls_total{{stage="{name}"}} {span["count"]}'
+                      for name, span in sorted(self.spans.items())]
+            lines.append('# TYPE mail_notifier_stage_max_seconds gauge')
+            lines += [f'mail_notifier_stage_max_seconds{{stage="{name}"}} {span["max"]:.6f}'
+                      for name, span in sorted(self.spans.items())]
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE mail_notifier_{name}_total counter')
+                lines.append(f'mail_notifier_{name}_total {value}')
+        return '\n'.join(lines) + '\n'
+
+# Метрики всего процесса: один запуск по расписанию или все время работы демона
+metrics = Metrics()
+
+def report_metrics():
+    """
+    Выводит JSON сводку метрик в лог и записывает ее в METRICS_FILE
+    """
+    summary = json.dumps(metrics.summary(), ensure_ascii=False)
+    log_info(f"Метрики: {summary}")
+    if METRICS_FILE:
+        try:
+            with open(METRICS_FILE, 'w', encoding='utf-8') as f:
+                f.write(summary + '\n')
+        except OSError as e:
+            log_warning(f"Не удалось записать метрики в {METRICS_FILE}: {e}")
+
+def start_metrics_server(port, host=METRICS_HOST):
+    """
+    Запускает в фоновом потоке HTTP эндпоинт /metrics для Prometheus
+
     Returns:
-        str or None: ID последнего обработанного письма или None если файл не существует
+        HTTP сервер (для остановки в тестах)
+    """
+    # http.server тянет за собой разбор MIME, поэтому импортируется только для демона
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log_info(f"Метрики Prometheus: http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+# Ящики проверяются параллельно, а состояние всех папок хранится в одном файле
+STATE_LOCK = threading.Lock()
+
+def fsync_directory(path):
+    """
+    Сбрасывает на диск каталог файла, чтобы переименование пережило сбой питания
     """
     try:
-        with open(STATE_FILE, 'r', encoding='utf-8') as f:
-            state = json.load(f)
-            last_id = state.get('last_processed_id')
-            log_info(f"Загружено состояние: ID {last_id}")
-            return last_id
-    except FileNotFoundError:
-        log_info("Файл состояния не найден, начинаем с начала")
-        return None
-    except json.JSONDecodeError as e:
-        log_error(f"Ошибка чтения файла состояния: {e}")
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        # Windows не позволяет открыть каталог, там os.replace и так надежен
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+class DedupIndex:
+    """
+    Ключи отправленных уведомлений для отсева повторов
+
+    Ключи (короткие хэши Message-ID и пары номер дела + тема) хранятся в
+    словаре со временем отправки, поэтому проверка письма стоит O(1) при
+    любой длине истории. Ключ действует DEDUP_WINDOW_HOURS, устаревшие
+    ключи и все сверх DEDUP_MAX_ENTRIES самых новых отбрасываются при сжатии
+    журнала. Ключи писем, которые сейчас в обработке, занимаются в памяти
+    до доставки, чтобы копии письма из двух ящиков не ушли одновременно.
+
+    Args:
+        entries (dict): {ключ: время отправки (Unix time)} из снимка
+    """
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        self.claimed = set()
+
+    def add(self, keys, timestamp):
+        for key in keys:
+            self.entries[key] = timestamp
+            self.claimed.discard(key)
+
+    def claim(self, keys, now):
+        """
+        Занимает ключи письма, если уведомление с ними еще не отправлялось
+
+        Returns:
+            bool: False если письмо повторяет отправленное или обрабатываемое уведомление
+        """
+        window = DEDUP_WINDOW_HOURS * 3600
+        for key in keys:
+            if key in self.claimed or now - self.entries.get(key, now - window) < window:
+                return False
+        self.claimed.update(keys)
+        return True
+
+    def release(self, keys):
+        self.claimed.difference_update(keys)
+
+    def prune(self, now):
+        """
+        Отбрасывает устаревшие ключи и оставляет не больше DEDUP_MAX_ENTRIES новых
+
+        Returns:
+            dict: Оставшиеся ключи для снимка
+        """
+        window = DEDUP_WINDOW_HOURS * 3600
+        fresh = [(timestamp, key) for key, timestamp in self.entries.items() if now - timestamp < window]
+        if len(fresh) > DEDUP_MAX_ENTRIES:
+            fresh = sorted(fresh, reverse=True)[:DEDUP_MAX_ENTRIES]
+        self.entries = {key: timestamp for timestamp, key in fresh}
+        return self.entries
+
+class StateJournal:
+    """
+    Состояние обработки: снимок в STATE_FILE и журнал изменений рядом с ним
+
+    Каждое изменение (сдвиг границы обработанных UID папки, постановка
+    уведомления в очередь отправки, его доставка с message_id Telegram или
+    удаление из очереди) дописывается в конец журнала одной
+    JSON строкой и сбрасывается на диск через fsync, поэтому фиксация
+    письма стоит одной короткой записи вместо перезаписи всего файла.
+    Снимок перезаписывается атомарно (временный файл, fsync, os.replace) при
+    сжатии журнала: в конце проверки и когда в журнале набирается
+    STATE_JOURNAL_MAX_RECORDS записей. Поэтому при запуске читается снимок
+    размером в число папок и ограниченный хвост журнала.
+
+    У записей журнала сквозной номер, в снимке хранится номер последней
+    учтенной записи: повторное применение журнала после сбоя посреди сжатия
+    ничего не меняет. Оборванная при сбое последняя строка отбрасывается.
+    Записи о доставке хранятся, пока граница UID папки не пройдет письмо, и
+    не дают отправить уведомление второй раз, если процесс упал между
+    отправкой и сдвигом границы. Ключи повторов из записей о доставке
+    попадают в DedupIndex и хранятся в снимке отдельно от папок.
+
+    Очередь отправки (outbox) - уведомления, которые еще не доставлены в
+    Telegram. Уведомление ставится в очередь до того, как граница UID
+    проходит письмо, и удаляется из очереди записью о доставке, поэтому
+    недоставленное уведомление переживает перезапуск и сохраняется в снимке
+    вместе с состоянием папок. На диск попадают только папка, UIDVALIDITY,
+    UID писем и чат: STATE_FILE коммитится в репозиторий, а тема,
+    отправитель и отрывок письма туда попадать не должны. Текст хранится
+    только в памяти, после перезапуска его заново собирает
+    restore_notification_texts.
+
+    Письмо остается непрочитанным на месте, пока уведомление о нем не
+    доставлено. UID доставленных писем копятся в unflagged папки, пока
+    следующая проверка папки не пометит их прочитанными (и не перенесет в
+    PROCESSED_FOLDER) и не учтет это записью 'flagged'.
+
+    Args:
+        path (str): Путь к файлу снимка (журнал - тот же путь с расширением .journal)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.journal_path = os.path.splitext(path)[0] + '.journal'
+        self.lock = threading.Lock()
+        self.mailboxes = {}
+        self.dedup = DedupIndex()
+        self.outbox = {}
+        self.seq = 0
+        self.records = 0
+        self.journal = None
+        self.load_snapshot()
+        self.replay_journal()
+
+    def load_snapshot(self):
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            log_info("Файл состояния не найден, начинаем с начала")
+            return
+        except (OSError, ValueError) as e:
+            log_error(f"Ошибка чтения файла состояния: {e}")
+            return
+        if 'last_processed_id' in state and 'mailboxes' not in state:
+            # Старый формат хранил порядковый номер письма, который нельзя сопоставить с UID
+            log_warning("Файл состояния в старом формате, будет выполнена полная синхронизация")
+            return
+        self.seq = int(state.get('journal_seq', 0))
+        self.dedup = DedupIndex({key: int(timestamp) for key, timestamp in state.get('dedup', {}).items()})
+        for entry in state.get('outbox', []):
+            entry.setdefault('text', None)
+            self.outbox[int(entry['id'])] = entry
+        for mailbox, entry in state.get('mailboxes', {}).items():
+            try:
+                self.mailboxes[mailbox] = {
+                    'uidvalidity': int(entry['uidvalidity']),
+                    'last_uid': int(entry['last_uid']),
+                    'delivered': {int(uid): record for uid, record in entry.get('delivered', {}).items()},
+                    'unflagged': {int(uid) for uid in entry.get('unflagged', [])},
+                }
+            except (AttributeError, KeyError, TypeError, ValueError) as e:
+                log_error(f"Некорректное состояние папки {mailbox}: {e}")
+
+    def replay_journal(self):
+        try:
+            with open(self.journal_path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        valid = 0
+        for line in data.splitlines(keepends=True):
+            try:
+                if not line.endswith(b'\n'):
+                    raise ValueError("нет конца строки")
+                record = json.loads(line)
+            except ValueError:
+                break
+            valid += len(line)
+            self.records += 1
+            if record['seq'] > self.seq:
+                self.apply(record)
+                self.seq = record['seq']
+        if valid < len(data):
+            log_warning(f"Журнал состояния оборван, отброшено {len(data) - valid} байт")
+            with open(self.journal_path, 'r+b') as f:
+                f.truncate(valid)
+        if self.records:
+            log_info(f"Применено записей журнала состояния: {self.records}")
+
+    def apply(self, record):
+        """
+        Применяет запись журнала к состоянию в памяти
+        """
+        if record['op'] == 'queued':
+            self.outbox[record['seq']] = {
+                'id': record['seq'], 'mailbox': record['mailbox'], 'uidvalidity': record['uidvalidity'],
+                'uids': record['uids'], 'chat_id': record['chat_id'], 'digest': record.get('digest', False),
+                'time': record['time'], 'text': record.get('text'),
+            }
+            if record.get('keys'):
+                self.dedup.add(record['keys'], int(datetime.fromisoformat(record['time']).timestamp()))
+            return
+        if record['op'] == 'dropped':
+            self.outbox.pop(record['id'], None)
+            return
+        mailbox = self.mailboxes.get(record['mailbox'])
+        if record['op'] == 'flagged':
+            if mailbox is not None and mailbox['uidvalidity'] == record['uidvalidity']:
+                mailbox['unflagged'].difference_update(record['uids'])
+            return
+        if 'outbox' in record:
+            self.outbox.pop(record['outbox'], None)
+            if mailbox is not None and (mailbox['uidvalidity'] != record['uidvalidity']
+                                        or record['uid'] <= mailbox['last_uid']):
+                # Граница папки уже прошла письмо, пока уведомление ждало в очереди:
+                # запись о доставке не нужна, но письмо еще не помечено прочитанным
+                if mailbox['uidvalidity'] == record['uidvalidity']:
+                    mailbox['unflagged'].add(record['uid'])
+                return
+        if mailbox is None or mailbox['uidvalidity'] != record['uidvalidity']:
+            mailbox = {'uidvalidity': record['uidvalidity'], 'last_uid': 0, 'delivered': {}, 'unflagged': set()}
+            self.mailboxes[record['mailbox']] = mailbox
+        if record['op'] == 'state':
+            mailbox['last_uid'] = record['last_uid']
+            mailbox['delivered'] = {
+                uid: entry for uid, entry in mailbox['delivered'].items() if uid > record['last_uid']
+            }
+        else:
+            mailbox['delivered'][record['uid']] = {
+                'message_id': record.get('message_id'), 'chat_id': record.get('chat_id'), 'time': record.get('time'),
+            }
+            if 'outbox' in record:
+                mailbox['unflagged'].add(record['uid'])
+            if record.get('keys'):
+                self.dedup.add(record['keys'], int(datetime.fromisoformat(record['time']).timestamp()))
+
+    def append(self, records):
+        """
+        Дописывает записи в журнал одним fsync и применяет их
+
+        Args:
+            records (list): Записи {'op': 'state', 'delivered', 'queued', 'dropped' или 'flagged', ...}
+        """
+        with self.lock:
+            lines = []
+            for record in records:
+                self.seq += 1
+                record['seq'] = self.seq
+                # Текст уведомления остается только в памяти (см. описание класса)
+                saved = {key: value for key, value in record.items() if key != 'text'}
+                lines.append(json.dumps(saved, ensure_ascii=False).encode('utf-8') + b'\n')
+            if self.journal is None:
+                self.journal = open(self.journal_path, 'ab')
+            with metrics.span('journal'):
+                self.journal.write(b''.join(lines))
+                self.journal.flush()
+                os.fsync(self.journal.fileno())
+            for record in records:
+                self.apply(record)
+            self.records += len(records)
+            if self.records >= STATE_JOURNAL_MAX_RECORDS:
+                self.compact_locked()
+
+    def apply_unsaved(self, records):
+        """
+        Применяет записи только в памяти, если дописать их в журнал не удалось
+
+        Нужна для доставки: Telegram сообщение уже принял, и уведомление не
+        должно остаться в очереди и уйти снова. Снимок при следующем сжатии
+        запишет состояние уже без него.
+        """
+        with self.lock:
+            for record in records:
+                self.apply(record)
+
+    def set_text(self, entry_id, text):
+        """
+        Задает текст уведомления очереди, восстановленный после перезапуска (только в памяти)
+        """
+        with self.lock:
+            if entry_id in self.outbox:
+                self.outbox[entry_id]['text'] = text
+
+    def get(self, mailbox):
+        with self.lock:
+            return self.mailboxes.get(mailbox)
+
+    def delivered_uids(self, mailbox, uidvalidity):
+        """
+        UID писем папки, уведомления о которых уже доставлены или ждут в очереди отправки
+
+        Returns:
+            set: UID (str)
+        """
+        with self.lock:
+            uids = {
+                str(uid) for entry in self.outbox.values()
+                if entry['mailbox'] == mailbox and entry['uidvalidity'] == uidvalidity for uid in entry['uids']
+            }
+            entry = self.mailboxes.get(mailbox)
+            if entry is None or entry['uidvalidity'] != uidvalidity:
+                return uids
+            return uids | {str(uid) for uid in entry['delivered']} | {str(uid) for uid in entry['unflagged']}
+
+    def unflagged_uids(self, mailbox, uidvalidity=None):
+        """
+        UID писем папки, уведомления о которых доставлены, а сами письма еще не помечены прочитанными
+
+        Args:
+            uidvalidity (int): UIDVALIDITY папки (None - текущий из состояния)
+
+        Returns:
+            list: UID (int) по возрастанию
+        """
+        with self.lock:
+            entry = self.mailboxes.get(mailbox)
+            if entry is None or uidvalidity not in (None, entry['uidvalidity']):
+                return []
+            return sorted(entry['unflagged'])
+
+    def pending(self):
+        """
+        Недоставленные уведомления в порядке постановки в очередь
+
+        Returns:
+            list: Копии записей очереди
+        """
+        with self.lock:
+            return [dict(entry) for entry in self.outbox.values()]
+
+    def first_pending(self, chat_id):
+        """
+        Самое раннее недоставленное уведомление чата
+
+        Returns:
+            dict or None: Копия записи очереди
+        """
+        with self.lock:
+            for entry in self.outbox.values():
+                if entry['chat_id'] == chat_id:
+                    return dict(entry)
         return None
-    except Exception as e:
-        log_error(f"Неожиданная ошибка при загрузке состояния: {e}")
+
+    def claim_keys(self, keys):
+        with self.lock:
+            return self.dedup.claim(keys, time.time())
+
+    def release_keys(self, keys):
+        with self.lock:
+            self.dedup.release(keys)
+
+    def compact(self):
+        with self.lock:
+            self.compact_locked()
+
+    def compact_locked(self):
+        """
+        Атомарно перезаписывает снимок и удаляет учтенный в нем журнал
+        """
+        mailboxes = {}
+        for mailbox, entry in self.mailboxes.items():
+            mailboxes[mailbox] = {'uidvalidity': entry['uidvalidity'], 'last_uid': entry['last_uid']}
+            if entry['delivered']:
+                mailboxes[mailbox]['delivered'] = {str(uid): record for uid, record in entry['delivered'].items()}
+            if entry['unflagged']:
+                mailboxes[mailbox]['unflagged'] = sorted(entry['unflagged'])
+        state = {'mailboxes': mailboxes, 'journal_seq': self.seq}
+        dedup = self.dedup.prune(time.time())
+        if dedup:
+            state['dedup'] = dedup
+        if self.outbox:
+            state['outbox'] = [
+                {key: value for key, value in entry.items() if key != 'text'} for entry in self.outbox.values()
+            ]
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        fsync_directory(self.path)
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self.records = 0
+
+    def close(self):
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+_state_journal = None
+
+def get_state_journal():
+    """
+    Возвращает журнал состояния для текущего STATE_FILE, загружая его при первом обращении
+    """
+    global _state_journal
+    with STATE_LOCK:
+        if _state_journal is None or _state_journal.path != STATE_FILE:
+            if _state_journal is not None:
+                _state_journal.close()
+            _state_journal = StateJournal(STATE_FILE)
+        return _state_journal
+
+def load_processed_state(mailbox=IMAP_MAILBOX):
+    """
+    Загружает UIDVALIDITY и UID последнего обработанного письма папки
+    
+    Args:
+        mailbox (str): Имя папки IMAP
+
+    Returns:
+        dict or None: {'uidvalidity': int, 'last_uid': int} или None если состояния нет
+    """
+    entry = get_state_journal().get(mailbox)
+    if not entry:
         return None
+    result = {'uidvalidity': entry['uidvalidity'], 'last_uid': entry['last_uid']}
+    log_info(f"Загружено состояние {mailbox}: UIDVALIDITY {result['uidvalidity']}, UID {result['last_uid']}")
+    return result
 
-def save_processed_state(email_id):
+def save_processed_state(uidvalidity, last_uid, mailbox=IMAP_MAILBOX):
     """
-    Сохраняет ID обработанного письма в файл состояния
+    Сохраняет UIDVALIDITY и UID последнего обработанного письма папки
     
     Args:
-        email_id (str): ID обработанного письма
+        uidvalidity (int): UIDVALIDITY папки
+        last_uid (int): UID последнего обработанного письма
+        mailbox (str): Имя папки IMAP
+    """
+    try:
+        get_state_journal().append([
+            {'op': 'state', 'mailbox': mailbox, 'uidvalidity': uidvalidity, 'last_uid': last_uid},
+        ])
+        log_success(f"Сохранено состояние {mailbox}: UID {last_uid}")
+    except Exception as e:
+        log_error(f"Ошибка сохранения состояния: {e}")
+
+def queue_notifications(mailbox, uidvalidity, messages, digest=False):
+    """
+    Ставит уведомления в очередь отправки одной записью журнала с fsync
+
+    Args:
+        mailbox (str): Ключ папки
+        uidvalidity (int): UIDVALIDITY папки
+        messages (list): Тройки (текст, чат, уведомления о письмах в этом тексте)
+        digest (bool): Тексты - дайджесты (нужно, чтобы собрать текст заново после перезапуска)
+
+    Returns:
+        bool: True если очередь сохранена на диск
+    """
+    if not messages:
+        return True
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    try:
+        get_state_journal().append([
+            {'op': 'queued', 'mailbox': mailbox, 'uidvalidity': uidvalidity,
+             'uids': [int(notice['uid']) for notice in notices], 'chat_id': chat_id, 'text': text,
+             'time': timestamp, 'keys': [key for notice in notices for key in notice.get('dedup_keys', [])],
+             'digest': digest}
+            for text, chat_id, notices in messages
+        ])
+        return True
+    except Exception as e:
+        log_error(f"Ошибка записи очереди уведомлений: {e}")
+        return False
+
+def record_delivery(entry, message_id):
+    """
+    Записывает в журнал доставку уведомления из очереди (UID писем, message_id Telegram, время)
+
+    Если запись не удалась, доставка все равно учитывается в памяти: уведомление
+    уходит из очереди и не будет отправлено повторно этим процессом.
+
+    Args:
+        entry (dict): Запись очереди отправки
+        message_id (int): message_id отправленного сообщения
+
+    Returns:
+        bool: True если доставка сохранена на диск
+    """
+    timestamp = datetime.now().isoformat(timespec='seconds')
+    records = [
+        {'op': 'delivered', 'mailbox': entry['mailbox'], 'uidvalidity': entry['uidvalidity'], 'uid': uid,
+         'message_id': message_id, 'chat_id': entry['chat_id'], 'time': timestamp, 'outbox': entry['id']}
+        for uid in entry['uids']
+    ]
+    journal = get_state_journal()
+    try:
+        journal.append(records)
+        return True
+    except Exception as e:
+        log_error(f"Ошибка записи журнала доставки: {e}")
+        journal.apply_unsaved(records)
+        return False
+
+def drop_notification(entry):
+    """
+    Удаляет из очереди уведомление, которое Telegram отклонил окончательно
+
+    Args:
+        entry (dict): Запись очереди отправки
+
+    Returns:
+        bool: True если удаление сохранено на диск (в памяти уведомление удаляется всегда)
+    """
+    records = [{'op': 'dropped', 'id': entry['id']}]
+    journal = get_state_journal()
+    try:
+        journal.append(records)
+        return True
+    except Exception as e:
+        log_error(f"Ошибка записи очереди уведомлений: {e}")
+        journal.apply_unsaved(records)
+        return False
+
+def compact_state():
+    """
+    Сжимает журнал состояния в STATE_FILE (в конце проверки почты)
     """
     try:
-        with open(STATE_FILE, 'w', encoding='utf-8') as f:
-            json.dump({'last_processed_id': email_id}, f, ensure_ascii=False, indent=2)
-        log_success(f"Сохранено состояние: ID {email_id}")
+        get_state_journal().compact()
     except Exception as e:
         log_error(f"Ошибка сохранения состояния: {e}")
 
@@ -84,6 +850,9 @@ def decode_quoted_printable(text):
     """
     Декодирует quoted-printable строки
     """
+    # Без последовательностей вида =D0 декодировать нечего, пропускаем лишнее кодирование строки
+    if not QP_ESCAPE_RE.search(text):
+        return text
     try:
         # Декодируем quoted-printable
         decoded_bytes = quopri.decodestring(text.encode('utf-8'))
@@ -92,32 +861,252 @@ def decode_quoted_printable(text):
     except:
         return text
 
+@functools.lru_cache(maxsize=64)
+def lookup_codec(charset):
+    """
+    Возвращает каноническое имя кодека для объявленной кодировки
+
+    Результат кэшируется: в потоке писем встречается всего несколько кодировок.
+
+    Args:
+        charset (str): Кодировка из заголовка письма (например, "Windows-1251")
+
+    Returns:
+        str or None: Имя кодека Python или None, если кодировка неизвестна
+    """
+    if not charset:
+        return None
+    try:
+        return codecs.lookup(charset.strip().strip('"\'').lower()).name
+    except LookupError:
+        return None
+
+def is_valid_text(sample, codec):
+    """
+    Проверяет, что фрагмент без ошибок декодируется кодеком
+
+    Фрагмент может обрываться посреди многобайтового символа, поэтому
+    используется инкрементальный декодер без завершения.
+    """
+    try:
+        codecs.getincrementaldecoder(codec)('strict').decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+def detect_charset(payload, declared=None):
+    """
+    Определяет кодировку тела письма
+
+    Основой служит объявленная кодировка. Проверяется только начало тела
+    (CHARSET_SAMPLE_SIZE байт), поэтому время не зависит от размера письма.
+    Письма с неверно указанной или отсутствующей кодировкой распознаются:
+    UTF-8 - по корректности последовательностей, windows-1251 и koi8-r - по
+    тому, в какой половине верхней таблицы больше букв (строчные буквы в
+    них лежат в разных диапазонах).
+
+    Args:
+        payload (bytes or memoryview): Тело части после снятия transfer-encoding
+        declared (str): Объявленная кодировка
+
+    Returns:
+        str: Имя кодека Python
+    """
+    codec = lookup_codec(declared)
+    sample = bytes(payload[:CHARSET_SAMPLE_SIZE])
+    if sample.isascii():
+        return codec or 'utf-8'
+    if codec and is_valid_text(sample, codec):
+        # Однобайтовые кодировки принимают любые байты, поэтому UTF-8 с
+        # ошибочной меткой windows-1251 проверяем отдельно
+        if codec in SINGLE_BYTE_CYRILLIC and is_valid_text(sample, 'utf-8'):
+            return 'utf-8'
+        return codec
+    if is_valid_text(sample, 'utf-8'):
+        return 'utf-8'
+    if len(sample.translate(None, HIGH_UPPER_ONLY)) > len(sample.translate(None, HIGH_LOWER_ONLY)):
+        return 'koi8-r'
+    return 'cp1251'
+
+def decode_transfer_encoding(body_bytes, transfer_encoding):
+    """
+    Снимает Content-Transfer-Encoding с тела части
+
+    Для 7bit/8bit/binary тело не копируется: возвращается memoryview на
+    исходные байты, полученные от сервера.
+
+    Args:
+        body_bytes (bytes): Тело части в том виде, как его вернул сервер
+        transfer_encoding (str): Значение Content-Transfer-Encoding
+
+    Returns:
+        bytes or memoryview: Раскодированное тело
+    """
+    transfer_encoding = (transfer_encoding or '7bit').strip().lower()
+    if transfer_encoding == 'base64':
+        try:
+            return binascii.a2b_base64(body_bytes)
+        except binascii.Error:
+            # Оборванное или неверно дополненное тело: декодируем целые группы
+            data = re.sub(rb'[^A-Za-z0-9+/]', b'', body_bytes)
+            return binascii.a2b_base64(data[:len(data) - len(data) % 4])
+    if transfer_encoding == 'quoted-printable':
+        # Тело, обрезанное окном загрузки, может кончаться половиной escape-последовательности
+        # ("=D"): ее байты испортили бы UTF-8, и кодировка определилась бы неверно
+        cut = body_bytes.rfind(b'=', len(body_bytes) - 2)
+        return binascii.a2b_qp(body_bytes[:cut] if cut != -1 else body_bytes)
+    return memoryview(body_bytes)
+
+def decode_body_text(payload, charset, content_type, max_length=None):
+    """
+    Декодирует текстовую часть письма один раз с учетом ее кодировки
+
+    Args:
+        payload (bytes or memoryview): Тело части после снятия transfer-encoding
+        charset (str): Объявленная кодировка части
+        content_type (str): text/plain или text/html
+        max_length (int): Сколько символов текста HTML части нужно (None - весь текст)
+
+    Returns:
+        str: Текст части
+    """
+    encoding = detect_charset(payload, charset)
+    if content_type == 'text/html':
+        return extract_html_preview(payload, max_length, encoding)
+    return str(payload, encoding, 'ignore')
+
 def extract_plain_text_from_html(html_text):
     """
     Извлекает чистый текст из HTML, убирая все теги
     """
     try:
         # Убираем HTML теги
-        clean_text = re.sub(r'<[^>]+>', '', html_text)
-        # Убираем множественные пробелы и переносы
-        clean_text = re.sub(r'\s+', ' ', clean_text)
-        # Убираем служебные HTML символы
-        clean_text = re.sub(r'&nbsp;', ' ', clean_text)
-        clean_text = re.sub(r'&amp;', '&', clean_text)
-        clean_text = re.sub(r'&lt;', '<', clean_text)
-        clean_text = re.sub(r'&gt;', '>', clean_text)
-        clean_text = re.sub(r'&quot;', '"', clean_text)
-        clean_text = clean_text.strip()
-        return clean_text
+        clean_text = HTML_TAG_RE.sub('', html_text)
+        # Раскрываем все именованные и числовые сущности (&nbsp;, &laquo;, &#8470; ...)
+        if '&' in clean_text:
+            clean_text = html.unescape(clean_text)
+        # Убираем множественные пробелы и переносы (включая неразрывные)
+        return ' '.join(clean_text.split())
     except:
         return html_text
 
-def clean_telegram_text(text):
+class HTMLTextExtractor(HTMLParser):
+    """
+    Потоковый извлекатель текста из HTML
+
+    Пропускает содержимое style/script, считает блочные элементы границей
+    слов и сразу схлопывает пробелы. Как только набрано max_length символов,
+    выставляет флаг done, и дальнейший разбор документа не нужен.
+
+    Args:
+        max_length (int): Сколько символов текста нужно (None - весь документ)
+    """
+
+    def __init__(self, max_length=None):
+        super().__init__(convert_charrefs=True)
+        self.max_length = max_length
+        self.parts = []
+        self.length = 0
+        self.skip_depth = 0
+        self.pending_space = False
+        self.done = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in HTML_SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in HTML_BLOCK_TAGS:
+            self.pending_space = True
+
+    def handle_endtag(self, tag):
+        if tag in HTML_SKIP_TAGS:
+            self.skip_depth = max(0, self.skip_depth - 1)
+        elif tag in HTML_BLOCK_TAGS:
+            self.pending_space = True
+
+    def handle_data(self, data):
+        if self.skip_depth or self.done:
+            return
+        words = data.split()
+        if not words:
+            self.pending_space = self.pending_space or bool(data)
+            return
+        if self.parts and (self.pending_space or data[0].isspace()):
+            self.parts.append(' ')
+            self.length += 1
+        text = ' '.join(words)
+        self.parts.append(text)
+        self.length += len(text)
+        self.pending_space = data[-1].isspace()
+        if self.max_length is not None and self.length >= self.max_length:
+            self.done = True
+
+    def get_text(self):
+        """
+        Returns:
+            str: Извлеченный текст
+        """
+        return ''.join(self.parts)
+
+def extract_html_preview(html_bytes, max_length=None, encoding='utf-8'):
+    """
+    Извлекает текст из HTML части письма, разбирая ее по частям
+
+    Байты декодируются и разбираются порциями по HTML_CHUNK_SIZE, и разбор
+    останавливается, как только набран нужный объем текста, поэтому время и
+    память ограничены размером отрывка, а не размером письма с инлайн-стилями
+    и таблицами.
+
+    Args:
+        html_bytes (bytes): Тело HTML части
+        max_length (int): Сколько символов текста нужно (None - весь текст)
+        encoding (str): Кодировка HTML части
+
+    Returns:
+        str: Текст без HTML разметки
+    """
+    decoder = codecs.getincrementaldecoder(encoding)(errors='ignore')
+    extractor = HTMLTextExtractor(max_length)
+    view = memoryview(html_bytes)
+    offset = 0
+    chunk_size = HTML_CHUNK_SIZE
+    while offset < len(view):
+        extractor.feed(decoder.decode(view[offset:offset + chunk_size]))
+        if extractor.done:
+            return extractor.get_text()
+        offset += chunk_size
+        # Внутри style/script парсер копит содержимое до закрывающего тега и
+        # просматривает его заново на каждой порции, поэтому порции растут
+        chunk_size = chunk_size * 2 if extractor.skip_depth else HTML_CHUNK_SIZE
+    extractor.feed(decoder.decode(b'', final=True))
+    extractor.close()
+    return extractor.get_text()
+
+def truncate_raw_text(text, limit):
+    """
+    Обрезает исходный текст до очистки, не оставляя на конце оборванный тег,
+    HTML сущность или quoted-printable последовательность
+
+    Args:
+        text (str): Исходный текст
+        limit (int): Максимальная длина
+
+    Returns:
+        str: Обрезанный текст
+    """
+    if len(text) <= limit:
+        return text
+    return TRUNCATED_TAIL_RE.sub('', text[:limit])
+
+def clean_telegram_text(text, max_length=None):
     """
     Очищает текст от символов, которые могут сломать разметку Telegram
     
+    Таблица замен и регулярные выражения собираются один раз при импорте.
+
     Args:
         text (str): Исходный текст
+        max_length (int): Если задано, очищается только начало текста, которого
+            достаточно для результата длиннее max_length символов
         
     Returns:
         str: Очищенный текст
@@ -125,6 +1114,16 @@ def clean_telegram_text(text):
     if not text:
         return ""
     
+    if max_length is not None:
+        # Очистка не удлиняет текст, поэтому начинаем с запаса и расширяем его,
+        # только если после удаления разметки и пробелов текста не хватило
+        limit = max_length * 4
+        while True:
+            cleaned_text = clean_telegram_text(truncate_raw_text(text, limit))
+            if len(cleaned_text) > max_length or limit >= len(text):
+                return cleaned_text
+            limit *= 4
+    
     # Декодируем quoted-printable строки (например, =D0=9C=D0=BE=D0=B9)
     cleaned_text = decode_quoted_printable(text)
     
@@ -133,35 +1132,11 @@ def clean_telegram_text(text):
         cleaned_text = extract_plain_text_from_html(cleaned_text)
     
     # Заменяем проблемные символы Markdown на безопасные аналоги
-    replacements = {
-        '*': '•',
-        '_': '—',
-        '`': "'",
-        '[': '(',
-        ']': ')',
-        '~': '≈',
-        '#': '№',
-        '=': '═',
-        '|': '│',
-        '{': '❴',
-        '}': '❵',
-        '>': '›',
-        '<': '‹',
-        '?': '？',
-        '&': 'и',
-        ';': ',',
-        ':': 'ː',
-        '!': '❗'
-    }
-    
-    for old, new in replacements.items():
+    for old, new in TELEGRAM_TEXT_REPLACEMENTS:
         cleaned_text = cleaned_text.replace(old, new)
     
     # Убираем множественные пробелы и переносы
-    cleaned_text = re.sub(r'\s+', ' ', cleaned_text)
-    cleaned_text = cleaned_text.strip()
-    
-    return cleaned_text
+    return ' '.join(cleaned_text.split())
 
 def decode_email_header(header):
     """
@@ -171,15 +1146,14 @@ def decode_email_header(header):
         return ""
     
     try:
+        from email.header import decode_header
         decoded_parts = decode_header(header)
         decoded_text = ""
         
         for part, encoding in decoded_parts:
             if isinstance(part, bytes):
-                if encoding:
-                    decoded_text += part.decode(encoding, errors='ignore')
-                else:
-                    decoded_text += part.decode('utf-8', errors='ignore')
+                codec = lookup_codec(encoding) or detect_charset(part)
+                decoded_text += part.decode(codec, errors='ignore')
             else:
                 decoded_text += str(part)
         
@@ -207,320 +1181,2961 @@ def extract_email_from_sender(sender_raw):
     except:
         return sender_raw
 
-def check_email_criteria(subject, sender_raw):
+def normalize_match_text(text):
     """
-    Проверяет письмо на соответствие критериям фильтрации
-    
+    Приводит текст к виду для сравнения с правилами
+
+    NFKC сводит совместимые варианты символов (полноширинные знаки, лигатуры,
+    неразрывные пробелы) к обычным, casefold убирает различия в регистре.
+    """
+    return unicodedata.normalize('NFKC', text).casefold()
+
+def notice_dedup_keys(message_id, subject):
+    """
+    Ключи, по которым повтор уведомления узнается в другом ящике или письме
+
+    Копия письма в другом ящике имеет тот же Message-ID, а повторное
+    уведомление суда по тому же делу - новый Message-ID, но тот же номер дела
+    и тему. Ключи хэшируются, чтобы снимок состояния не рос от длинных строк.
+
     Args:
-        subject (str): Тема письма
-        sender_raw (str): Исходная строка отправителя
-        
+        message_id (str): Заголовок Message-ID (может быть пустым)
+        subject (str): Декодированная тема письма
+
     Returns:
-        bool: True если письмо подходит под критерии
+        list: Хэши ключей в hex
     """
-    # Извлекаем email из отправителя
-    sender_email = extract_email_from_sender(sender_raw)
-    
-    # Расширенная проверка отправителя
-    is_target_sender = False
-    
-    # Проверяем разные варианты отображения отправителя
-    sender_checks = [
-        TARGET_SENDER.lower() in sender_raw.lower(),           # Прямое вхождение в оригинальную строку
-        TARGET_SENDER.lower() in sender_email.lower(),         # Прямое вхождение в извлеченный email
-        'arbitr.ru' in sender_raw.lower(),                     # Домен arbitr.ru в оригинальной строке
-        'arbitr.ru' in sender_email.lower(),                   # Домен arbitr.ru в извлеченном email
-        'арбитр' in sender_raw.lower(),                        # Слово "арбитр" в оригинальной строке
-        'арбитр' in sender_email.lower()                       # Слово "арбитр" в извлеченном email
-    ]
-    
-    is_target_sender = any(sender_checks)
-    
-    # Проверяем тему на наличие ключевых слов
-    is_target_subject = any(
-        keyword.lower() in subject.lower() 
-        for keyword in TARGET_SUBJECT_KEYWORDS 
-        if keyword.strip()
-    )
-    
-    log_info(f"Отправитель оригинальный: {sender_raw}")
-    log_info(f"Отправитель извлеченный: {sender_email}")
-    log_info(f"Критерии проверки: отправитель={is_target_sender}, тема={is_target_subject}")
-    
-    return is_target_sender and is_target_subject
+    keys = []
+    message_id = (message_id or '').strip().strip('<>')
+    if message_id:
+        keys.append('mid:' + message_id)
+    case = CASE_NUMBER_RE.search(subject)
+    if case:
+        keys.append('case:' + case.group().upper() + '|' + ' '.join(normalize_match_text(subject).split()))
+    return [hashlib.blake2b(key.encode('utf-8'), digest_size=DEDUP_KEY_SIZE).hexdigest() for key in keys]
 
-def send_telegram_message(subject, sender_clean, body_preview, email_id):
+def default_rules():
     """
-    Отправляет сообщение в Telegram
-    
-    Args:
-        subject (str): Тема письма
-        sender_clean (str): Очищенный отправитель письма
-        body_preview (str): Преview текста письма
-        email_id (str): ID письма
-        
+    Правило из переменных окружения TARGET_SENDER / TARGET_SUBJECT_KEYWORDS
+
+    Повторяет прежнюю фильтрацию: отправитель содержит TARGET_SENDER или слово
+    "арбитр" либо пишет с домена arbitr.ru, тема содержит одно из ключевых слов.
+    """
+    return [{
+        'name': 'default',
+        'senders': [],
+        'sender_domains': [TARGET_SENDER_DOMAIN],
+        'sender_keywords': [TARGET_SENDER.strip()] + list(TARGET_SENDER_KEYWORDS),
+        'subject_keywords': [keyword.strip() for keyword in TARGET_SUBJECT_KEYWORDS if keyword.strip()],
+        'body_regex': '',
+        'chat_id': '',
+        'template': '',
+    }]
+
+def load_rules():
+    """
+    Загружает правила фильтрации из RULES_FILE
+
+    Формат файла:
+        {"rules": [{"name": "kad", "senders": ["guard@arbitr.ru"], "sender_domains": ["arbitr.ru"],
+                    "sender_keywords": ["арбитр"], "subject_keywords": ["А40-12345/2025"],
+                    "body_regex": "судебное заседание", "chat_id": "-100123",
+                    "template": "⚖️ {subject}\\n{body}"}]}
+
+    Отправитель подходит, если совпал адрес из senders, домен адреса (или его
+    поддомен) из sender_domains или строка From содержит одно из sender_keywords.
+    Тема подходит, если содержит одно из subject_keywords. Пустая группа
+    условий не проверяется. body_regex проверяется по началу текста письма.
+    Срабатывает первое подошедшее правило, его chat_id и template (поля
+    {subject}, {sender}, {body}, {uid}, {time}) заменяют чат ящика и
+    стандартный текст уведомления.
+
     Returns:
-        bool: True если отправка успешна, False в случае ошибки
+        list: Правила в порядке приоритета
+
+    Raises:
+        ValueError: Если файл некорректен
     """
-    log_info("Отправка уведомления в Telegram...")
-    
+    if not RULES_FILE:
+        return default_rules()
     try:
-        # Очищаем и декодируем текст
-        subject_clean = decode_email_header(subject)
-        body_clean = clean_telegram_text(body_preview)
-        
-        # Обрезаем слишком длинный текст
-        if len(body_clean) > 150:
-            body_clean = body_clean[:147] + "..."
-        
-        # Формируем сообщение
-        message = (
-            f"⚖️ НОВОЕ УВЕДОМЛЕНИЕ ОТ АРБИТРАЖНОГО СУДА\n\n"
-            f"📩 ОТ: {sender_clean}\n"
-            f"📋 ТЕМА: {subject_clean}\n"
-            f"🔔 СТАТУС: Предоставлен доступ к материалам дела\n"
-            f"📖 ОТРЫВОК: {body_clean}\n\n"
-            f"📧 ID ПИСЬМА: {email_id}\n"
-            f"🕒 ВРЕМЯ: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-        )
-        
-        url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
+        with open(RULES_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Не удалось прочитать {RULES_FILE}: {e}")
+
+    rules = []
+    for index, entry in enumerate(config.get('rules', []), 1):
+        rule = {'name': str(entry.get('name') or f"rule{index}")}
+        for field in RULE_LIST_FIELDS:
+            rule[field] = [str(value).strip() for value in entry.get(field) or [] if str(value).strip()]
+        rule['body_regex'] = entry.get('body_regex') or ''
+        rule['chat_id'] = str(entry.get('chat_id') or '')
+        rule['template'] = entry.get('template') or ''
+        if not any(rule[field] for field in RULE_CONDITION_FIELDS):
+            raise ValueError(f"В {RULES_FILE} у правила {rule['name']} нет ни одного условия")
+        try:
+            re.compile(rule['body_regex'])
+        except re.error as e:
+            raise ValueError(f"В {RULES_FILE} у правила {rule['name']} неверный body_regex: {e}")
+        try:
+            rule['template'].format(**{field: '' for field in NOTIFICATION_TEMPLATE_FIELDS})
+        except (KeyError, IndexError, ValueError) as e:
+            raise ValueError(f"В {RULES_FILE} у правила {rule['name']} неверный шаблон: {e}")
+        rules.append(rule)
+    if not rules:
+        raise ValueError(f"В {RULES_FILE} нет ни одного правила")
+    names = [rule['name'] for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError(f"В {RULES_FILE} повторяются имена правил")
+    return rules
+
+class KeywordMatcher:
+    """
+    Поиск всех ключевых слов в тексте одним регулярным выражением
+
+    Ключевые слова собираются в префиксное дерево, которое компилируется в
+    одно выражение: на каждой позиции текста движок re идет только по ветке
+    дерева для очередного символа, поэтому время поиска почти не зависит от
+    числа слов. Опережающая проверка (?=...) находит вхождения с каждой
+    позиции, в том числе перекрывающиеся. С одной позиции находится самое
+    длинное слово, более короткие слова с той же позиции - его начало и
+    учитываются заранее посчитанной маской.
+
+    Args:
+        keyword_masks (dict): {ключевое слово: битовая маска правил}
+    """
+
+    def __init__(self, keyword_masks):
+        trie = {}
+        for keyword in keyword_masks:
+            node = trie
+            for char in keyword:
+                node = node.setdefault(char, {})
+            node[''] = {}
+        self.masks = {}
+        for keyword in keyword_masks:
+            mask = 0
+            for end in range(1, len(keyword) + 1):
+                mask |= keyword_masks.get(keyword[:end], 0)
+            self.masks[keyword] = mask
+        self.pattern = re.compile(f"(?=({self.trie_pattern(trie)}))") if trie else None
+
+    @classmethod
+    def trie_pattern(cls, node):
+        """
+        Регулярное выражение для поддерева префиксного дерева
+        """
+        branches = [re.escape(char) + cls.trie_pattern(child) for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        pattern = branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+        # Слово может закончиться в этом узле: продолжение необязательно, но жадно
+        return f"(?:{pattern})?" if '' in node else pattern
+
+    def match(self, text):
+        """
+        Returns:
+            int: Объединение масок всех найденных ключевых слов
+        """
+        mask = 0
+        if self.pattern is not None:
+            for found in self.pattern.findall(text):
+                mask |= self.masks[found]
+        return mask
+
+class RuleSet:
+    """
+    Правила фильтрации, скомпилированные один раз
+
+    Каждое правило - бит целого числа. Для письма считаются маски правил,
+    которым подходит отправитель (словари адресов и доменов плюс поиск
+    ключевых слов в строке From) и тема (поиск ключевых слов), результат -
+    младший бит их пересечения. Текст приводится к NFKC и casefold.
+
+    Args:
+        rules (list): Правила из load_rules
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.addresses = {}
+        self.domains = {}
+        self.any_sender = 0
+        self.any_subject = 0
+        sender_keywords = {}
+        subject_keywords = {}
+        for index, rule in enumerate(rules):
+            bit = 1 << index
+            for address in rule['senders']:
+                key = normalize_match_text(address)
+                self.addresses[key] = self.addresses.get(key, 0) | bit
+            for domain in rule['sender_domains']:
+                key = normalize_match_text(domain).lstrip('@.')
+                self.domains[key] = self.domains.get(key, 0) | bit
+            for keyword in rule['sender_keywords']:
+                key = normalize_match_text(keyword)
+                sender_keywords[key] = sender_keywords.get(key, 0) | bit
+            for keyword in rule['subject_keywords']:
+                # Тема проверяется после очистки для Telegram, ключевые слова очищаются так же
+                key = normalize_match_text(clean_telegram_text(keyword))
+                subject_keywords[key] = subject_keywords.get(key, 0) | bit
+            if not (rule['senders'] or rule['sender_domains'] or rule['sender_keywords']):
+                self.any_sender |= bit
+            if not rule['subject_keywords']:
+                self.any_subject |= bit
+        self.sender_matcher = KeywordMatcher(sender_keywords)
+        self.subject_matcher = KeywordMatcher(subject_keywords)
+        self.body_patterns = {
+            rule['name']: re.compile(rule['body_regex'], re.IGNORECASE) for rule in rules if rule['body_regex']
+        }
+
+    def match(self, subject, sender_raw):
+        """
+        Находит первое правило, под которое подходят тема и отправитель
+
+        Returns:
+            dict or None: Правило или None, если письмо не подошло
+        """
+        address = normalize_match_text(extract_email_from_sender(sender_raw))
+        senders = self.any_sender | self.addresses.get(address, 0)
+        senders |= self.sender_matcher.match(normalize_match_text(sender_raw))
+        domain = address.rpartition('@')[2]
+        while domain:
+            senders |= self.domains.get(domain, 0)
+            domain = domain.partition('.')[2]
+        if not senders:
+            return None
+        candidates = senders & (self.any_subject | self.subject_matcher.match(normalize_match_text(subject)))
+        if not candidates:
+            return None
+        return self.rules[(candidates & -candidates).bit_length() - 1]
+
+    def needs_body(self, rule_name):
+        return rule_name in self.body_patterns
+
+    def body_matches(self, rule_name, body):
+        """
+        Проверяет текст письма по body_regex правила (правило без него подходит всегда)
+        """
+        pattern = self.body_patterns.get(rule_name)
+        return pattern is None or pattern.search(unicodedata.normalize('NFKC', body)) is not None
+
+_rule_set = None
+
+def get_rule_set():
+    """
+    Возвращает правила фильтрации, компилируя их при первом обращении
+
+    Raises:
+        ValueError: Если RULES_FILE некорректен
+    """
+    global _rule_set
+    if _rule_set is None:
+        _rule_set = RuleSet(load_rules())
+    return _rule_set
+
+def check_email_criteria(subject, sender_raw):
+    """
+    Проверяет письмо на соответствие правилам фильтрации
+    
+    Args:
+        subject (str): Тема письма
+        sender_raw (str): Исходная строка отправителя
+        
+    Returns:
+        dict or None: Первое подошедшее правило или None
+    """
+    rule = get_rule_set().match(subject, sender_raw)
+    log_debug("Отправитель оригинальный: %s", sender_raw)
+    log_debug("Правило фильтрации: %s", rule['name'] if rule else 'нет')
+    return rule
+
+class TokenBucket:
+    """
+    Ограничитель частоты по алгоритму token bucket
+
+    Используется из одного цикла событий: ожидание токена не блокирует
+    остальные ящики и чаты.
+
+    Args:
+        rate (float): Скорость пополнения, токенов в секунду
+        capacity (int): Максимальный запас токенов (допустимый всплеск)
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        """
+        Ждет появления токена и забирает его
+        """
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if now >= self.paused_until and self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep(max(self.paused_until - now, (1 - self.tokens) / self.rate))
+
+    def pause(self, seconds):
+        """
+        Запрещает отправку на заданное время (после ответа 429)
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+async def read_http_response(reader):
+    """
+    Читает ответ HTTP/1.1: тело по Content-Length, chunked или до закрытия соединения
+
+    Returns:
+        tuple: (статус, заголовки с именами в нижнем регистре, тело)
+
+    Raises:
+        ValueError: Ответ не разбирается как HTTP (отправитель повторит его как ошибку соединения)
+    """
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionResetError("Соединение закрыто сервером")
+    parts = status_line.split()
+    if len(parts) < 2 or not parts[0].startswith(b'HTTP/') or not parts[1].isdigit():
+        raise ValueError(f"Некорректная строка статуса HTTP: {status_line[:100]!r}")
+    status = int(parts[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            if size == 0:
+                while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                    pass
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        return status, headers, b''.join(chunks)
+    if 'content-length' in headers:
+        return status, headers, await reader.readexactly(int(headers['content-length']))
+    headers['connection'] = 'close'
+    return status, headers, await reader.read()
+
+class TelegramClient:
+    """
+    Асинхронный клиент Telegram Bot API с постоянными соединениями
+
+    Запросы идут по HTTP/1.1 keep-alive через пул не больше чем из
+    TELEGRAM_POOL_SIZE соединений, поэтому TCP и TLS соединение с
+    api.telegram.org переиспользуется между сообщениями, а ожидание ответа
+    не занимает поток. Частота отправки ограничивается token bucket для
+    каждого чата и общим лимитом бота, ответы 429 обрабатываются с ожиданием
+    retry_after.
+
+    Args:
+        token (str): Токен бота
+        api_url (str): Адрес Bot API (для тестов - локальная заглушка)
+        chat_rate (float): Допустимая частота сообщений в один чат, в секунду
+    """
+
+    def __init__(self, token, api_url=TELEGRAM_API_URL, chat_rate=TELEGRAM_CHAT_RATE):
+        url = urllib.parse.urlsplit(api_url)
+        self.host = url.hostname
+        self.use_ssl = url.scheme == 'https'
+        self.port = url.port or (443 if self.use_ssl else 80)
+        self.base_path = f"{url.path.rstrip('/')}/bot{token}"
+        self.chat_rate = chat_rate
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.idle_connections = []
+        self.slots = None
+        self.loop = None
+        self.retries = 0
+
+    def chat_bucket(self, chat_id):
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, TELEGRAM_CHAT_BURST)
+        return self.chat_buckets[chat_id]
+
+    def bind_loop(self):
+        """
+        Привязывает пул к текущему циклу событий
+
+        Соединения и семафор пула принадлежат циклу, в котором созданы: при
+        следующем asyncio.run (например, повторный check_email в бенчмарке)
+        пул начинается заново.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is not self.loop:
+            self.loop = loop
+            self.idle_connections = []
+            self.slots = asyncio.Semaphore(TELEGRAM_POOL_SIZE)
+
+    async def post(self, method, payload):
+        """
+        Выполняет запрос к Bot API по соединению из пула
+
+        Если сервер успел закрыть простаивающее keep-alive соединение, запрос
+        один раз повторяется по новому соединению.
+
+        Returns:
+            tuple: (HTTP статус, разобранный JSON ответа)
+        """
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        request = (
+            f"POST {self.base_path}/{method} HTTP/1.1\r\n"
+            f"Host: {self.host}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n"
+        ).encode('ascii') + body
+        self.bind_loop()
+        async with self.slots:
+            for attempt in range(2):
+                reused = bool(self.idle_connections)
+                if reused:
+                    reader, writer = self.idle_connections.pop()
+                else:
+                    reader, writer = await asyncio.open_connection(
+                        self.host, self.port, ssl=ssl.create_default_context() if self.use_ssl else None,
+                    )
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    status, headers, data = await read_http_response(reader)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt == 0:
+                        # Простаивавшие соединения, скорее всего, закрыты сервером все
+                        self.close()
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if headers.get('connection', '').lower() == 'close':
+                    writer.close()
+                else:
+                    self.idle_connections.append((reader, writer))
+                try:
+                    return status, json.loads(data or b'{}')
+                except ValueError:
+                    return status, {'description': data.decode('utf-8', errors='replace')}
+
+    async def send_message(self, chat_id, text):
+        """
+        Отправляет текстовое сообщение в чат
+
+        Args:
+            chat_id (str): ID чата
+            text (str): Текст сообщения (без parse_mode)
+
+        Returns:
+            dict or None: Отправленное сообщение из ответа API или None при ошибке
+        """
+        sent, _ = await self.try_send_message(chat_id, text)
+        return sent
+
+    async def try_send_message(self, chat_id, text):
+        """
+        Отправляет текстовое сообщение и сообщает, имеет ли смысл повтор при ошибке
+
+        Таймаут, обрыв соединения, ответ 5xx и 429 после TELEGRAM_MAX_RETRIES
+        повторов считаются временными ошибками, остальные ответы 4xx (чат не
+        найден, бот заблокирован) - постоянными.
+
+        Returns:
+            tuple: (отправленное сообщение или None, можно ли повторить отправку позже)
+        """
+        bucket = self.chat_bucket(chat_id)
         payload = {
-            'chat_id': TELEGRAM_CHAT_ID,
-            'text': message
+            'chat_id': chat_id,
+            'text': text
             # Не используем parse_mode для избежания проблем с разметкой
         }
+
+        for attempt in range(TELEGRAM_MAX_RETRIES + 1):
+            with metrics.span('throttle'):
+                await bucket.acquire()
+                await self.global_bucket.acquire()
+            try:
+                with metrics.span('send'):
+                    status, response = await asyncio.wait_for(self.post('sendMessage', payload), REQUEST_TIMEOUT)
+            except asyncio.TimeoutError:
+                log_error("Таймаут при отправке в Telegram")
+                metrics.inc('telegram_failed')
+                return None, True
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                log_error("Ошибка соединения с Telegram")
+                metrics.inc('telegram_failed')
+                return None, True
+            log_debug("Статус Telegram: %s", status)
+
+            if status == 200:
+                metrics.inc('telegram_sent')
+                return response.get('result', {}), False
+
+            if status == 429 and attempt < TELEGRAM_MAX_RETRIES:
+                try:
+                    retry_after = float(response.get('parameters', {}).get('retry_after', 1))
+                except (TypeError, ValueError):
+                    retry_after = 1.0
+                log_warning(f"Превышен лимит Telegram, повтор через {retry_after:.0f} с")
+                bucket.pause(retry_after)
+                self.retries += 1
+                metrics.inc('telegram_retries')
+                continue
+
+            log_error(f"Ошибка Telegram: {status} - {response.get('description', response)}")
+            metrics.inc('telegram_failed')
+            return None, status == 429 or status >= 500
+        return None, True
+
+    def close(self):
+        """
+        Закрывает простаивающие соединения пула
+        """
+        # После закрытия цикла событий его соединения уже закрыты вместе с ним
+        if self.loop is not None and not self.loop.is_closed():
+            for _, writer in self.idle_connections:
+                writer.close()
+        self.idle_connections = []
+
+_telegram_client = None
+
+def get_telegram_client():
+    """
+    Возвращает общий клиент Telegram, создавая его при первом обращении
+    """
+    global _telegram_client
+    if _telegram_client is None:
+        _telegram_client = TelegramClient(TELEGRAM_BOT_TOKEN)
+    return _telegram_client
+
+def format_notification(subject, sender_clean, body_preview, email_id, template=''):
+    """
+    Формирует текст уведомления о письме
+
+    Args:
+        template (str): Шаблон правила с полями {subject}, {sender}, {body},
+            {uid}, {time} (пусто - стандартный текст)
+    """
+    # Очищаем и декодируем текст
+    subject_clean = decode_email_header(subject)
+    body_clean = clean_telegram_text(body_preview, max_length=BODY_PREVIEW_LENGTH)
+    
+    # Обрезаем слишком длинный текст
+    if len(body_clean) > BODY_PREVIEW_LENGTH:
+        body_clean = body_clean[:BODY_PREVIEW_LENGTH - 3] + "..."
+    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    
+    if template:
+        message = template.format(
+            subject=subject_clean, sender=sender_clean, body=body_clean, uid=email_id, time=timestamp,
+        )
+        return message[:TELEGRAM_MAX_MESSAGE_LENGTH]
+    
+    return (
+        f"⚖️ НОВОЕ УВЕДОМЛЕНИЕ ОТ АРБИТРАЖНОГО СУДА\n\n"
+        f"📩 ОТ: {sender_clean}\n"
+        f"📋 ТЕМА: {subject_clean}\n"
+        f"🔔 СТАТУС: Предоставлен доступ к материалам дела\n"
+        f"📖 ОТРЫВОК: {body_clean}\n\n"
+        f"📧 ID ПИСЬМА: {email_id}\n"
+        f"🕒 ВРЕМЯ: {timestamp}"
+    )
+
+def format_digest_messages(notices):
+    """
+    Собирает дайджест из нескольких уведомлений
+
+    Если дайджест не помещается в одно сообщение Telegram (4096 символов),
+    он разбивается на несколько.
+
+    Args:
+        notices (list): Уведомления с ключами uid, subject, sender
+
+    Returns:
+        list: Пары (текст сообщения, уведомления в нем)
+    """
+    header = f"⚖️ НОВЫЕ УВЕДОМЛЕНИЯ ОТ АРБИТРАЖНОГО СУДА: {len(notices)}\n\n"
+    footer = f"\n🕒 ВРЕМЯ: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    messages = []
+    current = header
+    included = []
+    for index, notice in enumerate(notices, 1):
+        line = f"{index}. 📋 {notice['subject']}\n    📩 {notice['sender']} | 📧 ID {notice['uid']}\n"
+        if len(current) + len(line) + len(footer) > TELEGRAM_MAX_MESSAGE_LENGTH and current != header:
+            messages.append((current + footer, included))
+            current = header
+            included = []
+        current += line
+        included.append(notice)
+    messages.append((current + footer, included))
+    return messages
+
+async def send_telegram_message(subject, sender_clean, body_preview, email_id, chat_id=None, template=''):
+    """
+    Отправляет сообщение в Telegram
+    
+    Args:
+        subject (str): Тема письма
+        sender_clean (str): Очищенный отправитель письма
+        body_preview (str): Преview текста письма
+        email_id (str): ID письма
+        chat_id (str): Чат получателя (по умолчанию TELEGRAM_CHAT_ID)
+        template (str): Шаблон уведомления из правила фильтрации
         
-        response = requests.post(url, json=payload, timeout=REQUEST_TIMEOUT)
-        log_info(f"Статус Telegram: {response.status_code}")
-        
-        if response.status_code == 200:
-            log_success("Уведомление успешно отправлено в Telegram!")
+    Returns:
+        dict or None: Отправленное сообщение (с message_id) или None в случае ошибки
+    """
+    log_debug("Отправка уведомления о письме UID %s в Telegram", email_id)
+    
+    try:
+        message = format_notification(subject, sender_clean, body_preview, email_id, template)
+        sent = await get_telegram_client().send_message(chat_id or TELEGRAM_CHAT_ID, message)
+        if sent is None:
+            return None
+        log_debug("Уведомление о письме UID %s отправлено", email_id)
+        return sent
+    except Exception as e:
+        log_error(f"Неожиданная ошибка при отправке в Telegram: {e}")
+        return None
+
+def format_bytes(size):
+    """
+    Форматирует объем данных в читаемый вид
+    """
+    for unit in ('Б', 'КБ', 'МБ'):
+        if size < 1024 or unit == 'МБ':
+            return f"{size:.0f} {unit}" if unit == 'Б' else f"{size:.1f} {unit}"
+        size /= 1024
+
+def count_fetched_bytes(msg_data):
+    """
+    Подсчитывает объем данных в ответе IMAP FETCH
+    """
+    total = 0
+    for item in msg_data or []:
+        parts = item if isinstance(item, tuple) else (item,)
+        total += sum(len(part) for part in parts if isinstance(part, bytes))
+    return total
+
+def parse_imap_list(data):
+    """
+    Разбирает строку IMAP со списками в скобках во вложенные списки Python
+
+    Args:
+        data (bytes): Строка ответа сервера, например (UID 5 BODYSTRUCTURE (...))
+
+    Returns:
+        list: Вложенные списки строк, NIL превращается в None
+    """
+    stack = [[]]
+    for match in IMAP_TOKEN_RE.finditer(data):
+        opening, closing, quoted, atom = match.groups()
+        if opening:
+            stack.append([])
+        elif closing:
+            if len(stack) > 1:
+                item = stack.pop()
+                stack[-1].append(item)
+        elif quoted is not None:
+            value = re.sub(rb'\\(.)', rb'\1', quoted)
+            stack[-1].append(value.decode('utf-8', errors='replace'))
+        elif atom is not None:
+            value = atom.decode('utf-8', errors='replace')
+            stack[-1].append(None if value.upper() == 'NIL' else value)
+    while len(stack) > 1:
+        item = stack.pop()
+        stack[-1].append(item)
+    return stack[0]
+
+def parse_fetch_response(msg_data):
+    """
+    Группирует ответ IMAP FETCH по письмам
+
+    Литералы секций BODY[...] складываются отдельно, остальные элементы
+    (UID, FLAGS, BODYSTRUCTURE) разбираются в словарь атрибутов.
+
+    Args:
+        msg_data (list): Ответ imaplib на команду FETCH
+
+    Returns:
+        dict: {UID письма (или номер, если UID нет): {'attrs': dict, 'sections': {секция: bytes}}}
+    """
+    messages = {}
+    meta = {}
+    num = None
+
+    for item in msg_data or []:
+        head, literal = item if isinstance(item, tuple) else (item, None)
+        if not isinstance(head, bytes):
+            continue
+
+        start = FETCH_START_RE.match(head)
+        if start:
+            num = start.group(1).decode()
+            messages.setdefault(num, {'attrs': {}, 'sections': {}})
+            meta[num] = meta.get(num, b'') + b' '
+        if num is None:
+            continue
+        current = messages[num]
+
+        if literal is None:
+            meta[num] += head
+            continue
+
+        section = FETCH_LITERAL_RE.search(head)
+        if section:
+            current['sections'][section.group(1).decode().upper()] = literal
+            meta[num] += head[:section.start()]
+        else:
+            # Литерал внутри BODYSTRUCTURE (например, имя файла не в ASCII)
+            escaped = literal.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
+            meta[num] += LITERAL_SIZE_RE.sub(b'', head) + b'"' + escaped + b'"'
+
+    result = {}
+    for num, raw in meta.items():
+        parsed = parse_imap_list(raw)
+        items = parsed[1] if len(parsed) > 1 and isinstance(parsed[1], list) else []
+        attrs = messages[num]['attrs']
+        for index in range(0, len(items) - 1, 2):
+            if isinstance(items[index], str):
+                attrs[items[index].upper()] = items[index + 1]
+        if 'UID' in attrs:
+            result[attrs['UID']] = messages[num]
+        else:
+            result.setdefault(num, messages[num])
+
+    return result
+
+def get_fetched_section(fetched, prefix):
+    """
+    Возвращает литерал секции, имя которой начинается с prefix
+    """
+    for section, data in fetched['sections'].items():
+        if section.startswith(prefix):
+            return data
+    return None
+
+def iter_body_parts(structure, section=''):
+    """
+    Обходит BODYSTRUCTURE и возвращает листовые части с номерами секций
+
+    Yields:
+        tuple: (номер секции, описание части)
+    """
+    if structure and isinstance(structure[0], list):
+        index = 0
+        for child in structure:
+            if not isinstance(child, list):
+                break
+            index += 1
+            yield from iter_body_parts(child, f"{section}.{index}" if section else str(index))
+    elif structure:
+        yield section or '1', structure
+
+def is_attachment_part(part):
+    """
+    Проверяет, помечена ли часть BODYSTRUCTURE как вложение
+    """
+    for field in part[7:]:
+        if isinstance(field, list) and field and isinstance(field[0], str):
+            if field[0].lower() == 'attachment':
+                return True
+    return False
+
+def select_text_section(structure):
+    """
+    Выбирает секцию с текстом письма по BODYSTRUCTURE, не трогая вложения
+
+    Args:
+        structure (list): Разобранный BODYSTRUCTURE
+
+    Returns:
+        tuple: (номер секции, тип) части text/plain, иначе text/html, иначе (None, None)
+    """
+    html_section = None
+    for section, part in iter_body_parts(structure):
+        if len(part) < 2 or not all(isinstance(value, str) for value in part[:2]):
+            continue
+        content_type = f"{part[0]}/{part[1]}".lower()
+        if is_attachment_part(part):
+            continue
+        if content_type == 'text/plain':
+            return section, content_type
+        if content_type == 'text/html' and html_section is None:
+            html_section = section
+    return (html_section, 'text/html') if html_section else (None, None)
+
+def imap_quote(value):
+    """
+    Оборачивает ASCII строку в кавычки для команды IMAP
+    """
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+def build_or_criteria(keys):
+    """
+    Собирает из списка условий дерево OR в префиксной записи IMAP
+
+    Args:
+        keys (list): Условия, каждое - список токенов, например ['FROM', '"a@b.ru"']
+
+    Returns:
+        list: Токены вида OR FROM a OR FROM b FROM c
+    """
+    if not keys:
+        return []
+    criteria = list(keys[-1])
+    for key in reversed(keys[:-1]):
+        criteria = ['OR'] + list(key) + criteria
+    return criteria
+
+def build_search_queries(base_criteria):
+    """
+    Строит запросы SEARCH по отправителю и ключевым словам темы
+
+    Кириллические ключевые слова передаются литералом с CHARSET UTF-8.
+    Команда передает только один литерал, поэтому на каждое ключевое слово
+    строится отдельный запрос, а результаты объединяются.
+
+    Args:
+        base_criteria (list): Общие условия, например ['UNSEEN']
+
+    Returns:
+        list: Кортежи (charset, criteria, literal)
+    """
+    criteria = list(base_criteria)
+    if IMAP_SEARCH_SINCE_DAYS > 0:
+        since = datetime.now() - timedelta(days=IMAP_SEARCH_SINCE_DAYS)
+        criteria += ['SINCE', f"{since.day:02d}-{IMAP_MONTHS[since.month - 1]}-{since.year}"]
+
+    # Условия всех правил объединяются. Если у какого-то правила нет условия,
+    # которое можно проверить на сервере, сервер не фильтрует по этому признаку
+    rules = get_rule_set().rules
+    senders = []
+    keywords = []
+    for rule in rules:
+        rule_senders = rule['senders'] + rule['sender_domains'] + rule['sender_keywords']
+        # Отправителя с не-ASCII значением (кириллическое имя) FROM без литерала
+        # не найдет, а пропуск значения потерял бы письма: правило не сужает поиск
+        if not all(value.isascii() for value in rule_senders):
+            rule_senders = []
+        senders = None if senders is None or not rule_senders else senders + rule_senders
+        keywords = None if keywords is None or not rule['subject_keywords'] else keywords + rule['subject_keywords']
+    if senders:
+        # FROM ищет подстроку, поэтому значения, содержащие другое значение, лишние
+        senders = list(dict.fromkeys(sender.lower() for sender in senders))
+        senders = [sender for sender in senders if not any(other != sender and other in sender for other in senders)]
+        criteria += build_or_criteria([['FROM', imap_quote(sender)] for sender in senders])
+
+    if not keywords:
+        return [(None, criteria, None)]
+    keywords = list(dict.fromkeys(keywords))
+
+    queries = []
+    for keyword in keywords:
+        if keyword.isascii():
+            queries.append((None, criteria + ['SUBJECT', imap_quote(keyword)], None))
+        else:
+            queries.append(('UTF-8', criteria + ['SUBJECT'], keyword.encode('utf-8')))
+    return queries
+
+async def search_messages(mail, base_criteria):
+    """
+    Ищет письма на сервере командой UID SEARCH
+
+    В режиме IMAP_SERVER_SEARCH сервер сам отбирает кандидатов по отправителю,
+    теме и дате, иначе возвращаются все письма по base_criteria.
+
+    Args:
+        mail: IMAP соединение
+        base_criteria (list): Общие условия поиска
+
+    Returns:
+        list or None: UID найденных писем по возрастанию или None при ошибке
+    """
+    if not IMAP_SERVER_SEARCH:
+        status, messages = await mail.uid('SEARCH', *base_criteria)
+        return messages[0].split() if status == 'OK' else None
+
+    found = set()
+    for charset, criteria, literal in build_search_queries(base_criteria):
+        charset_args = ['CHARSET', charset] if charset else []
+        status, messages = await mail.uid('SEARCH', *charset_args, *criteria, literal=literal)
+        if status != 'OK':
+            return None
+        found.update(messages[0].split())
+    return sorted(found, key=int)
+
+def compress_uid_set(uids):
+    """
+    Сжимает список UID в набор IMAP с диапазонами
+
+    Args:
+        uids (list): UID в виде bytes, str или int
+
+    Returns:
+        str: Набор вида 1:5,9,12:20
+    """
+    numbers = sorted({int(uid) for uid in uids})
+    ranges = []
+    for number in numbers:
+        if ranges and number == ranges[-1][1] + 1:
+            ranges[-1][1] = number
+        else:
+            ranges.append([number, number])
+    return ','.join(str(start) if start == end else f"{start}:{end}" for start, end in ranges)
+
+def encode_mailbox_name(name):
+    """
+    Кодирует имя папки в modified UTF-7 (RFC 3501), например "Суд" -> "&BCEEQwQ0-"
+    """
+    result = []
+    pending = []
+
+    def flush():
+        if pending:
+            encoded = base64.b64encode(''.join(pending).encode('utf-16-be')).decode('ascii')
+            result.append('&' + encoded.rstrip('=').replace('/', ',') + '-')
+            pending.clear()
+
+    for char in name:
+        if 0x20 <= ord(char) <= 0x7e:
+            flush()
+            result.append('&-' if char == '&' else char)
+        else:
+            pending.append(char)
+    flush()
+    return ''.join(result)
+
+async def fetch_message_headers(mail, email_ids, stats):
+    """
+    Пакетно загружает только заголовки писем (без тел и вложений)
+
+    Args:
+        mail: IMAP соединение
+        email_ids (list): UID писем
+        stats (dict): Счетчики текущего запуска
+
+    Returns:
+        dict: {UID письма: email.message.Message с заголовками}
+    """
+    headers = {}
+    for start in range(0, len(email_ids), FETCH_BATCH_SIZE):
+        batch = email_ids[start:start + FETCH_BATCH_SIZE]
+        message_set = compress_uid_set(batch)
+        try:
+            status, msg_data = await mail.uid('FETCH', message_set, f'(BODY.PEEK[HEADER.FIELDS ({HEADER_FIELDS})])')
+            if status != 'OK':
+                log_error(f"Ошибка получения заголовков писем: {message_set}")
+                continue
+        except Exception as e:
+            log_error(f"Ошибка при получении заголовков писем: {e}")
+            continue
+
+        stats['bytes_fetched'] += count_fetched_bytes(msg_data)
+        for uid, fetched in parse_fetch_response(msg_data).items():
+            header_bytes = get_fetched_section(fetched, 'HEADER')
+            if header_bytes is not None:
+                headers[uid] = email.message_from_bytes(header_bytes)
+    return headers
+
+async def fetch_message_bodies(mail, email_ids, stats, truncated=None):
+    """
+    Пакетно загружает только текстовые части писем, определяя их по BODYSTRUCTURE
+
+    Структура всех писем запрашивается одной командой, затем тела загружаются
+    одной командой на каждую комбинацию секций (обычно у уведомлений суда она одна).
+    Вложения не загружаются вовсе, а от текстовой части берется только начало
+    (<0.TEXT_FETCH_WINDOW>, для HTML - HTML_FETCH_WINDOW): отрывку и body_regex
+    его обычно хватает, и память не зависит от размера письма. Если не хватило,
+    продолжение догружает extend_truncated_body.
+
+    Args:
+        mail: IMAP соединение
+        email_ids (list): UID писем
+        stats (dict): Счетчики текущего запуска
+        truncated (dict): Сюда записываются секции обрезанных частей {UID: секция}
+
+    Returns:
+        dict: {UID: (заголовки части, тело части) или None, если текстовой части нет}.
+            Письма, которые не удалось загрузить, в словарь не попадают.
+    """
+    result = {}
+    message_set = compress_uid_set(email_ids)
+    try:
+        status, msg_data = await mail.uid('FETCH', message_set, '(BODYSTRUCTURE)')
+        if status != 'OK':
+            log_error("Ошибка получения структуры писем")
+            return result
+        stats['bytes_fetched'] += count_fetched_bytes(msg_data)
+
+        groups = {}
+        for uid, fetched in parse_fetch_response(msg_data).items():
+            structure = fetched['attrs'].get('BODYSTRUCTURE')
+            section, content_type = select_text_section(structure) if isinstance(structure, list) else (None, None)
+            if not section:
+                log_warning(f"В письме UID {uid} нет текстовой части")
+                result[uid] = None
+                continue
+            # Для одночастного письма заголовки части совпадают с заголовками письма
+            mime_section = f"{section}.MIME" if isinstance(structure[0], list) else 'HEADER'
+            window = HTML_FETCH_WINDOW if content_type == 'text/html' else TEXT_FETCH_WINDOW
+            groups.setdefault((mime_section, section, window), []).append(uid)
+
+        for (mime_section, section, window), uids in groups.items():
+            status, msg_data = await mail.uid(
+                'FETCH', compress_uid_set(uids), f'(BODY.PEEK[{mime_section}] BODY.PEEK[{section}]<0.{window}>)',
+            )
+            if status != 'OK':
+                log_error("Ошибка получения текста писем")
+                continue
+            stats['bytes_fetched'] += count_fetched_bytes(msg_data)
+            for uid, fetched in parse_fetch_response(msg_data).items():
+                body_bytes = fetched['sections'].get(section)
+                if uid in uids and body_bytes is not None:
+                    if len(body_bytes) == window:
+                        metrics.inc('bodies_truncated')
+                        if truncated is not None:
+                            truncated[uid] = section
+                    result[uid] = (get_fetched_section(fetched, mime_section) or b'\r\n', body_bytes)
+    except Exception as e:
+        log_error(f"Ошибка при получении текста писем: {e}")
+    return result
+
+def parse_body_part(part_data, max_length=BODY_PREVIEW_LENGTH * 2):
+    """
+    Извлекает текст из загруженной текстовой части (выполняется в пуле потоков)
+
+    Args:
+        part_data (tuple or None): (заголовки части, тело части)
+        max_length (int): Сколько символов текста нужно
+
+    Returns:
+        str: Текст письма без HTML разметки
+    """
+    if part_data is None:
+        return UNREADABLE_BODY_TEXT
+    mime_headers, body_bytes = part_data
+    with metrics.span('parse'):
+        # Разбираются только заголовки части, тело декодируется напрямую без
+        # склейки с заголовками и повторного кодирования внутри пакета email
+        headers = email.message_from_bytes(mime_headers)
+        payload = decode_transfer_encoding(body_bytes, headers.get('Content-Transfer-Encoding'))
+        try:
+            # В уведомление попадает только отрывок, берем текст с запасом на очистку
+            body = decode_body_text(payload, headers.get_content_charset(), headers.get_content_type(), max_length)
+        except Exception as e:
+            log_warning(f"Ошибка декодирования части письма: {e}")
+            body = ""
+    return body.strip() or UNREADABLE_BODY_TEXT
+
+async def extend_truncated_body(mail, uid, section, part_data, max_length, stats):
+    """
+    Догружает продолжение обрезанной текстовой части, пока текста не хватает
+
+    Окно каждый раз удваивается: HTML с десятками килобайт стилей перед текстом
+    или кириллица в quoted-printable (до 9 байт на символ) не помещаются в
+    первое окно. Больше BODY_FETCH_LIMIT байт части не загружается.
+
+    Args:
+        mail: IMAP соединение
+        uid (str): UID письма
+        section (str): Секция текстовой части
+        part_data (tuple): (заголовки части, уже загруженное начало тела)
+        max_length (int): Сколько символов текста нужно
+        stats (dict): Счетчики текущего запуска
+
+    Returns:
+        tuple: (текст письма, True если он полный или его хватает)
+    """
+    loop = asyncio.get_running_loop()
+    mime_headers, body_bytes = part_data
+    body = bytearray(body_bytes)
+    window = len(body)
+    text = UNREADABLE_BODY_TEXT
+    while len(body) < BODY_FETCH_LIMIT:
+        window = min(window * 2, BODY_FETCH_LIMIT - len(body))
+        status, msg_data = await mail.uid('FETCH', uid, f'(BODY.PEEK[{section}]<{len(body)}.{window}>)')
+        if status != 'OK':
+            log_warning(f"Не удалось догрузить текст письма UID {uid}")
+            return text, False
+        stats['bytes_fetched'] += count_fetched_bytes(msg_data)
+        chunk = parse_fetch_response(msg_data).get(uid, {'sections': {}})['sections'].get(section) or b''
+        body += chunk
+        metrics.inc('bodies_extended')
+        text = await loop.run_in_executor(None, parse_body_part, (mime_headers, bytes(body)), max_length)
+        if len(chunk) < window or len(text) >= max_length:
+            return text, True
+    log_warning(f"Текст письма UID {uid} длиннее {format_bytes(BODY_FETCH_LIMIT)}, используется начало")
+    return text, False
+
+def process_email_message(email_id, headers, stats, matched=None):
+    """
+    Проверяет одно email сообщение по заранее загруженным заголовкам
+
+    Args:
+        email_id: UID письма
+        headers: Заголовки письма (From, Subject, Date, Message-ID)
+        stats (dict): Счетчики текущего запуска
+        matched (bool): Решение фильтра из кэша (None - проверить заново). Для
+            подошедших писем правило все равно определяется заново: нужны его
+            чат и шаблон, а скомпилированная проверка дешевле чтения кэша
+
+    Returns:
+        dict or None: Уведомление для отправки или None, если письмо не подошло
+    """
+    email_id_str = email_id.decode()
+    log_debug("Обработка письма UID: %s", email_id_str)
+
+    # Извлекаем тему
+    subject_raw = headers.get('Subject', 'Без темы')
+    subject_clean = decode_email_header(subject_raw)
+
+    # Извлекаем отправителя
+    sender_raw = headers.get('From', 'Неизвестный отправитель')
+    sender_clean = decode_email_header(sender_raw)
+
+    log_debug("Тема: %s", subject_clean)
+    log_debug("Отправитель (очищенный): %s", sender_clean)
+
+    # Проверяем критерии на оригинальном отправителе
+    rule = check_email_criteria(subject_clean, sender_raw) if matched is not False else None
+    if rule is None:
+        log_debug("Письмо не подходит под критерии фильтрации")
+        return None
+
+    log_debug("Письмо подходит под правило %s", rule['name'])
+    stats['matched'] += 1
+    
+    return {
+        'uid': email_id_str, 'subject': subject_clean, 'sender': sender_clean, 'body': None,
+        'rule': rule['name'], 'chat_id': rule['chat_id'], 'template': rule['template'],
+        'dedup_keys': notice_dedup_keys(headers.get('Message-ID'), subject_clean),
+    }
+
+class MessageCache:
+    """
+    Локальный кэш разобранных писем в SQLite
+
+    Ключ записи - (папка, UIDVALIDITY, UID), поэтому после смены UIDVALIDITY
+    старые записи просто перестают находиться и со временем вытесняются.
+    Хранятся заголовки From/Subject/Date, решение фильтра (вместе с отпечатком
+    критериев, при котором оно принято) и отрывок текста письма. Размер
+    ограничен max_entries записей, вытесняются давно не использованные (LRU).
+
+    Args:
+        path (str): Путь к файлу базы
+        max_entries (int): Максимальное число записей
+    """
+
+    def __init__(self, path, max_entries=MESSAGE_CACHE_SIZE):
+        import sqlite3
+
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " mailbox TEXT NOT NULL, uidvalidity INTEGER NOT NULL, uid INTEGER NOT NULL,"
+                " headers TEXT NOT NULL, criteria TEXT, matched INTEGER, preview TEXT,"
+                " accessed INTEGER NOT NULL,"
+                " PRIMARY KEY (mailbox, uidvalidity, uid))"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS messages_accessed ON messages (accessed)")
+        self.clock = self.db.execute("SELECT COALESCE(MAX(accessed), 0) FROM messages").fetchone()[0]
+
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def get_many(self, mailbox, uidvalidity, uids):
+        """
+        Возвращает закэшированные письма и отмечает их как недавно использованные
+
+        Returns:
+            dict: {UID (str): {'headers', 'criteria', 'matched', 'preview'}}
+        """
+        result = {}
+        uids = [int(uid) for uid in uids]
+        with self.lock, self.db:
+            accessed = self.tick()
+            for start in range(0, len(uids), CACHE_QUERY_BATCH_SIZE):
+                batch = uids[start:start + CACHE_QUERY_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch))
+                params = [mailbox, uidvalidity] + batch
+                rows = self.db.execute(
+                    f"SELECT uid, headers, criteria, matched, preview FROM messages"
+                    f" WHERE mailbox = ? AND uidvalidity = ? AND uid IN ({placeholders})", params,
+                ).fetchall()
+                self.db.execute(
+                    f"UPDATE messages SET accessed = ?"
+                    f" WHERE mailbox = ? AND uidvalidity = ? AND uid IN ({placeholders})", [accessed] + params,
+                )
+                for uid, headers, criteria, matched, preview in rows:
+                    result[str(uid)] = {
+                        'headers': json.loads(headers),
+                        'criteria': criteria,
+                        'matched': None if matched is None else bool(matched),
+                        'preview': preview,
+                    }
+        return result
+
+    def put_headers(self, mailbox, uidvalidity, headers_by_uid):
+        """
+        Сохраняет заголовки загруженных писем
+
+        Args:
+            headers_by_uid (dict): {UID: заголовки (email.message.Message или dict)}
+        """
+        with self.lock, self.db:
+            accessed = self.tick()
+            self.db.executemany(
+                "INSERT OR REPLACE INTO messages (mailbox, uidvalidity, uid, headers, accessed)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [
+                    (mailbox, uidvalidity, int(uid), json.dumps({
+                        name: str(headers[name]) for name in CACHED_HEADER_FIELDS if headers.get(name) is not None
+                    }, ensure_ascii=False), accessed)
+                    for uid, headers in headers_by_uid.items()
+                ],
+            )
+
+    def put_decisions(self, mailbox, uidvalidity, criteria, decisions):
+        """
+        Сохраняет решения фильтра
+
+        Args:
+            criteria (str): Отпечаток критериев фильтрации
+            decisions (list): Пары (UID, подошло ли письмо)
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE messages SET criteria = ?, matched = ? WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                [(criteria, int(matched), mailbox, uidvalidity, int(uid)) for uid, matched in decisions],
+            )
+
+    def put_previews(self, mailbox, uidvalidity, previews):
+        """
+        Сохраняет отрывки текста писем
+
+        Args:
+            previews (list): Пары (UID, отрывок текста)
+        """
+        with self.lock, self.db:
+            self.db.executemany(
+                "UPDATE messages SET preview = ? WHERE mailbox = ? AND uidvalidity = ? AND uid = ?",
+                [(preview, mailbox, uidvalidity, int(uid)) for uid, preview in previews],
+            )
+
+    def recent_matches(self, mailbox, limit):
+        """
+        Последние подошедшие под критерии письма текущего UIDVALIDITY папки
+
+        Returns:
+            list: Записи {'uid', 'headers', 'preview'} в порядке возрастания UID
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT uid, headers, preview FROM messages"
+                " WHERE mailbox = ? AND matched = 1 AND uidvalidity ="
+                " (SELECT MAX(uidvalidity) FROM messages WHERE mailbox = ?)"
+                " ORDER BY uid DESC LIMIT ?",
+                (mailbox, mailbox, limit),
+            ).fetchall()
+        return [
+            {'uid': str(uid), 'headers': json.loads(headers), 'preview': preview}
+            for uid, headers, preview in reversed(rows)
+        ]
+
+    def evict(self):
+        """
+        Удаляет давно не использованные записи сверх max_entries
+
+        Returns:
+            int: Количество удаленных записей
+        """
+        with self.lock, self.db:
+            count = self.db.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+            if count <= self.max_entries:
+                return 0
+            cursor = self.db.execute(
+                "DELETE FROM messages WHERE rowid IN"
+                " (SELECT rowid FROM messages ORDER BY accessed LIMIT ?)",
+                (count - self.max_entries,),
+            )
+            return cursor.rowcount
+
+    def close(self):
+        self.db.close()
+
+_message_cache = None
+
+def get_message_cache():
+    """
+    Возвращает общий кэш писем или None, если кэш отключен или недоступен
+    """
+    global _message_cache
+    if _message_cache is None and MESSAGE_CACHE_FILE:
+        import sqlite3
+
+        try:
+            _message_cache = MessageCache(MESSAGE_CACHE_FILE)
+        except sqlite3.Error as e:
+            log_warning(f"Кэш писем недоступен, работаем без него: {e}")
+            return None
+    return _message_cache
+
+def use_default_message_cache():
+    """
+    Включает кэш в DEFAULT_MESSAGE_CACHE_FILE, если MESSAGE_CACHE_FILE не задан
+
+    Вызывается режимами, в которых файл кэша переживает запуск (демон, --resend).
+    """
+    global MESSAGE_CACHE_FILE
+    if MESSAGE_CACHE_FILE is None:
+        MESSAGE_CACHE_FILE = DEFAULT_MESSAGE_CACHE_FILE
+
+def criteria_fingerprint():
+    """
+    Отпечаток текущих критериев фильтрации
+
+    Решения фильтра из кэша используются, только если критерии не менялись,
+    иначе письмо заново проверяется по закэшированным заголовкам.
+    """
+    criteria = json.dumps(get_rule_set().rules, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(criteria.encode('utf-8')).hexdigest()[:16]
+
+class ProgressTracker:
+    """
+    Отслеживает обработанные письма и сохраняет состояние по непрерывной границе
+
+    Состояние сдвигается только до UID, перед которым все письма-кандидаты
+    уже обработаны, поэтому сбой посреди прохода не приводит ни к пропуску
+    писем, ни к повторной отправке уже доставленных уведомлений.
+
+    Args:
+        candidate_uids (list): UID писем-кандидатов текущего прохода
+        last_uid (int): UID из сохраненного состояния
+        uidnext (int): UIDNEXT папки на момент SELECT
+        uidvalidity (int): UIDVALIDITY папки
+        mailbox (str): Ключ папки в файле состояния и кэше
+    """
+
+    def __init__(self, candidate_uids, last_uid, uidnext, uidvalidity, mailbox=IMAP_MAILBOX):
+        self.pending = sorted(int(uid) for uid in candidate_uids)
+        self.position = 0
+        self.completed = set()
+        self.uidnext = uidnext
+        self.uidvalidity = uidvalidity
+        self.mailbox = mailbox
+        self.saved_uid = last_uid
+        self.lock = threading.Lock()
+
+    def complete(self, uid):
+        with self.lock:
+            self.completed.add(int(uid))
+
+    def watermark(self):
+        """
+        Возвращает UID, до которого включительно все письма обработаны
+        """
+        with self.lock:
+            while self.position < len(self.pending) and self.pending[self.position] in self.completed:
+                self.position += 1
+            if self.position < len(self.pending):
+                return self.pending[self.position] - 1
+            return self.uidnext - 1
+
+    def commit(self, force=False):
+        """
+        Сохраняет состояние, если граница сдвинулась
+
+        Returns:
+            int: Сохраненный UID
+        """
+        last_uid = self.watermark()
+        if force or last_uid > self.saved_uid:
+            save_processed_state(self.uidvalidity, last_uid, self.mailbox)
+            self.saved_uid = last_uid
+        return self.saved_uid
+
+class OutboxWorker:
+    """
+    Доставка уведомлений из очереди отправки в отдельной задаче asyncio
+
+    Проверка почты только ставит уведомления в очередь на диске и не ждет
+    Telegram. Для каждого чата с уведомлениями к отправке запускается своя
+    задача: уведомления чата уходят строго в порядке постановки, поэтому
+    порядок сообщений совпадает с порядком писем, а медленный или
+    ограниченный 429 чат не задерживает остальные. После временной ошибки
+    (таймаут, обрыв соединения, 5xx) следующая попытка откладывается
+    экспоненциально от OUTBOX_RETRY_MIN до OUTBOX_RETRY_MAX со случайной
+    добавкой, чтобы повторы после сбоя Telegram не шли одной волной, а
+    уведомления чата после неудачного ждут вместе с ним. Задержки повторов
+    хранятся только в памяти: новый процесс сразу пробует отправить всю
+    очередь, оставшуюся от прошлого, а между запусками по расписанию и так
+    проходит 5 минут. Уведомление с постоянной ошибкой (чат не найден, бот
+    заблокирован) удаляется из очереди. Сообщение, отправленное перед самым
+    сбоем процесса, может прийти повторно: доставка - не меньше одного раза.
+    Чат, первое уведомление которого осталось с прошлого запуска без текста,
+    ждет, пока проверка его папки не соберет текст заново.
+    """
+
+    def __init__(self):
+        self.wakeup = asyncio.Event()
+        self.changed = asyncio.Event()
+        self.chats = {}
+        self.attempts = {}
+        self.retry_at = {}
+        self.task = None
+
+    def start(self):
+        pending = get_state_journal().pending()
+        if pending:
+            log_info(f"В очереди отправки с прошлого запуска уведомлений: "
+                     f"{sum(len(entry['uids']) for entry in pending)}")
+        self.task = asyncio.ensure_future(self.run())
+        return self
+
+    def notify(self):
+        self.wakeup.set()
+
+    async def run(self):
+        journal = get_state_journal()
+        while True:
+            self.wakeup.clear()
+            now = time.time()
+            heads = {}
+            for entry in journal.pending():
+                heads.setdefault(entry['chat_id'], entry)
+            heads = {chat_id: entry for chat_id, entry in heads.items() if entry['text'] is not None}
+            for chat_id, entry in heads.items():
+                if chat_id not in self.chats and self.retry_at.get(entry['id'], 0) <= now:
+                    self.chats[chat_id] = asyncio.ensure_future(self.deliver_chat(chat_id))
+            self.changed.set()
+            waits = [self.retry_at[entry['id']] for chat_id, entry in heads.items() if chat_id not in self.chats]
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), max(0, min(waits) - now) if waits else None)
+            except asyncio.TimeoutError:
+                pass
+
+    async def deliver_chat(self, chat_id):
+        """
+        Отправляет уведомления чата по порядку до первой неудачи или пустой очереди
+        """
+        try:
+            while True:
+                entry = get_state_journal().first_pending(chat_id)
+                if entry is None or entry['text'] is None or self.retry_at.get(entry['id'], 0) > time.time():
+                    return
+                if not await self.deliver(entry):
+                    return
+        finally:
+            del self.chats[chat_id]
+            self.wakeup.set()
+
+    async def deliver(self, entry):
+        """
+        Одна попытка отправки уведомления из очереди
+
+        Returns:
+            bool: False если уведомление осталось в очереди до следующей попытки
+        """
+        loop = asyncio.get_running_loop()
+        uids = ', '.join(str(uid) for uid in entry['uids'])
+        log_debug("Отправка уведомления о письме UID %s в Telegram", uids)
+        sent, retryable = await get_telegram_client().try_send_message(entry['chat_id'], entry['text'])
+        # Запись в журнал с fsync - в пуле потоков
+        if sent is not None:
+            if not await loop.run_in_executor(None, record_delivery, entry, sent.get('message_id')):
+                # Сообщение уже в Telegram: повторять его нельзя, очередь в памяти его не содержит
+                log_warning(f"Доставка уведомления о письме UID {uids} не сохранена, "
+                            f"после сбоя процесса до сжатия журнала оно может прийти повторно")
+                metrics.inc('journal_errors')
+            metrics.inc('notifications_delivered', len(entry['uids']))
+            log_debug("Уведомление о письме UID %s отправлено", uids)
             return True
+        if not retryable:
+            log_error(f"Уведомление о письме UID {uids} отклонено Telegram и удалено из очереди")
+            if not await loop.run_in_executor(None, drop_notification, entry):
+                metrics.inc('journal_errors')
+            metrics.inc('outbox_dropped')
+            return True
+        attempts = self.attempts.get(entry['id'], 0) + 1
+        delay = min(OUTBOX_RETRY_MIN * 2 ** (attempts - 1), OUTBOX_RETRY_MAX)
+        delay += random.uniform(0, delay / 2)
+        log_warning(f"Уведомление о письме UID {uids} не доставлено (попытка {attempts}), "
+                    f"повтор через {delay:.0f} с")
+        self.attempts[entry['id']] = attempts
+        self.retry_at[entry['id']] = time.time() + delay
+        metrics.inc('outbox_retries')
+        return False
+
+    async def drain(self, timeout):
+        """
+        Ждет опустошения очереди, но не дольше timeout секунд
+
+        Ожидание заканчивается раньше, если все оставшиеся уведомления
+        отложены до времени позже срока или их чаты ждут текста уведомления
+        с прошлого запуска: они уйдут при следующем запуске.
+
+        Returns:
+            int: О скольких письмах уведомления остались в очереди
+        """
+        deadline = time.time() + timeout
+        journal = get_state_journal()
+        while True:
+            self.changed.clear()
+            pending = journal.pending()
+            if not pending:
+                return 0
+            ready = []
+            waiting = set()
+            for entry in pending:
+                if entry['text'] is None:
+                    waiting.add(entry['chat_id'])
+                elif entry['chat_id'] not in waiting:
+                    ready.append(entry)
+            if time.time() >= deadline or not ready or (
+                    not self.chats and min(self.retry_at.get(entry['id'], 0) for entry in ready) > deadline):
+                return sum(len(entry['uids']) for entry in pending)
+            try:
+                await asyncio.wait_for(self.changed.wait(), deadline - time.time())
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        """
+        Останавливает доставку: недоставленные уведомления остаются в очереди на диске
+        """
+        global _outbox_worker
+        if _outbox_worker is self:
+            _outbox_worker = None
+        tasks = [self.task] + list(self.chats.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+_outbox_worker = None
+
+def start_outbox_worker():
+    """
+    Запускает доставку из очереди отправки в текущем цикле событий
+    """
+    global _outbox_worker
+    _outbox_worker = OutboxWorker().start()
+    return _outbox_worker
+
+def notify_outbox():
+    """
+    Будит доставку после постановки уведомлений в очередь
+    """
+    if _outbox_worker is not None:
+        _outbox_worker.notify()
+
+async def queue_notices(tracker, notices, digest=False):
+    """
+    Формирует тексты уведомлений и ставит их в очередь отправки
+
+    Письма отмечаются обработанными только после записи очереди на диск:
+    если запись не удалась, граница UID не пройдет их и они проверятся снова.
+
+    Args:
+        tracker (ProgressTracker): Учет обработанных писем
+        notices (list): Подошедшие письма с текстом отрывка (для дайджеста не нужен)
+        digest (bool): Собрать письма каждого чата в дайджест
+
+    Returns:
+        list: Поставленные в очередь уведомления
+    """
+    if not notices:
+        return []
+    if digest:
+        # Правила могут направлять письма в разные чаты: дайджест у каждого чата свой
+        chats = {}
+        for notice in notices:
+            chats.setdefault(notice.get('chat_id') or TELEGRAM_CHAT_ID, []).append(notice)
+        messages = [
+            (text, chat_id, included)
+            for chat_id, chat_notices in chats.items()
+            for text, included in format_digest_messages(chat_notices)
+        ]
+    else:
+        messages = [
+            (format_notification(notice['subject'], notice['sender'], notice['body'], notice['uid'],
+                                 notice.get('template', '')),
+             notice.get('chat_id') or TELEGRAM_CHAT_ID, [notice])
+            for notice in notices
+        ]
+    queued = await asyncio.get_running_loop().run_in_executor(
+        None, queue_notifications, tracker.mailbox, tracker.uidvalidity, messages, digest,
+    )
+    if not queued:
+        return []
+    for notice in notices:
+        tracker.complete(notice['uid'])
+    notify_outbox()
+    return notices
+
+def format_lost_notification(entry):
+    """
+    Текст уведомления из очереди, письма которого после перезапуска уже нет в папке
+
+    Текст уведомлений на диске не хранится, поэтому собрать его заново нельзя:
+    уходит короткое сообщение с UID, чтобы уведомление не потерялось совсем.
+    """
+    uids = ', '.join(str(uid) for uid in entry['uids'])
+    return (
+        f"⚖️ НОВОЕ УВЕДОМЛЕНИЕ ОТ АРБИТРАЖНОГО СУДА\n\n"
+        f"📖 Текст уведомления не сохранился: письмо больше недоступно в папке {entry['mailbox']}\n\n"
+        f"📧 ID ПИСЬМА: {uids}\n"
+        f"🕒 ВРЕМЯ: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+    )
+
+async def restore_notification_texts(mail, mailbox, uidvalidity, entries, stats):
+    """
+    Собирает заново тексты уведомлений очереди, оставшихся с прошлого запуска
+
+    Заголовки и отрывки берутся из локального кэша писем, а если их там нет -
+    с сервера (папка уже выбрана). Уведомление о письме, которого в папке
+    больше нет или UIDVALIDITY которой сменился, получает короткий текст
+    format_lost_notification.
+
+    Args:
+        mail: IMAP соединение с выбранной папкой
+        mailbox (str): Ключ папки
+        uidvalidity (int): Текущий UIDVALIDITY папки
+        entries (list): Записи очереди этой папки без текста
+        stats (dict): Счетчики текущего запуска
+    """
+    journal = get_state_journal()
+    uids = [str(uid).encode() for entry in entries if entry['uidvalidity'] == uidvalidity for uid in entry['uids']]
+    cache = get_message_cache()
+    cached = cache.get_many(mailbox, uidvalidity, uids) if cache and uids else {}
+    missing = [uid for uid in uids if uid.decode() not in cached]
+    headers_by_id = {}
+    if missing:
+        with metrics.span('fetch'):
+            headers_by_id = await fetch_message_headers(mail, missing, stats)
+
+    notices = {}
+    for uid in uids:
+        entry = cached.get(uid.decode())
+        headers = entry['headers'] if entry else headers_by_id.get(uid.decode())
+        if headers is None:
+            continue
+        subject = decode_email_header(headers.get('Subject', 'Без темы'))
+        sender_raw = headers.get('From', 'Неизвестный отправитель')
+        # Шаблон берется из правила, под которое письмо подходит сейчас
+        rule = get_rule_set().match(subject, sender_raw) or {}
+        notices[uid.decode()] = {
+            'uid': uid.decode(), 'subject': subject, 'sender': decode_email_header(sender_raw),
+            'body': entry['preview'] if entry else None, 'template': rule.get('template', ''),
+        }
+
+    # Отрывок нужен только отдельным уведомлениям, дайджесту хватает заголовков
+    need_body = [
+        str(uid).encode() for entry in entries if not entry.get('digest') for uid in entry['uids']
+        if str(uid) in notices and notices[str(uid)]['body'] is None
+    ]
+    if need_body:
+        with metrics.span('fetch'):
+            parts = await fetch_message_bodies(mail, need_body, stats)
+        loop = asyncio.get_running_loop()
+        for uid, part in parts.items():
+            notices[uid]['body'] = await loop.run_in_executor(None, parse_body_part, part)
+
+    for entry in entries:
+        found = [notices[str(uid)] for uid in entry['uids'] if str(uid) in notices]
+        if entry['uidvalidity'] != uidvalidity or len(found) != len(entry['uids']):
+            log_warning(f"Письма уведомления из очереди {mailbox} недоступны, отправляется UID без текста")
+            text = format_lost_notification(entry)
+        elif entry.get('digest'):
+            text = format_digest_messages(found)[0][0]
+        else:
+            notice = found[0]
+            text = format_notification(notice['subject'], notice['sender'], notice['body'] or UNREADABLE_BODY_TEXT,
+                                       notice['uid'], notice['template'])
+        journal.set_text(entry['id'], text)
+    log_info(f"Восстановлено уведомлений из очереди {mailbox}: {len(entries)}")
+    notify_outbox()
+
+def restore_orphaned_notifications(accounts):
+    """
+    Дает короткий текст уведомлениям очереди из папок, которых больше нет в списке ящиков
+    """
+    mailboxes = {mailbox_key(account, folder) for account in accounts for folder in account['folders']}
+    journal = get_state_journal()
+    for entry in journal.pending():
+        if entry['text'] is None and entry['mailbox'] not in mailboxes:
+            journal.set_text(entry['id'], format_lost_notification(entry))
+    notify_outbox()
+
+async def run_notification_pipeline(mail, notices, tracker, stats, chat_id=None):
+    """
+    Загружает тексты подошедших писем и ставит уведомления в очередь отправки
+
+    IMAP остается на одном соединении и загружает тела пакетами, разбор MIME
+    идет в пуле потоков цикла событий, уведомления пакета ставятся в очередь
+    одной записью журнала. Пока разбирается пакет, уже загружается
+    следующий. Отправку в Telegram выполняет OutboxWorker, проверка почты
+    ее не ждет.
+
+    Args:
+        mail (AsyncIMAPClient): IMAP соединение
+        notices (list): Подошедшие письма в порядке UID
+        tracker (ProgressTracker): Учет обработанных писем
+        stats (dict): Счетчики текущего запуска
+        chat_id (str): Чат получателя (по умолчанию TELEGRAM_CHAT_ID)
+
+    Returns:
+        list: Поставленные в очередь уведомления
+    """
+    for notice in notices:
+        notice['chat_id'] = notice.get('chat_id') or chat_id
+    rules = get_rule_set()
+    needs_body = any(rules.needs_body(notice.get('rule')) for notice in notices)
+    if TELEGRAM_DIGEST_THRESHOLD and len(notices) > TELEGRAM_DIGEST_THRESHOLD and not needs_body:
+        # Дайджесту тексты писем не нужны, поэтому тела не загружаются вовсе
+        log_info(f"Писем больше {TELEGRAM_DIGEST_THRESHOLD}, отправляем дайджест")
+        return await queue_notices(tracker, notices, digest=True)
+
+    loop = asyncio.get_running_loop()
+    queued = []
+    pending_batch = []
+    for start in range(0, len(notices), BODY_FETCH_BATCH_SIZE):
+        batch = notices[start:start + BODY_FETCH_BATCH_SIZE]
+        # Тела писем с отрывком из локального кэша не загружаются
+        uncached = [notice['uid'].encode() for notice in batch if notice['body'] is None]
+        truncated = {}
+        if uncached:
+            with metrics.span('fetch'):
+                parts = await fetch_message_bodies(mail, uncached, stats, truncated)
+        else:
+            parts = {}
+        for notice in batch:
+            if notice['uid'] in truncated:
+                notice['truncated_part'] = (truncated[notice['uid']], parts[notice['uid']])
+        futures = [
+            (notice, completed_future(notice['body']) if notice['body'] is not None
+             else loop.run_in_executor(None, parse_body_part, parts[notice['uid']],
+                                       RULE_BODY_SCAN_LENGTH if rules.needs_body(notice.get('rule'))
+                                       else BODY_PREVIEW_LENGTH * 2)
+             if notice['uid'] in parts else None)
+            for notice in batch
+        ]
+        queued += await queue_notices(tracker, await collect_parsed(tracker, pending_batch, mail, stats))
+        cache_previews(tracker, pending_batch)
+        pending_batch = futures
+        tracker.commit()
+    queued += await queue_notices(tracker, await collect_parsed(tracker, pending_batch, mail, stats))
+    cache_previews(tracker, pending_batch)
+    return queued
+
+async def collect_parsed(tracker, batch, mail, stats):
+    """
+    Собирает разобранные письма пакета в исходном порядке
+
+    Письмо, которое не удалось загрузить или разобрать, пропускается и
+    остается необработанным: состояние не сдвинется дальше него. Если часть
+    была обрезана окном загрузки и текста не хватает отрывку или body_regex,
+    продолжение догружается на соединении mail. Письмо, текст которого не
+    подошел под body_regex правила, считается обработанным, но только если
+    текст полный и не пустой: иначе уведомление отправляется без проверки.
+
+    Returns:
+        list: Письма с текстом отрывка для постановки в очередь
+    """
+    rules = get_rule_set()
+    ready = []
+    for notice, future in batch:
+        truncated_part = notice.pop('truncated_part', None)
+        if future is None:
+            log_error(f"Не удалось загрузить текст письма UID {notice['uid']}")
+            continue
+        try:
+            notice['body'] = await future
+        except Exception as e:
+            log_error(f"Ошибка разбора письма UID {notice['uid']}: {e}")
+            continue
+        needed = RULE_BODY_SCAN_LENGTH if rules.needs_body(notice.get('rule')) else BODY_PREVIEW_LENGTH * 2
+        complete = truncated_part is None or len(notice['body']) >= needed
+        if not complete:
+            section, part_data = truncated_part
+            try:
+                notice['body'], complete = await extend_truncated_body(
+                    mail, notice['uid'], section, part_data, needed, stats,
+                )
+            except IMAPAbort:
+                raise
+            except IMAPError as e:
+                log_warning(f"Ошибка догрузки текста письма UID {notice['uid']}: {e}")
+        log_debug("Длина текста письма UID %s: %s символов", notice['uid'], len(notice['body']))
+        if not rules.body_matches(notice.get('rule'), notice['body']):
+            if not complete or notice['body'] == UNREADABLE_BODY_TEXT:
+                log_warning(f"Текст письма UID {notice['uid']} пуст или загружен не полностью, "
+                            f"условие body_regex правила {notice['rule']} не проверено")
+                ready.append(notice)
+                continue
+            log_debug("Текст письма UID %s не подходит под правило %s", notice['uid'], notice['rule'])
+            notice['rejected'] = True
+            tracker.complete(notice['uid'])
+            continue
+        ready.append(notice)
+    return ready
+
+def completed_future(value):
+    """
+    Уже завершенный Future для письма, текст которого есть в кэше
+    """
+    future = asyncio.get_running_loop().create_future()
+    future.set_result(value)
+    return future
+
+def cache_previews(tracker, batch):
+    """
+    Сохраняет в локальный кэш отрывки писем разобранного пакета
+
+    Письма, текст которых не подошел под body_regex, отмечаются неподошедшими.
+    """
+    cache = get_message_cache()
+    previews = [(notice['uid'], notice['body']) for notice, _ in batch if notice['body'] is not None]
+    if cache and previews:
+        cache.put_previews(tracker.mailbox, tracker.uidvalidity, previews)
+    rejected = [(notice['uid'], False) for notice, _ in batch if notice.get('rejected')]
+    if cache and rejected:
+        cache.put_decisions(tracker.mailbox, tracker.uidvalidity, criteria_fingerprint(), rejected)
+
+async def move_processed_messages(mail, uid_set, folder):
+    """
+    Переносит обработанные письма в отдельную папку
+
+    Используется UID MOVE (RFC 6851), а если сервер его не поддерживает -
+    UID COPY с последующим UID EXPUNGE (требует UIDPLUS).
+    """
+    mailbox = imap_quote(encode_mailbox_name(folder))
+    if 'MOVE' in mail.capabilities:
+        status, _ = await mail.uid('MOVE', uid_set, mailbox)
+    elif 'UIDPLUS' in mail.capabilities:
+        status, _ = await mail.uid('COPY', uid_set, mailbox)
+        if status == 'OK':
+            await mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Deleted)')
+            status, _ = await mail.uid('EXPUNGE', uid_set)
+    else:
+        log_warning("Сервер не поддерживает MOVE и UIDPLUS, письма остаются во входящих")
+        return
+    if status == 'OK':
+        log_info(f"Письма перенесены в папку {folder}")
+    else:
+        log_warning(f"Не удалось перенести письма в папку {folder}")
+
+async def flush_processed_flags(mail, email_ids):
+    """
+    Помечает обработанные письма прочитанными одной или несколькими командами
+
+    UID собираются за весь проход и отправляются сжатыми наборами вида
+    1:5,9,12:20 вместо отдельной команды STORE на каждое письмо. Если задан
+    PROCESSED_FOLDER, письма затем переносятся в эту папку, чтобы входящие
+    оставались небольшими.
+
+    Args:
+        mail: IMAP соединение
+        email_ids (list): UID писем, уведомления о которых доставлены
+
+    Returns:
+        set: UID (int), команды для которых выполнены без ошибок
+    """
+    uids = sorted({int(email_id) for email_id in email_ids})
+    flagged = set()
+    for start in range(0, len(uids), STORE_BATCH_SIZE):
+        batch = uids[start:start + STORE_BATCH_SIZE]
+        uid_set = compress_uid_set(batch)
+        try:
+            await mail.uid('STORE', uid_set, '+FLAGS.SILENT', '(\\Seen)')
+            log_info(f"Письма помечены как прочитанные: {uid_set}")
+            if PROCESSED_FOLDER:
+                await move_processed_messages(mail, uid_set, PROCESSED_FOLDER)
+            flagged.update(batch)
+        except Exception as e:
+            log_warning(f"Ошибка при пометке писем как прочитанных: {e}")
+    return flagged
+
+async def flag_delivered_messages(mail, mailbox, uidvalidity, handled=()):
+    """
+    Помечает прочитанными письма выбранной папки, уведомления о которых доставлены
+
+    Письмо из очереди отправки остается непрочитанным и на месте, пока
+    уведомление о нем не доставлено: после перезапуска текст уведомления
+    собирается заново из этого письма, а если Telegram так и не примет
+    уведомление, письмо не затеряется среди прочитанных. Доставленные
+    OutboxWorker письма копятся в журнале и помечаются при следующей проверке
+    папки одной командой вместе с повторами этого прохода.
+
+    Args:
+        mail: IMAP соединение с выбранной папкой
+        mailbox (str): Ключ папки
+        uidvalidity (int): UIDVALIDITY папки
+        handled (list): UID писем, которые можно пометить сразу (повторы и уже доставленные)
+    """
+    journal = get_state_journal()
+    delivered = journal.unflagged_uids(mailbox, uidvalidity)
+    if not delivered and not handled:
+        return
+    with metrics.span('store'):
+        flagged = await flush_processed_flags(mail, list(handled) + delivered)
+    done = [uid for uid in delivered if uid in flagged]
+    if done:
+        try:
+            journal.append([{'op': 'flagged', 'mailbox': mailbox, 'uidvalidity': uidvalidity, 'uids': done}])
+        except Exception as e:
+            # Повторная пометка при следующей проверке ничего не испортит
+            log_error(f"Ошибка записи журнала состояния: {e}")
+
+async def get_mailbox_status(mail, folder_name):
+    """
+    Запрашивает UIDVALIDITY, UIDNEXT и UNSEEN папки командой STATUS без ее выбора
+
+    Returns:
+        dict: {'UIDVALIDITY': int, 'UIDNEXT': int, 'UNSEEN': int} (только присланные сервером)
+    """
+    with metrics.span('status'):
+        status, data = await mail.status(folder_name, '(UIDVALIDITY UIDNEXT UNSEEN)')
+    if status != 'OK':
+        raise IMAPError(f"Не удалось получить STATUS папки {folder_name}")
+    return {name.decode(): int(value) for name, value in STATUS_VALUE_RE.findall(data[0])}
+
+async def is_mailbox_idle(mail, folder_name, mailbox, state):
+    """
+    Быстрый путь запуска без новых писем: один STATUS вместо SELECT и SEARCH
+
+    Если UIDNEXT не сдвинулся, новых писем нет. Если сдвинулся, но в папке
+    нет непрочитанных, кандидатов тоже нет (ищутся только UNSEEN), и граница
+    сразу переносится на UIDNEXT - 1.
+
+    Returns:
+        bool: True если папку можно не открывать
+    """
+    info = await get_mailbox_status(mail, folder_name)
+    if info.get('UIDVALIDITY') != state['uidvalidity'] or 'UIDNEXT' not in info:
+        return False
+    if info['UIDNEXT'] - 1 <= state['last_uid']:
+        log_info(f"Нет новых писем в {mailbox}")
+        metrics.inc('mailboxes_skipped')
+        return True
+    if info.get('UNSEEN') == 0:
+        log_info(f"Новые письма в {mailbox} уже прочитаны")
+        save_processed_state(state['uidvalidity'], info['UIDNEXT'] - 1, mailbox)
+        metrics.inc('mailboxes_skipped')
+        return True
+    return False
+
+async def get_mailbox_uid_info(mail, mailbox=IMAP_MAILBOX):
+    """
+    Возвращает UIDVALIDITY и UIDNEXT выбранной папки
+
+    Значения берутся из ответа SELECT, а если сервер их не прислал - из STATUS.
+
+    Args:
+        mail: IMAP соединение с выбранной папкой
+        mailbox (str): Имя папки IMAP
+
+    Returns:
+        tuple: (uidvalidity, uidnext)
+    """
+    uidvalidity = mail.response('UIDVALIDITY')[1][0]
+    uidnext = mail.response('UIDNEXT')[1][0]
+    if uidvalidity is None or uidnext is None:
+        status, data = await mail.status(mailbox, '(UIDVALIDITY UIDNEXT)')
+        if status != 'OK':
+            raise IMAPError(f"Не удалось получить UIDVALIDITY папки {mailbox}")
+        values = dict(STATUS_VALUE_RE.findall(data[0]))
+        uidvalidity = values.get(b'UIDVALIDITY', uidvalidity)
+        uidnext = values.get(b'UIDNEXT', uidnext)
+    return int(uidvalidity), int(uidnext)
+
+def default_account():
+    """
+    Ящик из переменных окружения YANDEX_EMAIL / YANDEX_APP_PASSWORD
+
+    У него пустое имя, поэтому ключи состояния остаются прежними ("INBOX").
+    """
+    return {
+        'name': '',
+        'email': YANDEX_EMAIL,
+        'password': YANDEX_APP_PASSWORD,
+        'folders': [IMAP_MAILBOX],
+        'chat_id': TELEGRAM_CHAT_ID,
+    }
+
+def load_accounts():
+    """
+    Загружает список ящиков из ACCOUNTS_FILE
+
+    Формат файла:
+        {"accounts": [{"name": "firm", "email": "...", "password_env": "FIRM_PASSWORD",
+                       "folders": ["INBOX", "Спам"], "chat_id": "-100123"}]}
+
+    Пароль можно указать прямо в поле password, но лучше передавать его через
+    переменную окружения, имя которой указано в password_env. Если папки или
+    чат не указаны, используются INBOX и TELEGRAM_CHAT_ID.
+
+    Returns:
+        list: Ящики {'name', 'email', 'password', 'folders', 'chat_id'}
+
+    Raises:
+        ValueError: Если файл некорректен
+    """
+    if not ACCOUNTS_FILE:
+        return [default_account()]
+    try:
+        with open(ACCOUNTS_FILE, 'r', encoding='utf-8') as f:
+            config = json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        raise ValueError(f"Не удалось прочитать {ACCOUNTS_FILE}: {e}")
+
+    accounts = []
+    for entry in config.get('accounts', []):
+        if not entry.get('email'):
+            raise ValueError(f"В {ACCOUNTS_FILE} у ящика не указан email")
+        accounts.append({
+            'name': entry.get('name') or entry['email'],
+            'email': entry['email'],
+            'password': entry.get('password') or os.getenv(entry.get('password_env', ''), ''),
+            'folders': entry.get('folders') or [IMAP_MAILBOX],
+            'chat_id': str(entry.get('chat_id') or TELEGRAM_CHAT_ID or ''),
+        })
+    if not accounts:
+        raise ValueError(f"В {ACCOUNTS_FILE} нет ни одного ящика")
+    names = [account['name'] for account in accounts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"В {ACCOUNTS_FILE} повторяются имена ящиков")
+    return accounts
+
+def mailbox_key(account, folder):
+    """
+    Ключ папки в файле состояния и кэше: состояние у каждой папки каждого ящика свое
+    """
+    return f"{account['name']}/{folder}" if account['name'] else folder
+
+class IMAPError(Exception):
+    """
+    Ошибка команды IMAP (ответ NO или BAD): соединение остается рабочим
+    """
+
+class IMAPAbort(IMAPError):
+    """
+    Обрыв IMAP соединения или нарушение протокола: соединение нужно открыть заново
+    """
+
+class AsyncIMAPClient:
+    """
+    IMAP клиент на asyncio: одно соединение без отдельного потока
+
+    Повторяет ту часть интерфейса imaplib, которой пользуется скрипт (login,
+    select, status, uid, noop, close, logout, capabilities, response), и
+    возвращает ответы в том же виде (status, data), поэтому разбор FETCH,
+    SEARCH и STATUS общий. Ожидание ответа сервера, в том числе в IDLE, не
+    занимает поток: десятки ящиков обслуживаются одним циклом событий.
+    Ошибки сообщаются исключениями IMAPError и IMAPAbort (как IMAP4.error и
+    IMAP4.abort в imaplib, который больше не импортируется).
+
+    Args:
+        reader (asyncio.StreamReader): Чтение из соединения
+        writer (asyncio.StreamWriter): Запись в соединение
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.tag_number = 0
+        self.capabilities = ()
+        self.state = 'NONAUTH'
+        self.selected = None  # Имя выбранной папки в том виде, в каком его передали в SELECT
+        self.untagged = {}
+
+    @classmethod
+    async def open(cls, host=IMAP_SERVER, port=IMAP_PORT, use_ssl=True):
+        """
+        Подключается к серверу, читает приветствие и список возможностей
+
+        Returns:
+            AsyncIMAPClient: Соединение в состоянии NONAUTH (или AUTH при PREAUTH)
+        """
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            host, port, ssl=ssl.create_default_context() if use_ssl else None, limit=IMAP_LINE_LIMIT,
+        ), REQUEST_TIMEOUT)
+        client = cls(reader, writer)
+        greeting = await client.read_line()
+        if greeting.startswith(b'* PREAUTH'):
+            client.state = 'AUTH'
+        elif not greeting.startswith(b'* OK'):
+            writer.close()
+            raise IMAPAbort(f"Неожиданное приветствие сервера: {greeting.decode(errors='replace')}")
+        status, data = await client.command('CAPABILITY')
+        if status == 'OK' and data[-1]:
+            client.capabilities = tuple(data[-1].decode().upper().split())
+        return client
+
+    async def read_line(self):
+        """
+        Читает строку ответа без CRLF
+        """
+        try:
+            line = await self.reader.readline()
+        except (ConnectionError, ValueError) as e:
+            raise IMAPAbort(f"Ошибка чтения ответа сервера: {e}")
+        if not line:
+            raise IMAPAbort("Соединение закрыто сервером")
+        return line.rstrip(b'\r\n')
+
+    async def read_literal(self, size):
+        try:
+            return await self.reader.readexactly(size)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            raise IMAPAbort(f"Соединение оборвалось посреди литерала: {e}")
+
+    async def send(self, data):
+        try:
+            self.writer.write(data)
+            await self.writer.drain()
+        except ConnectionError as e:
+            raise IMAPAbort(f"Ошибка отправки команды: {e}")
+
+    async def store_untagged(self, line):
+        """
+        Разбирает непомеченный ответ и его литералы в self.untagged как imaplib
+
+        Ответ "* 5 FETCH (... {n}" становится элементами (b'5 (... {n}', литерал)
+        и хвостом вроде b')', "* SEARCH 1 2" - элементом b'1 2', код ответа
+        "* OK [UIDVALIDITY 7]" - элементом b'7' под именем UIDVALIDITY.
+        """
+        code = IMAP_RESPONSE_CODE_RE.match(line)
+        if code:
+            self.untagged.setdefault(code.group(1).decode().upper(), []).append(code.group(2) or b'')
+        match = IMAP_UNTAGGED_RE.match(line)
+        if not match:
+            return
+        number, name, rest = match.groups()
+        name = name.decode().upper()
+        if number is not None:
+            data = number + (b' ' + rest if rest is not None else b'')
         else:
-            log_error(f"Ошибка Telegram: {response.status_code} - {response.text}")
-            return False
-            
-    except requests.exceptions.Timeout:
-        log_error("Таймаут при отправке в Telegram")
-        return False
-    except requests.exceptions.ConnectionError:
-        log_error("Ошибка соединения с Telegram")
-        return False
-    except Exception as e:
-        log_error(f"Неожиданная ошибка при отправке в Telegram: {e}")
-        return False
+            data = rest if rest is not None else b''
+        items = self.untagged.setdefault(name, [])
+        while True:
+            literal = IMAP_LITERAL_RE.search(data)
+            if not literal:
+                break
+            items.append((data, await self.read_literal(int(literal.group(1)))))
+            data = await self.read_line()
+        items.append(data)
+
+    def next_tag(self):
+        self.tag_number += 1
+        return f"A{self.tag_number:04d}"
+
+    async def command(self, name, *args, literal=None):
+        """
+        Выполняет команду и собирает ответы до завершающей помеченной строки
+
+        Args:
+            name (str): Команда, например SELECT или UID
+            args: Аргументы команды (уже в синтаксисе IMAP)
+            literal (bytes): Литерал, который передается последним аргументом
+
+        Returns:
+            tuple: (статус OK/NO, непомеченные ответы с именем команды или [None])
+        """
+        response_name = (args[0] if name == 'UID' else name).upper()
+        self.untagged.pop(response_name, None)
+        tag = self.next_tag()
+        line = ' '.join([tag, name] + [arg.decode() if isinstance(arg, bytes) else str(arg) for arg in args])
+        if literal is not None:
+            await self.send(f"{line} {{{len(literal)}}}\r\n".encode('utf-8'))
+            while True:
+                response = await self.read_line()
+                if response.startswith(b'+'):
+                    break
+                if response.startswith(tag.encode() + b' '):
+                    return self.complete(name, tag, response, response_name)
+                await self.store_untagged(response)
+            await self.send(literal + b'\r\n')
+        else:
+            await self.send(line.encode('utf-8') + b'\r\n')
+
+        while True:
+            response = await self.read_line()
+            if response.startswith(tag.encode() + b' '):
+                return self.complete(name, tag, response, response_name)
+            if response.startswith(b'* BYE') and name != 'LOGOUT':
+                raise IMAPAbort(f"Сервер закрыл соединение: {response.decode(errors='replace')}")
+            if response.startswith(b'*'):
+                await self.store_untagged(response)
+
+    def complete(self, name, tag, response, response_name):
+        status, _, text = response[len(tag) + 1:].partition(b' ')
+        status = status.decode().upper()
+        if status == 'BAD':
+            raise IMAPError(f"{name} command error: BAD [{text.decode(errors='replace')}]")
+        if status != 'OK':
+            return status, [text]
+        return status, self.untagged.pop(response_name, [None])
+
+    def response(self, name):
+        """
+        Забирает накопленные непомеченные ответы с именем name, как imaplib.response
+        """
+        return name, self.untagged.pop(name.upper(), [None])
+
+    async def login(self, user, password):
+        status, data = await self.command('LOGIN', imap_quote(user), imap_quote(password))
+        if status != 'OK':
+            raise IMAPError(data[-1].decode(errors='replace'))
+        self.state = 'AUTH'
+        return status, data
+
+    async def select(self, mailbox):
+        # Как и в imaplib, ответы прошлой папки (EXISTS, UIDVALIDITY) не должны смешиваться с новыми
+        self.untagged.clear()
+        status, data = await self.command('SELECT', mailbox)
+        if status == 'OK':
+            self.state = 'SELECTED'
+            self.selected = mailbox
+            data = self.untagged.pop('EXISTS', [None])
+        else:
+            self.selected = None
+        return status, data
+
+    async def status(self, mailbox, names):
+        return await self.command('STATUS', mailbox, names)
+
+    async def uid(self, command, *args, literal=None):
+        return await self.command('UID', command.upper(), *args, literal=literal)
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def close(self):
+        status, data = await self.command('CLOSE')
+        self.state = 'AUTH'
+        self.selected = None
+        return status, data
+
+    async def logout(self):
+        self.state = 'LOGOUT'
+        try:
+            return await self.command('LOGOUT')
+        finally:
+            self.writer.close()
+
+    async def idle(self, timeout):
+        """
+        Ждет новые письма в режиме IMAP IDLE (RFC 2177)
+
+        Args:
+            timeout (float): Сколько секунд ждать до выхода из IDLE
+
+        Returns:
+            bool: True если сервер сообщил о новых письмах
+        """
+        try:
+            return await self.wait_idle(timeout)
+        except asyncio.CancelledError:
+            # Посреди IDLE сервер не примет другую команду, соединение просто закрывается
+            self.state = 'LOGOUT'
+            self.writer.close()
+            raise
+
+    async def wait_idle(self, timeout):
+        loop = asyncio.get_running_loop()
+        tag = self.next_tag().encode()
+        await self.send(tag + b' IDLE\r\n')
+
+        has_new = False
+        deadline = loop.time() + timeout
+        while not has_new:
+            try:
+                line = await asyncio.wait_for(self.read_line(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                break
+            if line.startswith(tag + b' '):
+                raise IMAPError(f"Сервер отклонил IDLE: {line.decode(errors='replace').strip()}")
+            if line.startswith(b'* BYE'):
+                raise IMAPAbort(f"Сервер закрыл соединение: {line.decode(errors='replace').strip()}")
+            if IDLE_EXISTS_RE.match(line):
+                has_new = True
+
+        await self.send(b'DONE\r\n')
+        deadline = loop.time() + IDLE_DONE_TIMEOUT
+        while True:
+            try:
+                line = await asyncio.wait_for(self.read_line(), max(0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise IMAPAbort("Сервер не ответил на завершение IDLE")
+            if line.startswith(tag + b' '):
+                return has_new
 
-def extract_email_body(msg):
+async def open_imap_connection():
     """
-    Извлекает текстовое тело из email сообщения, убирая HTML теги
-    
+    Открывает защищенное соединение с IMAP сервером
+    """
+    return await AsyncIMAPClient.open(IMAP_SERVER, IMAP_PORT)
+
+async def connect_imap(account=None):
+    """
+    Подключается к Яндекс.Почте и выполняет вход
+
     Args:
-        msg: Email сообщение
-        
+        account (dict): Ящик из load_accounts (по умолчанию YANDEX_EMAIL)
+
     Returns:
-        str: Текст письма без HTML разметки
+        IMAP соединение в состоянии AUTH
     """
-    body = ""
-    
+    account = account or default_account()
+    log_info(f"Подключаемся к Яндекс.Почте {account['email']}...")
+    with metrics.span('connect'):
+        mail = await open_imap_connection()
+    with metrics.span('login'):
+        await mail.login(account['email'], account['password'])
+    log_success(f"Успешное подключение к Яндекс.Почте {account['email']}")
+    return mail
+
+async def close_imap(mail):
+    """
+    Закрывает папку и соединение, не выбрасывая исключений
+    """
+    if mail.state == 'LOGOUT':
+        return
     try:
-        if msg.is_multipart():
-            # Обрабатываем multipart сообщение
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                content_disposition = str(part.get('Content-Disposition', ''))
-                
-                # Ищем текстовую часть без вложений
-                if content_type == 'text/plain' and 'attachment' not in content_disposition:
-                    try:
-                        body_bytes = part.get_payload(decode=True)
-                        if body_bytes:
-                            body = body_bytes.decode('utf-8', errors='ignore')
-                            break
-                    except Exception as e:
-                        log_warning(f"Ошибка декодирования части письма: {e}")
-                        continue
-                
-                # Если текстовой версии нет, используем HTML но убираем теги
-                if content_type == 'text/html' and not body and 'attachment' not in content_disposition:
-                    try:
-                        body_bytes = part.get_payload(decode=True)
-                        if body_bytes:
-                            html_body = body_bytes.decode('utf-8', errors='ignore')
-                            # Убираем HTML теги и получаем чистый текст
-                            body = extract_plain_text_from_html(html_body)
-                            break
-                    except Exception as e:
-                        log_warning(f"Ошибка декодирования HTML части: {e}")
-                        continue
-        else:
-            # Обрабатываем простое сообщение
-            try:
-                body_bytes = msg.get_payload(decode=True)
-                if body_bytes:
-                    body_content = body_bytes.decode('utf-8', errors='ignore')
-                    # Если это HTML, убираем теги
-                    if msg.get_content_type() == 'text/html':
-                        body = extract_plain_text_from_html(body_content)
-                    else:
-                        body = body_content
-            except Exception as e:
-                log_warning(f"Ошибка декодирования письма: {e}")
-        
-        # Если тело пустое, возвращаем заглушку
-        if not body:
-            body = "Текст письма не доступен для чтения"
-            
-        return body.strip()
-        
+        if mail.state == 'SELECTED':
+            await mail.close()
+        await mail.logout()
+        log_info("Соединение с почтой закрыто")
     except Exception as e:
-        log_error(f"Ошибка извлечения тела письма: {e}")
-        return "Ошибка чтения текста письма"
+        log_warning(f"Ошибка при закрытии соединения: {e}")
 
-def process_email_message(mail, email_id, last_processed_id):
+async def check_mailbox(mail, account=None, folder=IMAP_MAILBOX, use_status=True):
     """
-    Обрабатывает одно email сообщение
-    
+    Один цикл проверки папки на уже открытом соединении
+
+    Выбирает папку, ищет новые письма по UID, ставит уведомления в очередь
+    отправки и сохраняет состояние. Ошибки IMAP пробрасываются вызывающему коду.
+
     Args:
-        mail: IMAP соединение
-        email_id: ID письма
-        last_processed_id: ID последнего обработанного письма
-        
+        mail: IMAP соединение после входа
+        account (dict): Ящик из load_accounts (по умолчанию YANDEX_EMAIL)
+        folder (str): Папка IMAP
+        use_status (bool): Проверять наличие работы командой STATUS до SELECT
+            (False, если папка должна остаться выбранной, например для IDLE)
+
     Returns:
-        tuple: (new_last_processed_id, notification_sent)
+        int: Количество поставленных в очередь уведомлений
     """
-    email_id_str = email_id.decode()
-    log_info(f"Обработка письма ID: {email_id_str}")
+    account = account or default_account()
+    mailbox = mailbox_key(account, folder)
+    folder_name = imap_quote(encode_mailbox_name(folder))
     
-    # Пропускаем уже обработанные письма
-    if last_processed_id and int(email_id_str) <= int(last_processed_id):
-        log_info("Письмо уже обработано, пропускаем")
-        return last_processed_id, False
+    # Загружаем состояние
+    state = load_processed_state(mailbox)
+    journal = get_state_journal()
+    # Уведомлениям очереди с прошлого запуска нужен текст, а доставленным письмам - флаг \Seen,
+    # и для того и для другого нужна выбранная папка
+    unsent = [entry for entry in journal.pending() if entry['mailbox'] == mailbox and entry['text'] is None]
+    unflagged = journal.unflagged_uids(mailbox, state['uidvalidity']) if state else []
+    if state and use_status and not unsent and not unflagged and await is_mailbox_idle(mail, folder_name, mailbox, state):
+        return 0
     
-    # Получаем письмо
-    try:
-        status, msg_data = mail.fetch(email_id, '(RFC822)')
+    metrics.inc('mailboxes_checked')
+    with metrics.span('select'):
+        status, _ = await mail.select(folder_name)
         if status != 'OK':
-            log_error("Ошибка получения письма")
-            return last_processed_id, False
-    except Exception as e:
-        log_error(f"Ошибка при получении письма: {e}")
-        return last_processed_id, False
+            raise IMAPError(f"Не удалось открыть папку {mailbox}")
+        uidvalidity, uidnext = await get_mailbox_uid_info(mail, folder_name)
     
-    # Парсим письмо
-    try:
-        msg = email.message_from_bytes(msg_data[0][1])
-    except Exception as e:
-        log_error(f"Ошибка парсинга письма: {e}")
-        return last_processed_id, False
+    stats = {'bytes_fetched': 0, 'scanned': 0, 'matched': 0}
+    if unsent:
+        await restore_notification_texts(mail, mailbox, uidvalidity, unsent, stats)
     
-    # Извлекаем тему
-    subject_raw = msg.get('Subject', 'Без темы')
-    subject_clean = decode_email_header(subject_raw)
+    if state and state['uidvalidity'] != uidvalidity:
+        log_warning(
+            f"UIDVALIDITY изменился ({state['uidvalidity']} -> {uidvalidity}), "
+            f"выполняем полную синхронизацию"
+        )
+        state = None
+    last_uid = state['last_uid'] if state else 0
     
-    # Извлекаем отправителя
-    sender_raw = msg.get('From', 'Неизвестный отправитель')
-    sender_clean = decode_email_header(sender_raw)
+    # Если UIDNEXT не сдвинулся, новых писем нет и искать нечего
+    if state and uidnext - 1 <= last_uid:
+        log_info(f"Нет новых писем в {mailbox}")
+        await flag_delivered_messages(mail, mailbox, uidvalidity)
+        return 0
+    
+    if state:
+        # Инкрементальная синхронизация: только письма, пришедшие после прошлого запуска
+        log_info(f"Поиск новых писем начиная с UID {last_uid + 1}...")
+        base_criteria = ['UID', f"{last_uid + 1}:{uidnext - 1}", 'UNSEEN']
+    else:
+        log_info("Поиск непрочитанных писем...")
+        base_criteria = ['UNSEEN']
+    with metrics.span('search'):
+        email_ids = await search_messages(mail, base_criteria)
     
-    log_info(f"Тема: {subject_clean}")
-    log_info(f"Отправитель (очищенный): {sender_clean}")
+    if email_ids is None:
+        log_error("Ошибка поиска писем")
+        return 0
     
-    # Проверяем критерии на оригинальном отправителе
-    if not check_email_criteria(subject_clean, sender_raw):
-        log_info("Письмо не подходит под критерии фильтрации")
-        return last_processed_id, False
+    email_ids = [email_id for email_id in email_ids if last_uid < int(email_id) < uidnext]
+    log_info(f"Найдено новых непрочитанных писем: {len(email_ids)}")
     
-    log_success("Письмо подходит под критерии! Обрабатываем...")
+    tracker = ProgressTracker(email_ids, last_uid, uidnext, uidvalidity, mailbox)
+    notices = []
     
-    # Извлекаем текст письма
-    body = extract_email_body(msg)
-    log_info(f"Длина текста письма: {len(body)} символов")
+    # Письма, уже разобранные в прошлых запусках, берутся из локального кэша
+    cache = get_message_cache()
+    cached = cache.get_many(mailbox, uidvalidity, email_ids) if cache and email_ids else {}
+    criteria = criteria_fingerprint()
+    if cached:
+        log_info(f"Найдено в локальном кэше: {len(cached)}")
+        metrics.inc('cache_hits', len(cached))
     
-    # Отправляем уведомление в Telegram
-    notification_sent = False
-    if send_telegram_message(subject_clean, sender_clean, body, email_id_str):
-        notification_sent = True
-        log_success("Уведомление обработано успешно")
-    else:
-        log_error("Ошибка отправки уведомления")
+    # Первый проход: только заголовки всех кандидатов одним пакетом
+    missing_ids = [email_id for email_id in email_ids if email_id.decode() not in cached]
+    headers_by_id = {}
+    if missing_ids:
+        with metrics.span('fetch'):
+            headers_by_id = await fetch_message_headers(mail, missing_ids, stats)
+    if cache and headers_by_id:
+        cache.put_headers(mailbox, uidvalidity, headers_by_id)
+    
+    # Уведомления, доставленные или поставленные в очередь до сбоя, но не прошедшие границу UID, не повторяются
+    delivered_before = journal.delivered_uids(mailbox, uidvalidity)
+    already_delivered = []
+    duplicates = []
+    decisions = []
+    with metrics.span('filter'):
+        for email_id in email_ids:
+            entry = cached.get(email_id.decode())
+            headers = entry['headers'] if entry else headers_by_id.get(email_id.decode())
+            if headers is None:
+                # Не сдвигаем состояние дальше письма, которое не удалось прочитать
+                log_warning(f"Не удалось получить заголовки письма UID: {email_id.decode()}")
+                break
+            stats['scanned'] += 1
+            matched = entry['matched'] if entry and entry['criteria'] == criteria else None
+            notice = process_email_message(email_id, headers, stats, matched)
+            if matched is None:
+                decisions.append((email_id, notice is not None))
+            if notice and notice['uid'] in delivered_before:
+                log_debug("Уведомление о письме UID %s уже доставлено", notice['uid'])
+                already_delivered.append(notice)
+                tracker.complete(email_id)
+            elif notice and DEDUP_WINDOW_HOURS > 0 and not journal.claim_keys(notice['dedup_keys']):
+                # Копия из другого ящика или повторное уведомление по делу: тело не загружаем
+                log_debug("Письмо UID %s повторяет уже отправленное уведомление", notice['uid'])
+                duplicates.append(notice)
+                tracker.complete(email_id)
+            elif notice:
+                if entry:
+                    notice['body'] = entry['preview']
+                notice['chat_id'] = notice['chat_id'] or account['chat_id']
+                notices.append(notice)
+            else:
+                tracker.complete(email_id)
+    if cache and decisions:
+        cache.put_decisions(mailbox, uidvalidity, criteria, decisions)
     
-    # Помечаем письмо как прочитанное
+    # Второй проход: тела загружаются только для подходящих писем, уведомления ставятся в очередь отправки
     try:
-        mail.store(email_id, '+FLAGS', '\\Seen')
-        log_info("Письмо помечено как прочитанное")
-    except Exception as e:
-        log_warning(f"Ошибка при пометке письма как прочитанного: {e}")
+        queued = await run_notification_pipeline(mail, notices, tracker, stats, account['chat_id'])
+    finally:
+        # Ключи поставленных в очередь уведомлений уже в журнале, остальные письма проверятся снова
+        if DEDUP_WINDOW_HOURS > 0:
+            journal.release_keys([key for notice in notices for key in notice['dedup_keys']])
+    if duplicates:
+        log_info(f"Пропущено повторов уже отправленных уведомлений: {len(duplicates)}")
+        metrics.inc('duplicates_dropped', len(duplicates))
     
-    return email_id_str, notification_sent
+    # Прочитанными помечаются письма с доставленными уведомлениями и их повторы,
+    # письма из очереди отправки ждут доставки
+    waiting = {
+        str(uid) for entry in journal.pending()
+        if entry['mailbox'] == mailbox and entry['uidvalidity'] == uidvalidity for uid in entry['uids']
+    }
+    await flag_delivered_messages(mail, mailbox, uidvalidity, [
+        notice['uid'] for notice in already_delivered if notice['uid'] not in waiting
+    ] + [notice['uid'] for notice in duplicates])
+    
+    # Сохраняем состояние, если были обработаны новые письма
+    new_last_uid = tracker.commit(force=state is None)
+    if new_last_uid == last_uid:
+        log_info("Состояние не изменилось")
+    if cache:
+        cache.evict()
+    
+    metrics.inc('messages_scanned', stats['scanned'])
+    metrics.inc('messages_matched', stats['matched'])
+    metrics.inc('bytes_fetched', stats['bytes_fetched'])
+    metrics.inc('notifications_queued', len(queued))
+    
+    # Выводим итоги
+    log_success(f"Проверка {mailbox} завершена. Поставлено в очередь уведомлений: {len(queued)}")
+    log_info(f"Просмотрено писем: {stats['scanned']}, подошло под критерии: {stats['matched']}")
+    log_info(f"Получено данных с сервера: {format_bytes(stats['bytes_fetched'])}")
+    log_info(f"Текущее состояние: UIDVALIDITY {uidvalidity}, UID {new_last_uid}")
+    return len(queued)
 
-def check_email():
+async def check_account_folders(mail, account, keep_selected=False, secondary_only=False):
     """
-    Основная функция проверки почты
+    Проверяет все папки ящика на одном соединении
+
+    Ошибка отдельной папки (например, папка не существует) не мешает проверке
+    остальных, обрыв соединения пробрасывается. Основная (первая) папка
+    проверяется последней, чтобы в режиме демона IDLE следил именно за ней.
+
+    Args:
+        keep_selected (bool): Основная папка должна остаться выбранной (для IDLE),
+            поэтому для нее быстрый путь через STATUS не используется
+        secondary_only (bool): Проверить только остальные папки (через STATUS),
+            основную - лишь если пришлось выбрать другую папку и ее нужно выбрать снова
+            или в ней есть письма с доставленными уведомлениями
+
+    Returns:
+        int: Количество поставленных в очередь уведомлений по всем папкам
     """
-    log_info("Начинаем проверку почты...")
-    log_info(f"Время начала: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-    
+    folders = account['folders'][1:] + account['folders'][:1]
+    main_folder = imap_quote(encode_mailbox_name(account['folders'][0]))
+    queued = 0
+    for index, folder in enumerate(folders, 1):
+        is_main = index == len(folders)
+        if (is_main and secondary_only and mail.selected == main_folder
+                and not get_state_journal().unflagged_uids(mailbox_key(account, folder))):
+            # STATUS остальных папок не снимает выбор основной, а доставленных писем для флага \Seen нет
+            break
+        try:
+            queued += await check_mailbox(mail, account, folder, use_status=not (keep_selected and is_main))
+        except IMAPAbort:
+            raise
+        except IMAPError as e:
+            log_error(f"Ошибка IMAP в папке {mailbox_key(account, folder)}: {e}")
+            metrics.inc('imap_errors')
+    return queued
+
+async def check_account(account, slots=None):
+    """
+    Проверяет один ящик: отдельное соединение на все его папки
+
+    Args:
+        account (dict): Ящик из load_accounts
+        slots (asyncio.Semaphore): Ограничение числа одновременно проверяемых ящиков
+    """
+    if slots is not None:
+        async with slots:
+            await check_account(account)
+        return
     mail = None
     try:
         # Подключаемся к серверу Яндекс.Почты
-        log_info("Подключаемся к Яндекс.Почте...")
-        mail = imaplib.IMAP4_SSL(IMAP_SERVER, IMAP_PORT)
-        mail.login(YANDEX_EMAIL, YANDEX_APP_PASSWORD)
-        mail.select('inbox')
-        log_success("Успешное подключение к Яндекс.Почте")
-        
-        # Ищем непрочитанные письма
-        log_info("Поиск непрочитанных писем...")
-        status, messages = mail.search(None, 'UNSEEN')
-        
-        if status != 'OK':
-            log_info("Нет новых писем")
-            return
-        
-        email_ids = messages[0].split()
-        
-        if not email_ids:
-            log_info("Нет непрочитанных писем")
-            return
-        
-        log_info(f"Найдено непрочитанных писем: {len(email_ids)}")
-        
-        # Загружаем состояние
-        last_processed_id = load_processed_state()
-        new_last_processed_id = last_processed_id
-        notifications_sent = 0
-        
-        # Обрабатываем письма
-        for email_id in email_ids:
-            new_id, sent = process_email_message(mail, email_id, last_processed_id)
-            if new_id != last_processed_id:
-                new_last_processed_id = new_id
-            if sent:
-                notifications_sent += 1
-        
-        # Сохраняем состояние, если были обработаны новые письма
-        if new_last_processed_id != last_processed_id:
-            save_processed_state(new_last_processed_id)
-        else:
-            log_info("Состояние не изменилось")
-        
-        # Выводим итоги
-        log_success(f"Проверка завершена. Отправлено уведомлений: {notifications_sent}")
-        log_info(f"Текущее состояние: ID {new_last_processed_id}")
+        mail = await connect_imap(account)
+        await check_account_folders(mail, account)
         
-    except imaplib.IMAP4.error as e:
-        log_error(f"Ошибка IMAP: {e}")
+    except IMAPError as e:
+        log_error(f"Ошибка IMAP ({account['email']}): {e}")
+        metrics.inc('imap_errors')
     except Exception as e:
-        log_error(f"Критическая ошибка: {e}")
+        log_error(f"Критическая ошибка ({account['email']}): {e}")
+        metrics.inc('imap_errors')
     finally:
         # Закрываем соединение
         if mail:
+            await close_imap(mail)
+
+async def check_email():
+    """
+    Основная функция проверки почты
+
+    Ящики проверяются параллельно в одном цикле событий (не больше
+    ACCOUNT_WORKERS одновременно), поэтому общее время близко ко времени
+    самого медленного ящика, а число потоков не растет с числом ящиков.
+    Уведомления доставляются из очереди параллельно с проверкой, после нее
+    запуск ждет доставки не дольше OUTBOX_DRAIN_TIMEOUT секунд.
+    """
+    log_info("Начинаем проверку почты...")
+    log_info(f"Время начала: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    
+    try:
+        accounts = load_accounts()
+    except ValueError as e:
+        log_error(f"Ошибка списка ящиков: {e}")
+        return
+    
+    worker = start_outbox_worker()
+    try:
+        if len(accounts) == 1:
+            await check_account(accounts[0])
+        else:
+            slots = asyncio.Semaphore(ACCOUNT_WORKERS)
+            await asyncio.gather(*(check_account(account, slots) for account in accounts))
+        restore_orphaned_notifications(accounts)
+        left = await worker.drain(OUTBOX_DRAIN_TIMEOUT)
+        if left:
+            log_warning(f"Не доставлено уведомлений: {left}, они останутся в очереди до следующего запуска")
+    finally:
+        await worker.stop()
+    # Журнал (вместе с очередью отправки) сворачивается в email_state.json, который сохраняет workflow
+    compact_state()
+
+def week_hour(timestamp):
+    """
+    Номер часа московской недели (0 - понедельник 00:00, 167 - воскресенье 23:00)
+    """
+    moment = datetime.fromtimestamp(timestamp, MOSCOW_TZ)
+    return moment.weekday() * 24 + moment.hour
+
+def is_business_hour(hour):
+    """
+    Рабочий ли час недели по Москве (пн-пт, BUSINESS_HOURS)
+    """
+    return hour < 5 * 24 and BUSINESS_HOURS[0] <= hour % 24 < BUSINESS_HOURS[1]
+
+class ArrivalHistogram:
+    """
+    Выученное распределение прихода уведомлений по часам московской недели
+
+    Для каждого ящика хранится 168 счетчиков (7 дней по 24 часа). Пока
+    наблюдений мало, вес часа задает начальное значение: рабочие часы суда
+    заметно важнее ночи и выходных. Когда наблюдений набирается
+    POLL_HISTOGRAM_CAP, счетчики делятся пополам, поэтому гистограмма
+    подстраивается под изменившийся распорядок. Сохраняется в JSON файл
+    после каждого нового наблюдения (это редкие события).
+
+    Args:
+        path (str): Файл гистограммы (пусто - только в памяти)
+    """
+
+    def __init__(self, path=''):
+        self.path = path
+        self.counts = {}
+        if path and os.path.exists(path):
             try:
-                mail.close()
-                mail.logout()
-                log_info("Соединение с почтой закрыто")
-            except Exception as e:
-                log_warning(f"Ошибка при закрытии соединения: {e}")
+                with open(path, encoding='utf-8') as f:
+                    data = json.load(f)
+                self.counts = {
+                    name: [float(value) for value in counts]
+                    for name, counts in data.get('mailboxes', {}).items() if len(counts) == 7 * 24
+                }
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                log_warning(f"Не удалось прочитать гистограмму опроса {path}, начинаем заново: {e}")
+
+    def rates(self, name):
+        """
+        Вес каждого часа недели: наблюдения плюс начальное значение
+
+        Returns:
+            list: 168 весов
+        """
+        counts = self.counts.get(name) or [0.0] * (7 * 24)
+        return [
+            count + (POLL_PRIOR_BUSINESS if is_business_hour(hour) else POLL_PRIOR_OFF_HOURS)
+            for hour, count in enumerate(counts)
+        ]
+
+    def record(self, name, timestamp, count=1):
+        """
+        Учитывает count уведомлений, пришедших в момент timestamp
+        """
+        counts = self.counts.setdefault(name, [0.0] * (7 * 24))
+        counts[week_hour(timestamp)] += count
+        if sum(counts) > POLL_HISTOGRAM_CAP:
+            self.counts[name] = [value / 2 for value in counts]
+        self.save()
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'mailboxes': {
+                    name: [round(value, 3) for value in counts] for name, counts in self.counts.items()
+                }}, f)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            log_warning(f"Не удалось сохранить гистограмму опроса {self.path}: {e}")
+
+_arrival_histogram = None
+
+def get_arrival_histogram():
+    """
+    Возвращает общую гистограмму прихода писем, загружая ее при первом обращении
+    """
+    global _arrival_histogram
+    if _arrival_histogram is None:
+        _arrival_histogram = ArrivalHistogram(POLL_HISTOGRAM_FILE)
+    return _arrival_histogram
+
+class PollScheduler:
+    """
+    Интервал опроса ящика без IDLE по выученному распорядку прихода писем
+
+    Базовый интервал часа обратно пропорционален корню из его веса в
+    гистограмме: в самый загруженный час он равен min_interval, в час с
+    весом в 100 раз меньше - в 10 раз длиннее (корень - оптимум между
+    задержкой уведомления и числом запросов при пуассоновском потоке).
+    В течение POLL_RECENT_MATCH_WINDOW после уведомления опрос идет с
+    минимальным интервалом. Вне рабочих часов каждый пустой опрос удваивает
+    интервал (не больше чем в POLL_BACKOFF_LIMIT раз и не дольше max_interval),
+    но сон не переходит начало часа, в котором базовый интервал короче, -
+    утром опрос учащается вовремя.
+
+    Args:
+        name (str): Ящик, по которому ведется гистограмма
+        histogram (ArrivalHistogram): Гистограмма (по умолчанию общая из POLL_HISTOGRAM_FILE)
+        min_interval (float): Нижняя граница интервала, секунды
+        max_interval (float): Верхняя граница интервала, секунды
+    """
+
+    def __init__(self, name, histogram=None, min_interval=None, max_interval=None):
+        self.name = name
+        self.histogram = histogram if histogram is not None else get_arrival_histogram()
+        self.min_interval = min_interval or POLL_INTERVAL_MIN
+        self.max_interval = max(max_interval or POLL_INTERVAL_MAX, self.min_interval)
+        self.last_arrival = None
+        self.idle_polls = 0
+
+    def observe(self, now, arrivals):
+        """
+        Учитывает результат опроса
+
+        Args:
+            now (float): Время опроса (time.time())
+            arrivals (int): Сколько уведомлений найдено
+        """
+        if arrivals:
+            self.last_arrival = now
+            self.idle_polls = 0
+            self.histogram.record(self.name, now, arrivals)
+        else:
+            self.idle_polls += 1
+
+    def base_intervals(self):
+        rates = self.histogram.rates(self.name)
+        peak = max(rates)
+        return [min(self.max_interval, self.min_interval * (peak / rate) ** 0.5) for rate in rates]
+
+    def next_interval(self, now):
+        """
+        Через сколько секунд опросить ящик снова
+
+        Returns:
+            float: Интервал в секундах
+        """
+        if self.last_arrival is not None and now - self.last_arrival < POLL_RECENT_MATCH_WINDOW:
+            return self.min_interval
+        bases = self.base_intervals()
+        hour = week_hour(now)
+        interval = bases[hour]
+        if not is_business_hour(hour):
+            interval = min(self.max_interval, interval * min(2 ** self.idle_polls, POLL_BACKOFF_LIMIT))
+
+        # Не просыпаем начало часа, в котором нужно опрашивать чаще
+        boundary = now - now % 3600 + 3600
+        while boundary < now + interval:
+            if bases[week_hour(boundary)] < interval:
+                return max(boundary - now, 1.0)
+            boundary += 3600
+        return interval
+
+async def wait_for_new_mail(mail, use_idle, scheduler=None):
+    """
+    Ждет появления новых писем или истечения интервала ожидания
+
+    Args:
+        mail: IMAP соединение с выбранной папкой
+        use_idle (bool): Ждать через IDLE, иначе опрашивать командой NOOP
+        scheduler (PollScheduler): Интервал опроса (по умолчанию NOOP_POLL_INTERVAL)
+
+    Returns:
+        bool: True если есть новые письма
+    """
+    if use_idle:
+        return await mail.idle(IDLE_TIMEOUT)
+
+    await asyncio.sleep(scheduler.next_interval(time.time()) if scheduler else NOOP_POLL_INTERVAL)
+    status, _ = await mail.noop()
+    if status != 'OK':
+        raise IMAPAbort("NOOP завершился с ошибкой")
+    return mail.response('EXISTS')[1][0] is not None
+
+async def run_daemon(account=None, poll=False):
+    """
+    Режим демона: одно постоянное IMAP соединение и реакция на письма за секунды
+
+    Новые письма отслеживаются через IDLE (или NOOP, если сервер его не
+    поддерживает), при обрыве соединение восстанавливается с экспоненциальной
+    задержкой. IDLE следит за основной папкой ящика, остальные папки
+    проверяются при каждом выходе из ожидания (не реже раза в IDLE_TIMEOUT)
+    одной командой STATUS на папку без повторного SELECT. Письма, уведомления
+    о которых доставлены за время ожидания, помечаются прочитанными при
+    следующем выходе из него.
+    Без IDLE интервал опроса выбирает PollScheduler по выученному распорядку
+    прихода уведомлений, между полными проверками идут только NOOP и STATUS.
+
+    Args:
+        account (dict): Ящик из load_accounts (по умолчанию YANDEX_EMAIL)
+        poll (bool): Опрашивать сервер, даже если он поддерживает IDLE
+    """
+    account = account or default_account()
+    scheduler = None
+    delay = RECONNECT_DELAY_MIN
+    while True:
+        mail = None
+        try:
+            mail = await connect_imap(account)
+            use_idle = 'IDLE' in mail.capabilities and not poll
+            log_info(f"Ожидание писем {account['email']} через {'IDLE' if use_idle else 'опрос NOOP'}")
+            if not use_idle and scheduler is None:
+                scheduler = PollScheduler(account['name'])
+
+            # Догоняем письма, пришедшие пока демон не работал
+            await check_account_folders(mail, account, keep_selected=True)
+            delay = RECONNECT_DELAY_MIN
+
+            while True:
+                # О письме, пришедшем во время проверки, сервер сообщает EXISTS в ответе на ее
+                # команды, а в IDLE повторно не сообщит: такое письмо проверяем сразу
+                has_new = mail.response('EXISTS')[1][0] is not None
+                if has_new:
+                    log_debug("Новые письма пришли во время проверки %s", account['email'])
+                else:
+                    has_new = await wait_for_new_mail(mail, use_idle, scheduler)
+                if has_new:
+                    log_info(f"Получено уведомление о новых письмах {account['email']}")
+                queued = 0
+                if has_new:
+                    queued = await check_account_folders(mail, account, keep_selected=True)
+                elif len(account['folders']) > 1 or get_state_journal().unflagged_uids(
+                        mailbox_key(account, account['folders'][0])):
+                    queued = await check_account_folders(mail, account, keep_selected=True, secondary_only=True)
+                if scheduler:
+                    scheduler.observe(time.time(), queued)
+        except Exception as e:
+            log_error(f"Ошибка соединения с почтой {account['email']}: {e}")
+            metrics.inc('reconnects')
+        finally:
+            if mail:
+                await close_imap(mail)
+
+        # Случайная добавка, чтобы не переподключаться синхронно с другими клиентами
+        pause = delay + random.uniform(0, delay / 2)
+        log_warning(f"Переподключение к {account['email']} через {pause:.0f} с")
+        await asyncio.sleep(pause)
+        delay = min(delay * 2, RECONNECT_DELAY_MAX)
+
+async def run_daemons(accounts, poll=False):
+    """
+    Запускает демона для каждого ящика со своим соединением в общем цикле событий
+
+    Отдельный поток на ящик больше не нужен: все демоны ждут IDLE в одном потоке.
+    Уведомления всех ящиков доставляет общий OutboxWorker.
+    """
+    worker = start_outbox_worker()
+    restore_orphaned_notifications(accounts)
+    try:
+        await asyncio.gather(*(run_daemon(account, poll) for account in accounts))
+    finally:
+        await worker.stop()
+
+def run_coroutine(coroutine):
+    """
+    Выполняет корутину в новом цикле событий, синхронная обертка для точек входа
+
+    Разбор писем уходит в пул из PARSE_WORKERS потоков (исполнитель цикла по
+    умолчанию), соединения пула Telegram закрываются вместе с циклом.
+
+    Returns:
+        Результат корутины
+    """
+    async def run():
+        from concurrent.futures import ThreadPoolExecutor
+
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=PARSE_WORKERS))
+        try:
+            return await coroutine
+        finally:
+            if _telegram_client is not None:
+                _telegram_client.close()
+
+    return asyncio.run(run())
+
+def validate_config(imap=True):
+    """
+    Проверяет обязательные переменные окружения
+
+    Args:
+        imap (bool): Нужен ли доступ к почте (для повторной отправки из кэша не нужен)
+
+    Returns:
+        bool: True если конфигурация полная
+    """
+    if ACCOUNTS_FILE:
+        # Ящики, пароли и чаты описаны в файле
+        required_vars = {'TELEGRAM_BOT_TOKEN': TELEGRAM_BOT_TOKEN}
+    else:
+        required_vars = {
+            'TELEGRAM_BOT_TOKEN': TELEGRAM_BOT_TOKEN,
+            'TELEGRAM_CHAT_ID': TELEGRAM_CHAT_ID
+        }
+        if imap:
+            required_vars = {'YANDEX_EMAIL': YANDEX_EMAIL, 'YANDEX_APP_PASSWORD': YANDEX_APP_PASSWORD, **required_vars}
+    
+    missing_vars = [var for var, value in required_vars.items() if not value]
+    if missing_vars:
+        log_error(f"Отсутствуют обязательные переменные: {', '.join(missing_vars)}")
+        return False
+    
+    if ACCOUNTS_FILE:
+        try:
+            accounts = load_accounts()
+        except ValueError as e:
+            log_error(f"Ошибка списка ящиков: {e}")
+            return False
+        for account in accounts:
+            if imap and not account['password']:
+                log_error(f"Не задан пароль ящика {account['email']}")
+                return False
+            if not account['chat_id']:
+                log_error(f"Не задан чат для ящика {account['email']}")
+                return False
+        log_info(f"Ящиков: {len(accounts)}, одновременно проверяется не больше {ACCOUNT_WORKERS}")
+    
+    try:
+        rules = get_rule_set().rules
+    except ValueError as e:
+        log_error(f"Ошибка правил фильтрации: {e}")
+        return False
+    
+    log_info("Конфигурация проверена успешно")
+    if RULES_FILE:
+        log_info(f"Правил фильтрации: {len(rules)}")
+    else:
+        log_info(f"Целевой отправитель: {TARGET_SENDER}")
+        log_info(f"Ключевые слова в теме: {TARGET_SUBJECT_KEYWORDS}")
+    log_info(f"Поиск на стороне сервера: {'включен' if IMAP_SERVER_SEARCH else 'выключен'}")
+    return True
 
 def main():
     """
@@ -531,28 +4146,108 @@ def main():
     print("=" * 50)
     
     # Проверяем обязательные переменные окружения
-    required_vars = {
-        'YANDEX_EMAIL': YANDEX_EMAIL,
-        'YANDEX_APP_PASSWORD': YANDEX_APP_PASSWORD,
-        'TELEGRAM_BOT_TOKEN': TELEGRAM_BOT_TOKEN,
-        'TELEGRAM_CHAT_ID': TELEGRAM_CHAT_ID
-    }
-    
-    missing_vars = [var for var, value in required_vars.items() if not value]
-    if missing_vars:
-        log_error(f"Отсутствуют обязательные переменные: {', '.join(missing_vars)}")
+    if not validate_config():
         return
     
-    log_info("Конфигурация проверена успешно")
-    log_info(f"Целевой отправитель: {TARGET_SENDER}")
-    log_info(f"Ключевые слова в теме: {TARGET_SUBJECT_KEYWORDS}")
-    
     # Запускаем проверку почты
-    check_email()
+    run_coroutine(check_email())
+    report_metrics()
     
     print("=" * 50)
     log_success("Работа скрипта завершена")
     print("=" * 50)
 
+def daemon_main(poll=False):
+    """
+    Точка входа режима демона
+
+    Args:
+        poll (bool): Адаптивный опрос вместо IDLE (--poll)
+    """
+    print("=" * 50)
+    print("🎯 YANDEX MAIL TO TELEGRAM NOTIFIER (DAEMON)")
+    print("=" * 50)
+    
+    if not validate_config():
+        return
+    
+    use_default_message_cache()
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    try:
+        run_coroutine(run_daemons(load_accounts(), poll))
+    except KeyboardInterrupt:
+        log_info("Демон остановлен")
+    compact_state()
+    report_metrics()
+
+async def resend_last_notices(count):
+    """
+    Повторно отправляет последние count уведомлений из локального кэша
+
+    Почтовый сервер не используется: заголовки и отрывки берутся из кэша.
+    Уведомления повторяются для каждой папки каждого ящика в ее чат.
+
+    Args:
+        count (int): Сколько последних уведомлений папки отправить
+
+    Returns:
+        int: Количество отправленных уведомлений
+    """
+    cache = get_message_cache()
+    if cache is None:
+        log_error("Локальный кэш писем отключен (MESSAGE_CACHE_FILE)")
+        return 0
+    sent = 0
+    for account in load_accounts():
+        for folder in account['folders']:
+            entries = cache.recent_matches(mailbox_key(account, folder), count)
+            log_info(f"Найдено в кэше уведомлений {mailbox_key(account, folder)}: {len(entries)}")
+            for entry in entries:
+                headers = entry['headers']
+                sender_raw = headers.get('From', 'Неизвестный отправитель')
+                sender_clean = decode_email_header(sender_raw)
+                subject = headers.get('Subject', 'Без темы')
+                preview = entry['preview'] or UNREADABLE_BODY_TEXT
+                # Чат и шаблон берутся из правила, под которое письмо подходит сейчас
+                rule = get_rule_set().match(decode_email_header(subject), sender_raw) or {}
+                if await send_telegram_message(subject, sender_clean, preview, entry['uid'],
+                                         rule.get('chat_id') or account['chat_id'],
+                                         rule.get('template', '')) is not None:
+                    sent += 1
+    log_success(f"Повторно отправлено уведомлений: {sent}")
+    return sent
+
+def resend_main(count):
+    """
+    Точка входа повторной отправки (--resend N)
+    """
+    print("=" * 50)
+    print("🎯 YANDEX MAIL TO TELEGRAM NOTIFIER (RESEND)")
+    print("=" * 50)
+    
+    if not validate_config(imap=False):
+        return
+    
+    use_default_message_cache()
+    
+    run_coroutine(resend_last_notices(count))
+
 if __name__ == '__main__':
-    main()
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Уведомления в Telegram о письмах суда из Яндекс.Почты")
+    parser.add_argument('--daemon', action='store_true', help="постоянное соединение и IDLE")
+    parser.add_argument('--poll', action='store_true', help="режим демона с адаптивным опросом вместо IDLE")
+    parser.add_argument('--resend', type=int, nargs='?', const=1, metavar='N',
+                        help="повторно отправить N последних уведомлений каждой папки из кэша")
+    arguments = parser.parse_args()
+    if arguments.resend is not None and arguments.resend < 1:
+        parser.error("--resend: число уведомлений должно быть положительным")
+
+    if arguments.daemon or arguments.poll:
+        daemon_main(poll=arguments.poll)
+    elif arguments.resend is not None:
+        resend_main(arguments.resend)
+    else:
+        main()